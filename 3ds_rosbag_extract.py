@@ -3,61 +3,128 @@
 # import rosbag
 import numpy as np
 import teleop_utils as utils
+import se3_batch
+from artifact_store import ArtifactStore
+import stage_cache
+import instrumentation
+import rel_pose_computation as rpc
 from pathlib import Path
-from rosbags.highlevel import AnyReader
-from spatialmath import *
 import os
-import ipdb
-
-def extract(config):
-    # Initializing lists to add data
-    pose_msg_list = []
-    user_input_traj = []
-    button1_list = []
-    button2_list = []
+import tempfile
+
+POSE_TOPIC = '/arm/measured_cp'
+BUTTON_TOPICS = {'/arm/button1': 'button1', '/arm/button2': 'button2'}
+
+class GrowableBuffer:
+    """
+    Row buffer backed by a numpy array whose capacity doubles when full,
+    so appending a message does not allocate a new Python object per row
+    """
+    def __init__(self, width, capacity=1024):
+        self.data = np.empty((capacity, width))
+        self.size = 0
+
+    def append(self, row):
+        if self.size == len(self.data):
+            self.data = np.resize(self.data, (2 * len(self.data), self.data.shape[1]))
+        self.data[self.size] = row
+        self.size += 1
+
+    def array(self):
+        return self.data[:self.size]
+
+    def clear(self):
+        self.size = 0
+
+def _stamp(msg):
+    return msg.header.stamp.sec + (msg.header.stamp.nanosec / 1000000000)
+
+@instrumentation.traced
+def read_bag(rosbag_path, spill_dir, chunk_size=None):
+    """
+    Returns the button1, button2, pose_msg and user_input_traj arrays of the rosbag
+
+    The bag is read in a single pass over the three topics. Pose messages are stored
+    as [time, x, y, z, qx, qy, qz, qw] rows in a growable buffer and all quaternions are
+    converted to rotation matrices in one vectorized batch.
+
+    chunk_size = optional number of pose messages kept in memory: full chunks are converted
+    and spilled to temporary files in spill_dir, and returned as memory maps of these files,
+    so the peak memory does not grow with the length of the bag
+    """
+    pose_buffer = GrowableBuffer(8, capacity=chunk_size or 1024)
+    button_buffers = {name: GrowableBuffer(2, capacity=64) for name in BUTTON_TOPICS.values()}
+    pose_msg_file = os.path.join(spill_dir, 'pose_msg.bin')
+    traj_file = os.path.join(spill_dir, 'user_input_traj.bin')
+    n_spilled = 0
+
+    def spill():
+        # convert and append the buffered chunk to the temporary files
+        nonlocal n_spilled
+        chunk = pose_buffer.array()
+        with open(pose_msg_file, 'ab') as f:
+            chunk.tofile(f)
+        with open(traj_file, 'ab') as f:
+            se3_batch.pose_msg_to_traj(chunk).tofile(f)
+        n_spilled += len(chunk)
+        pose_buffer.clear()
+
     # create reader instance and open for reading
-    with AnyReader([Path(config['user_input_rosbag'])]) as reader:
-        connections = [x for x in reader.connections if x.topic == '/arm/measured_cp']
+    from rosbags.highlevel import AnyReader
+    with AnyReader([Path(rosbag_path)]) as reader:
+        connections = [x for x in reader.connections if x.topic == POSE_TOPIC or x.topic in BUTTON_TOPICS]
         for connection, timestamp, rawdata in reader.messages(connections=connections):
-            # reading raw pose messages
             msg = reader.deserialize(rawdata, connection.msgtype)
-            time = msg.header.stamp.sec + (msg.header.stamp.nanosec / 1000000000)
-            pose_msg = np.array([time, msg.pose.position.x, msg.pose.position.y, msg.pose.position.z, 
-                            msg.pose.orientation.x, msg.pose.orientation.y, msg.pose.orientation.z, msg.pose.orientation.w])
-            pose_msg_list.append(pose_msg)
-
-            pose_SE3 = SE3(SO3(UnitQuaternion(
-                s = msg.pose.orientation.w, 
-                v = [msg.pose.orientation.x, msg.pose.orientation.y, msg.pose.orientation.z]).R))
-            pose_SE3.t = [msg.pose.position.x, msg.pose.position.y, msg.pose.position.z]
-            user_input_traj.append(pose_SE3)
-                
-        connections = [x for x in reader.connections if x.topic == '/arm/button1']
-        for connection, timestamp, rawdata in reader.messages(connections=connections):
-            msg = reader.deserialize(rawdata, connection.msgtype)
-            try:
-                time = msg.header.stamp.sec + (msg.header.stamp.nanosec / 1000000000)
-                button1_list.append(np.array([time, msg.buttons[0]]))
-            except:
-                button1_list.append(np.array([0, 0]))
+            if connection.topic == POSE_TOPIC:
+                # reading raw pose messages
+                position, orientation = msg.pose.position, msg.pose.orientation
+                pose_buffer.append((_stamp(msg), position.x, position.y, position.z,
+                                    orientation.x, orientation.y, orientation.z, orientation.w))
+                if chunk_size is not None and pose_buffer.size == chunk_size:
+                    spill()
+            else:
+                try:
+                    button_buffers[BUTTON_TOPICS[connection.topic]].append((_stamp(msg), msg.buttons[0]))
+                except:
+                    button_buffers[BUTTON_TOPICS[connection.topic]].append((0, 0))
 
-        connections = [x for x in reader.connections if x.topic == '/arm/button2']
-        for connection, timestamp, rawdata in reader.messages(connections=connections):
-            msg = reader.deserialize(rawdata, connection.msgtype)
-            try:
-                time = msg.header.stamp.sec + (msg.header.stamp.nanosec / 1000000000)
-                button2_list.append(np.array([time, msg.buttons[0]]))
-            except:
-                button2_list.append(np.array([0, 0]))
-
-    np.savez(config['user_input_data'], 
-             button1=np.array(button1_list), 
-             button2=np.array(button2_list), 
-             pose_msg=np.array(pose_msg_list),
-             user_input_traj=utils.se3_to_ndarray(SE3(user_input_traj)),
-             teleop_traj_config=config,)
-    print("File Saved As: ", config['user_input_data']) 
+    if chunk_size is None:
+        pose_msg = pose_buffer.array()
+        user_input_traj = se3_batch.pose_msg_to_traj(pose_msg)
+    else:
+        spill()
+        pose_msg = np.memmap(pose_msg_file, dtype=float, mode='r', shape=(n_spilled, 8)) if n_spilled else np.empty((0, 8))
+        user_input_traj = np.memmap(traj_file, dtype=float, mode='r', shape=(n_spilled, 4, 4)) if n_spilled else np.empty((0, 4, 4))
+
+    return {
+        'button1': button_buffers['button1'].array(),
+        'button2': button_buffers['button2'].array(),
+        'pose_msg': pose_msg,
+        'user_input_traj': user_input_traj,
+    }
+
+@instrumentation.traced_stage
+def extract(config, chunk_size=None):
+    """
+    Extracts the pose and button messages of the rosbag into the artifact store,
+    along with the segment index of the enable button (see rel_pose_computation.segment_index)
+    The result is cached on the rosbag path, size and mtime (see stage_cache.py)
+
+    chunk_size = optional number of pose messages kept in memory (see read_bag)
+    """
+    store = ArtifactStore(config['artifact_store'])
+    cache = stage_cache.from_config(config)
+    with tempfile.TemporaryDirectory(dir=store.path) as spill_dir:
+        outputs = cache.run('extract',
+                            fields={'topics': [POSE_TOPIC] + list(BUTTON_TOPICS)},
+                            inputs={'rosbag': stage_cache.file_fingerprint(config['user_input_rosbag'])},
+                            compute=lambda: read_bag(config['user_input_rosbag'], spill_dir, chunk_size=chunk_size))
+        store.save('extract', **outputs)
+        del outputs     # release the memory maps before the spill files are removed
+    # precompute the enable-button segments and their pose index ranges
+    rpc.segment_index(config, store, recompute=True)
+    print("Artifacts Saved In: ", store.path) 
     
 if __name__ == '__main__':
     config = utils.load_config()
-    extract(config)
+    extract(config, chunk_size=config['extract_chunk_size'])
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Tracking accuracy report of the solver
+
+Compares the desired robot poses (robot_pose_traj) with the forward kinematics of the
+joint trajectory, all the samples in one batch: batched FK, then position distance and
+geodesic rotation angle from the batched SO(3) log (see se3_batch.pose_distance).
+
+* waypoint: the joint state reached at every waypoint vs its desired pose
+* path: every exported joint state vs the desired pose it is aligned to
+    - solver log of fixed_dt: the waypoint tracked at its integration step (tracking lag)
+    - solver log of adaptive_dls / feedforward: one joint state per waypoint
+    - [Resample] control trajectory: the desired poses interpolated at the control time stamps
+* convergence: iterations per waypoint, share of the waypoints within E_P, E_O and the
+  settle time, after which every waypoint stays within E_P, E_O
+
+The report is saved as a compact JSON file (data_saved/<cfg>_accuracy.json, rounded
+values, sorted keys) to diff between solver versions, and the path errors to the
+artifact store. Compare with a previous report:
+    python accuracy_report.py traj1 [--compare data_saved/traj1_accuracy_old.json]
+"""
+
+import os
+import json
+import numpy as np
+import se3_batch
+import ur5_kinematics
+import resample
+import instrumentation
+import pose_traj_sim as sim
+from artifact_store import open_store
+
+PERCENTILES = [50, 90, 95, 99]
+# significant digits of the values in the JSON report
+DIGITS = 6
+
+def error_stats(values, scale=1.0):
+    """
+    Returns the mean, percentiles and max of the errors (N,) times scale as a dict
+    """
+    values = scale * np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {}
+    stats = {'mean': values.mean(), 'max': values.max()}
+    stats.update({f'p{p}': value for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES))})
+    return stats
+
+def aligned_waypoints(solver_mode, n_points, waypoint_iters):
+    """
+    Returns the index (n_points,) of the waypoint each joint state of the solver log is tracking:
+    fixed_dt logs a joint state every LOG_STEPS integration steps, adaptive_dls and feedforward
+    log the joint state reached at every waypoint. The first joint state is the start
+    """
+    if solver_mode == 'fixed_dt':
+        steps = np.r_[0, (np.arange(1, n_points) - 1) * sim.LOG_STEPS]
+        index = np.searchsorted(np.cumsum(waypoint_iters), steps, side='right')
+    else:
+        index = np.r_[0, np.arange(n_points - 1)]
+    return np.minimum(index, len(waypoint_iters) - 1)
+
+def settle_time(time_stamps, within):
+    """
+    Returns the time [s] from the first waypoint after which every waypoint is within the
+    tolerance, None if the last one is not
+    """
+    if len(within) == 0 or not within[-1]:
+        return None
+    outside = np.flatnonzero(~within)
+    first = outside[-1] + 1 if len(outside) else 0
+    return float(time_stamps[first] - time_stamps[0])
+
+def _rounded(value):
+    if isinstance(value, dict):
+        return {key: _rounded(item) for key, item in value.items()}
+    if value is None or isinstance(value, (str, bool, int)):
+        return value
+    return float(f'{float(value):.{DIGITS}g}')
+
+@instrumentation.traced_stage
+def accuracy_report(config):
+    """
+    Returns the tracking accuracy report of the sim stage outputs as a dict, saves it to
+    data_saved/<cfg>_accuracy.json and the path errors to the artifact store
+    """
+    data = open_store(config)
+    robot_traj = np.array(data['robot_pose_traj'])
+    robot_pose_time = np.array(data['robot_pose_time'])
+    waypoint_iters = np.array(data['solver_waypoint_iters'])
+    solver_mode = str(data['solver_mode'])
+    fkine, _ = ur5_kinematics.kinematics_backend('ets' if config['kinematics_backend'] == 'rtb'
+                                                 else config['kinematics_backend'])
+
+    # the joint state reached at every waypoint
+    delta_p, angle = se3_batch.pose_distance(robot_traj, fkine(np.array(data['solver_waypoint_joint_traj'])))
+    within = (delta_p <= sim.E_P) & (angle <= sim.E_O)
+
+    # every exported joint state, aligned to a desired pose
+    if 'robot_control_joint_traj' in data:
+        control_time = np.array(data['robot_control_time'])
+        desired = resample.interpolate_pose_traj(*resample.unique_times(robot_pose_time, robot_traj), control_time)
+        path_joint_traj, path_source = np.array(data['robot_control_joint_traj']), 'control'
+    else:
+        path_joint_traj, path_source = np.array(data['robot_joint_traj']), 'solver_log'
+        desired = robot_traj[aligned_waypoints(solver_mode, len(path_joint_traj), waypoint_iters)]
+    path_delta_p, path_angle = se3_batch.pose_distance(desired, fkine(path_joint_traj))
+
+    report = {
+        'config': config['name'],
+        'solver_mode': solver_mode,
+        'kinematics_backend': config['kinematics_backend'],
+        'n_waypoints': len(robot_traj),
+        'waypoint': {'delta_p_mm': error_stats(delta_p, 1e3), 'angle_deg': error_stats(angle, 180 / np.pi)},
+        'path': {'source': path_source, 'n_points': len(path_joint_traj),
+                 'delta_p_mm': error_stats(path_delta_p, 1e3), 'angle_deg': error_stats(path_angle, 180 / np.pi)},
+        'convergence': {'converged': float(np.mean(within)) if len(within) else None,
+                        'iterations': error_stats(waypoint_iters),
+                        'total_iterations': int(waypoint_iters.sum()),
+                        'settle_time_s': settle_time(robot_pose_time, within)},
+    }
+    report = _rounded(report)
+    data.save('accuracy', accuracy_path_delta_p=path_delta_p, accuracy_path_angle=path_angle)
+    file_path = os.path.join('data_saved', config['name'] + '_accuracy.json')
+    with open(file_path, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print("File Saved As: ", file_path)
+    return report
+
+def flatten(report, prefix=''):
+    """
+    Returns the report as a flat dict with dotted keys, e.g. 'waypoint.delta_p_mm.p99'
+    """
+    flat = {}
+    for key, value in report.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+def print_report(report, previous=None):
+    """
+    Prints the report, next to a previous report and the change of every value if given
+    """
+    flat = flatten(report)
+    old = flatten(previous) if previous is not None else {}
+    for key in sorted(set(flat) | set(old)):
+        value = flat.get(key)
+        line = f'{key:<34}{str(value):>14}'
+        if previous is not None:
+            before = old.get(key)
+            line += f'{str(before):>14}'
+            if isinstance(value, float) and isinstance(before, float):
+                line += f'{value - before:>+14.6g}'
+            elif value != before:
+                line += f'{"changed":>14}'
+        print(line)
+
+
+if __name__ == '__main__':
+    import argparse
+    import teleop_utils as utils
+
+    parser = argparse.ArgumentParser(description='Tracking accuracy of the simulated joint trajectory')
+    parser.add_argument('config', help='config name, e.g. traj1')
+    parser.add_argument('--compare', default=None, help='previous report (JSON) to compare with')
+    args = parser.parse_args()
+
+    config = utils.load_config(args.config)
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    report = accuracy_report(config)
+    print_report(report, previous)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Offscreen animation of the follower robot
+
+Replaces ROBOT.plot(..., backend='pyplot', movie=gif_path), which draws every logged
+joint state through an interactive pyplot window. Here:
+
+* the joint trajectory is decimated to a target frame rate (one joint state per frame)
+* the arm is drawn as a polyline of ur5_kinematics.joint_positions, computed for all
+  the frames at once
+* every worker process draws on its own Agg canvas (no display needed) with artists
+  created once and only updated in place, a chunk of frames at a time. The axes,
+  panes and grid do not change (fixed view), so they are drawn once and every frame
+  only restores them and redraws the moving artists (blitting)
+* the frames are quantized to a shared palette and appended to the GIF as they come
+  back from the workers, only a few chunks are held in memory at any time
+
+Render the animation of a simulated trajectory with:
+    python animation_render.py traj1 [--fps 20] [--workers 4]
+"""
+
+import os
+import numpy as np
+import ur5_kinematics
+
+FPS = 20
+STATE_DT = 0.025            # playback time of one logged joint state without time stamps [s], as ROBOT.plot(dt=0.025)
+CHUNK_FRAMES = 25
+FIGSIZE = (6, 6)
+DPI = 80
+LIMITS = [(-0.8, 0.8), (-0.8, 0.8), (-0.2, 1.0)]
+
+# the renderer of a worker process, created once by _init_worker
+_RENDERER = None
+
+def frame_index(time_stamps, fps=FPS):
+    """
+    Returns the time of every frame at the target fps and the index of the joint state shown
+    in it (the latest state at that time), so long trajectories are decimated and not slowed down
+    """
+    time_stamps = np.asarray(time_stamps, dtype=float)
+    frame_time = np.arange(time_stamps[0], time_stamps[-1] + 1e-9, 1.0 / fps)
+    index = np.clip(np.searchsorted(time_stamps, frame_time, side='right') - 1, 0, len(time_stamps) - 1)
+    return frame_time, index
+
+class FrameRenderer:
+    """
+    Agg canvas with preallocated artists: the arm, the end effector path and the title
+
+    ee_path = (F,3) end effector positions of all the frames, drawn up to the current frame
+    """
+    def __init__(self, ee_path, title='', figsize=FIGSIZE, dpi=DPI, limits=LIMITS):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.ee_path = ee_path
+        self.title = title
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        ax = self.figure.add_subplot(projection='3d')
+        ax.set_xlim(*limits[0])
+        ax.set_ylim(*limits[1])
+        ax.set_zlim(*limits[2])
+        ax.set_xlabel('X')
+        ax.set_ylabel('Y')
+        ax.set_zlabel('Z')
+        (self.path_line,) = ax.plot([], [], [], color='tab:orange', linewidth=1, animated=True)
+        (self.arm_line,) = ax.plot([], [], [], 'o-', color='tab:blue', linewidth=4, markersize=5, animated=True)
+        self.title_text = ax.set_title(title, animated=True)
+        self.ax = ax
+        # static background, the animated artists are left out
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+    def render(self, frame, points, frame_time):
+        """
+        Returns the RGB image (H,W,3) uint8 of one frame, points = (8,3) arm polyline
+        """
+        self.arm_line.set_data_3d(points[:,0], points[:,1], points[:,2])
+        path = self.ee_path[:frame + 1]
+        self.path_line.set_data_3d(path[:,0], path[:,1], path[:,2])
+        self.title_text.set_text(f'{self.title}  t = {frame_time:.2f} s')
+        self.canvas.restore_region(self.background)
+        for artist in (self.path_line, self.arm_line, self.title_text):
+            self.ax.draw_artist(artist)
+        return np.asarray(self.canvas.buffer_rgba())[..., :3].copy()
+
+def _init_worker(ee_path, title):
+    global _RENDERER
+    _RENDERER = FrameRenderer(ee_path, title)
+
+def _render_chunk(start, points, frame_time):
+    return np.stack([_RENDERER.render(start + k, p, t) for k, (p, t) in enumerate(zip(points, frame_time))])
+
+def render_frames(points, frame_time, title='', workers=None, chunk_frames=CHUNK_FRAMES):
+    """
+    Yields the rendered frames (H,W,3) in order, the chunks of chunk_frames frames are drawn
+    in a process pool with at most 2 chunks per worker in flight (bounded memory)
+
+    points = (F,8,3) arm polylines of the frames
+    workers = number of processes, None for one per core, 0 or 1 to render in this process
+    """
+    ee_path = points[:,-1]
+    chunks = [slice(start, start + chunk_frames) for start in range(0, len(points), chunk_frames)]
+    if workers is None:
+        workers = min(os.cpu_count() or 1, len(chunks))
+    if workers <= 1:
+        _init_worker(ee_path, title)
+        for chunk in chunks:
+            yield from _render_chunk(chunk.start, points[chunk], frame_time[chunk])
+        return
+
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(ee_path, title)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_render_chunk, chunk.start, points[chunk], frame_time[chunk]))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def write_gif(gif_path, frames, fps=FPS):
+    """
+    Writes the frames to an endlessly looping GIF one at a time, quantized to the
+    palette of the first frame. Returns the number of frames written
+    """
+    from PIL import Image, GifImagePlugin
+
+    duration = int(round(1000 / fps))
+    palette = None
+    n_frames = 0
+    with open(gif_path, 'wb') as f:
+        for frame in frames:
+            image = Image.fromarray(frame)
+            if palette is None:
+                palette = image.quantize(colors=256)
+                image = palette
+                header, _ = GifImagePlugin.getheader(image, None, {'loop': 0, 'duration': duration})
+                f.writelines(header)
+            else:
+                image = image.quantize(palette=palette)
+            f.writelines(GifImagePlugin.getdata(image, duration=duration, loop=0))
+            n_frames += 1
+        f.write(b';')
+    return n_frames
+
+def render_animation(joint_traj, gif_path, time_stamps=None, fps=FPS, workers=None, title='UR5'):
+    """
+    Renders the joint trajectory (N,6) offscreen to an animated GIF and returns the number of frames
+
+    time_stamps = (N,) times of the joint states, every STATE_DT by default
+    """
+    joint_traj = np.asarray(joint_traj, dtype=float)
+    if time_stamps is None:
+        time_stamps = np.arange(len(joint_traj)) * STATE_DT
+    frame_time, index = frame_index(time_stamps, fps)
+    points = ur5_kinematics.joint_positions(joint_traj[index])
+    n_frames = write_gif(gif_path, render_frames(points, frame_time - frame_time[0], title, workers), fps)
+    print("Animation Saved As: ", gif_path)
+    return n_frames
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    import teleop_utils as utils
+    from artifact_store import open_store
+
+    parser = argparse.ArgumentParser(description='Render the follower robot animation of a simulated trajectory')
+    parser.add_argument('config', help='config name, e.g. traj1')
+    parser.add_argument('--fps', type=float, default=FPS, help='frame rate of the animation')
+    parser.add_argument('--workers', type=int, default=None, help='render processes (default: one per core)')
+    args = parser.parse_args()
+
+    config = utils.load_config(args.config)
+    data = open_store(config)
+    if 'robot_control_joint_traj' in data:
+        joint_traj, time_stamps = data['robot_control_joint_traj'], data['robot_control_time']
+    else:
+        joint_traj, time_stamps = data['robot_joint_traj'], None
+    start = time.perf_counter()
+    n_frames = render_animation(joint_traj, 'data_saved/follower_robot_' + config['name'] + '.gif',
+                                time_stamps=time_stamps, fps=args.fps, workers=args.workers, title=config['name'])
+    print(f'{n_frames} frames rendered in {time.perf_counter() - start:.2f} s')
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+Per-stage artifact store for the teleop pipeline
+
+A store is a directory holding one .npy file per array and a manifest.json that
+records which stage wrote each array. A stage only writes its own outputs and
+reads its inputs memory-mapped, so large trajectories are neither copied into RAM
+nor rewritten on disk by the following stages.
+
+Export a store to the single .npz layout (<cfg>_user_input_data.npz):
+    python artifact_store.py traj1 [--compress]
+"""
+
+import os
+import sys
+import json
+import time
+import numpy as np
+
+MANIFEST = 'manifest.json'
+
+class ArtifactStore:
+    """
+    Directory of .npy arrays with a manifest, indexable like the NpzFile it replaces,
+    e.g. store['pose_msg'] returns a read-only memory map
+    """
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        manifest_path = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'arrays': {}, 'stages': {}}
+
+    def _write_manifest(self):
+        tmp_path = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, os.path.join(self.path, MANIFEST))
+
+    def save(self, stage, **arrays):
+        """
+        Saves the arrays as the outputs of the stage, replacing arrays of the same name
+        Memory-mapped inputs are streamed to disk rather than loaded
+        """
+        for name, value in arrays.items():
+            file_name = name + '.npy'
+            tmp_path = os.path.join(self.path, name + '.tmp.npy')
+            value = np.asanyarray(value)
+            np.save(tmp_path, value, allow_pickle=False)
+            os.replace(tmp_path, os.path.join(self.path, file_name))
+            self.manifest['arrays'][name] = {
+                'stage': stage,
+                'file': file_name,
+                'shape': list(value.shape),
+                'dtype': value.dtype.str,
+            }
+        self.manifest['stages'][stage] = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'outputs': sorted(name for name, entry in self.manifest['arrays'].items() if entry['stage'] == stage),
+        }
+        self._write_manifest()
+
+    def load(self, name, mmap=True):
+        """
+        Returns the array, memory-mapped read-only unless mmap is False
+        """
+        if name not in self.manifest['arrays']:
+            raise KeyError(f'{name} is not in the artifact store {self.path}')
+        file_path = os.path.join(self.path, self.manifest['arrays'][name]['file'])
+        return np.load(file_path, mmap_mode='r' if mmap else None, allow_pickle=False)
+
+    def __getitem__(self, name):
+        return self.load(name)
+
+    def __contains__(self, name):
+        return name in self.manifest['arrays']
+
+    def keys(self):
+        return list(self.manifest['arrays'].keys())
+
+    def stage_outputs(self, stage):
+        return self.manifest['stages'].get(stage, {}).get('outputs', [])
+
+    def export_npz(self, file_path, compress=False):
+        """
+        Writes every array of the store into a single .npz file (the layout before the store)
+        """
+        arrays = {name: self.load(name) for name in self.keys()}
+        (np.savez_compressed if compress else np.savez)(file_path, **arrays)
+
+    @classmethod
+    def from_npz(cls, npz_path, path, stage='import'):
+        """
+        Returns a new store holding the arrays of an existing .npz file
+        """
+        store = cls(path)
+        with np.load(npz_path, allow_pickle=False) as data:
+            arrays = {}
+            for name in data.files:
+                try:
+                    arrays[name] = data[name]
+                except ValueError:
+                    pass    # pickled objects, e.g. teleop_traj_config, are not kept
+        store.save(stage, **arrays)
+        return store
+
+def open_store(config):
+    """
+    Returns the artifact store of the config, importing a legacy
+    <cfg>_user_input_data.npz the first time if there is no store yet
+    """
+    path = config['artifact_store']
+    if not os.path.exists(os.path.join(path, MANIFEST)) and os.path.exists(config['user_input_data']):
+        print("Importing ", config['user_input_data'], " into ", path)
+        return ArtifactStore.from_npz(config['user_input_data'], path)
+    return ArtifactStore(path)
+
+
+if __name__ == '__main__':
+    import teleop_utils as utils
+
+    config = utils.load_config()
+    store = ArtifactStore(config['artifact_store'])
+    store.export_npz(config['user_input_data'], compress='--compress' in sys.argv[2:])
+    print("File Saved As: ", config['user_input_data'])
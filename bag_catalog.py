@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+"""
+Indexed catalog of the haptic rosbags
+
+Scans a collection of 3D Touch bags once, in parallel, and stores an SQLite index
+(data_saved/bag_catalog.sqlite) of:
+
+* bags: size, mtime, time span and number of pose messages
+* topics: message type and count of every topic
+* segments: every enable-button window (press to release) of button1 and button2,
+  with its duration and number of pose messages, as extract would cut them
+  (see rel_pose_computation.anchor_events and time_windows)
+
+Only the time stamps are read: the pose stamps are unpacked from the raw message
+headers, without deserializing the messages. A bag is only scanned again when its
+size or mtime changes, and the bags that no longer exist are removed.
+
+    python bag_catalog.py scan data_saved [more dirs, bags or globs] [--workers 4]
+    python bag_catalog.py query --button button2 --min-duration 5 [--min-poses 500]
+    python bag_catalog.py configs traj1 --button button2 --min-duration 5
+
+configs writes one cfg per matching bag and button under config/, copied from the
+template cfg (traj1) with its user_input_rosbag and enable_button, e.g. for batch_runner.py
+"""
+
+import os
+import glob
+import sqlite3
+import importlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+CATALOG = os.path.join('data_saved', 'bag_catalog.sqlite')
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bags (
+    path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+    start REAL, end REAL, duration REAL, n_poses INTEGER, error TEXT);
+CREATE TABLE IF NOT EXISTS topics (
+    path TEXT, topic TEXT, msgtype TEXT, count INTEGER);
+CREATE TABLE IF NOT EXISTS segments (
+    path TEXT, button TEXT, segment_id INTEGER,
+    press REAL, release REAL, duration REAL, n_poses INTEGER);
+CREATE INDEX IF NOT EXISTS topics_path ON topics (path);
+CREATE INDEX IF NOT EXISTS segments_path ON segments (path);
+CREATE INDEX IF NOT EXISTS segments_query ON segments (button, duration);
+"""
+
+def _extract_module():
+    # the module name starts with a digit, it cannot be imported with an import statement
+    return importlib.import_module('3ds_rosbag_extract')
+
+def header_stamps(reader, connections):
+    """
+    Returns the header time stamps [s] of the messages of the connections, in bag order
+
+    The stamp is unpacked from the raw bytes: seq, sec, nsec at the start of a ROS1 message,
+    sec, nanosec after the 4 byte encapsulation of a little-endian CDR (ROS2) message.
+    The other encodings are deserialized
+    """
+    stamps = bytearray()
+    fallback = []
+    for connection, _, rawdata in reader.messages(connections=connections):
+        if reader.is2 and rawdata[1] != 1:
+            fallback.append(_extract_module()._stamp(reader.deserialize(rawdata, connection.msgtype)))
+        else:
+            stamps += rawdata[4:12]
+    sec_nsec = np.frombuffer(bytes(stamps), dtype='<u4').reshape(-1, 2)
+    return np.r_[sec_nsec[:,0] + sec_nsec[:,1] / 1000000000, fallback]
+
+def scan_bag(path):
+    """
+    Returns the catalog rows of a bag as a dict (runs in a worker process):
+    its time span, topic counts and enable-button segments of every button
+    A bag that cannot be read is returned with its error
+    """
+    from pathlib import Path
+    from rosbags.highlevel import AnyReader
+    import rel_pose_computation as rpc
+
+    extract = _extract_module()
+    stat = os.stat(path)
+    bag = {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'start': None, 'end': None,
+           'duration': None, 'n_poses': 0, 'error': None, 'topics': [], 'segments': []}
+    try:
+        with AnyReader([Path(path)]) as reader:
+            counts = {}
+            for connection in reader.connections:
+                key = (connection.topic, connection.msgtype)
+                counts[key] = counts.get(key, 0) + connection.msgcount
+            bag['topics'] = [(topic, msgtype, count) for (topic, msgtype), count in sorted(counts.items())]
+            bag['start'], bag['end'] = reader.start_time / 1e9, reader.end_time / 1e9
+            bag['duration'] = bag['end'] - bag['start']
+
+            time_stamps = np.sort(header_stamps(reader, [x for x in reader.connections if x.topic == extract.POSE_TOPIC]))
+            bag['n_poses'] = len(time_stamps)
+            # the few button messages are deserialized, as in read_bag
+            buttons = {name: [] for name in extract.BUTTON_TOPICS.values()}
+            connections = [x for x in reader.connections if x.topic in extract.BUTTON_TOPICS]
+            for connection, _, rawdata in reader.messages(connections=connections):
+                msg = reader.deserialize(rawdata, connection.msgtype)
+                try:
+                    buttons[extract.BUTTON_TOPICS[connection.topic]].append((extract._stamp(msg), msg.buttons[0]))
+                except (AttributeError, IndexError):
+                    buttons[extract.BUTTON_TOPICS[connection.topic]].append((0, 0))
+    except Exception as err:
+        bag['error'] = f'{type(err).__name__}: {err}'
+        return bag
+
+    end_time = time_stamps[-1] if len(time_stamps) else None
+    for button, events in buttons.items():
+        anchors = rpc.anchor_events(np.array(events, dtype=float).reshape(-1, 2), end_time=end_time)
+        index = rpc.time_windows(time_stamps, anchors)
+        for segment_id, ((press, release), (start, stop)) in enumerate(zip(anchors, index)):
+            bag['segments'].append((button, segment_id, press, release, release - press, int(stop - start)))
+    return bag
+
+def open_catalog(catalog=CATALOG):
+    """
+    Returns a connection to the catalog database, created if needed
+    """
+    os.makedirs(os.path.dirname(catalog) or '.', exist_ok=True)
+    conn = sqlite3.connect(catalog)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+def find_bags(paths):
+    """
+    Returns the sorted absolute paths of the .bag files of directories (searched recursively),
+    files or glob patterns
+    """
+    bags = set()
+    for path in paths:
+        if os.path.isdir(path):
+            bags.update(glob.glob(os.path.join(path, '**', '*.bag'), recursive=True))
+        else:
+            bags.update(match for match in glob.glob(path) if match.endswith('.bag'))
+    return sorted(os.path.abspath(bag) for bag in bags)
+
+def _delete(conn, path):
+    for table in ('bags', 'topics', 'segments'):
+        conn.execute(f'DELETE FROM {table} WHERE path = ?', (path,))
+
+def update_catalog(paths, catalog=CATALOG, max_workers=None):
+    """
+    Scans the new and changed bags (size or mtime) of paths in a process pool and updates
+    the catalog, the bags that no longer exist are removed
+
+    Returns the number of bags scanned, unchanged and removed
+    """
+    conn = open_catalog(catalog)
+    known = {row['path']: (row['size'], row['mtime_ns']) for row in conn.execute('SELECT path, size, mtime_ns FROM bags')}
+    stale = []
+    for path in find_bags(paths):
+        stat = os.stat(path)
+        if known.get(path) != (stat.st_size, stat.st_mtime_ns):
+            stale.append(path)
+    removed = [path for path in known if not os.path.exists(path)]
+    with conn:
+        for path in removed:
+            _delete(conn, path)
+    scanned = 0
+    if stale:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            for bag in pool.map(scan_bag, stale):
+                # one transaction per bag, an interrupted scan keeps the bags already indexed
+                with conn:
+                    _delete(conn, bag['path'])
+                    conn.execute('INSERT INTO bags VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 [bag[key] for key in ('path', 'size', 'mtime_ns', 'start', 'end', 'duration', 'n_poses', 'error')])
+                    conn.executemany('INSERT INTO topics VALUES (?, ?, ?, ?)',
+                                     [(bag['path'], *topic) for topic in bag['topics']])
+                    conn.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     [(bag['path'], *segment) for segment in bag['segments']])
+                if bag['error'] is not None:
+                    print(f"Could not read {bag['path']}: {bag['error']}")
+                scanned += 1
+    conn.close()
+    return scanned, len(known) - len(removed) - len(set(stale) & set(known)), len(removed)
+
+def query_segments(conn, button=None, min_duration=None, max_duration=None, min_poses=None, bag=None):
+    """
+    Returns the catalog segments matching all the given filters as a list of dicts, longest first:
+    path, button, segment_id, press, release, duration [s], n_poses
+
+    bag = optional substring of the bag path
+    """
+    filters, values = [], []
+    for clause, value in (('button = ?', button), ('duration >= ?', min_duration), ('duration <= ?', max_duration),
+                          ('n_poses >= ?', min_poses), ("path LIKE '%' || ? || '%'", bag)):
+        if value is not None:
+            filters.append(clause)
+            values.append(value)
+    where = ' WHERE ' + ' AND '.join(filters) if filters else ''
+    rows = conn.execute('SELECT * FROM segments' + where + ' ORDER BY duration DESC', values)
+    return [dict(row) for row in rows]
+
+def rosbag_name(path, data_dir='data_saved'):
+    """
+    Returns the user_input_rosbag value of a cfg for a bag path: relative to data_saved, without .bag
+    """
+    return os.path.splitext(os.path.relpath(path, data_dir))[0]
+
+def write_configs(segments, template, config_dir='config'):
+    """
+    Writes one cfg per bag and button of the segments, a copy of the template cfg with
+    the user_input_rosbag and enable_button of the segments. Returns the cfg names
+    """
+    import configparser
+
+    names = []
+    for path, button in dict.fromkeys((segment['path'], segment['button']) for segment in segments):
+        config = configparser.ConfigParser()
+        config.optionxform = str    # keep the case of the keys, e.g. haptic_R_viewer
+        config.read(os.path.join(config_dir, template + '.cfg'))
+        config['General']['user_input_rosbag'] = rosbag_name(path)
+        config['General']['enable_button'] = button
+        name = f"{template}_{rosbag_name(path).replace(os.sep, '_')}_{button}"
+        with open(os.path.join(config_dir, name + '.cfg'), 'w') as f:
+            config.write(f)
+        names.append(name)
+    return names
+
+def print_segments(segments):
+    print(f"{'bag':<40}{'button':>9}{'segment':>9}{'press [s]':>11}{'duration [s]':>14}{'poses':>8}")
+    for segment in segments:
+        print(f"{rosbag_name(segment['path']):<40}{segment['button']:>9}{segment['segment_id']:>9}"
+              f"{segment['press']:>11.2f}{segment['duration']:>14.2f}{segment['n_poses']:>8}")
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Indexed catalog of the haptic rosbags')
+    parser.add_argument('--catalog', default=CATALOG, help='catalog database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    scan = commands.add_parser('scan', help='index the new and changed bags')
+    scan.add_argument('paths', nargs='+', help='directories (searched recursively), bags or globs')
+    scan.add_argument('--workers', type=int, default=None, help='scan processes (default: one per core)')
+    for name in ('query', 'configs'):
+        command = commands.add_parser(name, help='list the matching segments' if name == 'query'
+                                      else 'write a cfg per matching bag and button')
+        if name == 'configs':
+            command.add_argument('template', help='template config name, e.g. traj1')
+        command.add_argument('--button', default=None, help='enable button, e.g. button2')
+        command.add_argument('--min-duration', type=float, default=None, help='shortest segment [s]')
+        command.add_argument('--max-duration', type=float, default=None, help='longest segment [s]')
+        command.add_argument('--min-poses', type=int, default=None, help='fewest pose messages of a segment')
+        command.add_argument('--bag', default=None, help='substring of the bag path')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'scan':
+        scanned, unchanged, removed = update_catalog(args.paths, catalog=args.catalog, max_workers=args.workers)
+        print(f'{scanned} bags scanned, {unchanged} unchanged, {removed} removed in {time.perf_counter() - start:.2f} s')
+        print("Catalog Saved As: ", args.catalog)
+    else:
+        conn = open_catalog(args.catalog)
+        segments = query_segments(conn, button=args.button, min_duration=args.min_duration,
+                                  max_duration=args.max_duration, min_poses=args.min_poses, bag=args.bag)
+        print_segments(segments)
+        print(f'{len(segments)} segments in {1e3 * (time.perf_counter() - start):.1f} ms')
+        if args.command == 'configs':
+            for name in write_configs(segments, args.template):
+                print("Config Saved As: ", os.path.join('config', name + '.cfg'))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+Batched kinematics of any roboticstoolbox manipulator
+
+The elementary transform sequence of the rtb model (robot.ets(), also available for
+the DH models) is compiled once into the constant (4,4) transforms between the
+joints and the joint axes. fkine/jacob0 then evaluate whole joint trajectories (N,n)
+with a few numpy column operations per joint, instead of one rtb call per pose:
+
+* fkine: (N,4,4) end effector poses wrt the robot base frame
+* jacob0: (N,6,n) geometric Jacobians [v; w] wrt the robot base frame
+
+Long trajectories are evaluated chunk_size configurations at a time into the
+preallocated outputs. Check the parity against the rtb model (UR5 by default, or
+any model of rtb.models) with:
+    python batch_kinematics.py [Puma560]
+"""
+
+import functools
+import numpy as np
+
+# Joint configurations per chunk, bounds the memory of the intermediate frames
+CHUNK_SIZE = 4096
+AXES = {'x': 0, 'y': 1, 'z': 2}
+# the two columns (i, j) mixed by a rotation about each axis: col_i' = c col_i + s col_j, col_j' = c col_j - s col_i
+ROTATION_COLUMNS = {0: (1, 2), 1: (2, 0), 2: (0, 1)}
+
+class ETSKinematics:
+    """
+    Batched forward kinematics and Jacobians compiled from the ETS of an rtb model
+
+    robot = roboticstoolbox manipulator (ERobot / Robot or DHRobot), its base and tool included
+    """
+    def __init__(self, robot):
+        from roboticstoolbox import DHRobot
+
+        self.n = robot.n
+        # the ETS of a DH model already holds its base and tool transforms, as rtb the
+        # Jacobians of the other models are expressed in the frame of their base link
+        if isinstance(robot, DHRobot):
+            self.base, tool = None, np.identity(4)
+        else:
+            self.base, tool = np.array(robot.base.A, dtype=float), robot.tool.A
+        # (constant transform before the joint, translation?, axis, joint index, sign) per joint
+        self.joints = []
+        const = np.identity(4)
+        for et in robot.ets():
+            kind = getattr(et, 'kind', None) or et.axis
+            if et.isjoint:
+                self.joints.append((const, kind[0] == 't', AXES[kind[1]], et.jindex, -1.0 if et.isflip else 1.0))
+                const = np.identity(4)
+            else:
+                const = const @ et.A()
+        self.tool = const @ np.array(tool, dtype=float)
+
+    def _evaluate(self, q, jacobian):
+        # poses (N,4,4) and, if jacobian, the Jacobians (N,6,n) of a chunk of configurations
+        pose = np.broadcast_to(np.identity(4), (len(q), 4, 4))
+        origins, axes = [], []
+        for const, prismatic, axis, index, sign in self.joints:
+            pose = pose @ const
+            if jacobian:
+                origins.append(pose[:, :3, 3])
+                axes.append(pose[:, :3, axis])
+            value = sign * q[:, index]
+            if prismatic:
+                pose = pose.copy()
+                pose[:, :3, 3] += value[:, None] * pose[:, :3, axis]
+            else:
+                i, j = ROTATION_COLUMNS[axis]
+                c, s = np.cos(value)[:, None], np.sin(value)[:, None]
+                col_i, col_j = pose[:, :3, i], pose[:, :3, j]
+                pose = pose.copy()
+                pose[:, :3, i], pose[:, :3, j] = c * col_i + s * col_j, c * col_j - s * col_i
+        pose = pose @ self.tool
+        jac = None
+        if jacobian:
+            jac = np.zeros((len(q), 6, self.n))
+            p_ee = pose[:, :3, 3]
+            for (_, prismatic, _, index, sign), origin, axis in zip(self.joints, origins, axes):
+                if prismatic:
+                    jac[:, :3, index] += sign * axis
+                else:
+                    jac[:, :3, index] += sign * np.cross(axis, p_ee - origin)
+                    jac[:, 3:, index] += sign * axis
+        if self.base is not None:
+            pose = self.base @ pose
+        return pose, jac
+
+    def fkine_jacob0(self, q, chunk_size=CHUNK_SIZE):
+        """
+        Returns the end effector poses (N,4,4) and the geometric Jacobians (N,6,n) of the
+        joint configurations (N,n), or a single (4,4) pose and (6,n) Jacobian for a (n,) configuration
+        """
+        return self._batch(q, chunk_size, jacobian=True)
+
+    def fkine(self, q, chunk_size=CHUNK_SIZE):
+        """
+        Returns the end effector poses wrt the robot base frame as a (4,4) or (N,4,4) ndarray
+        """
+        return self._batch(q, chunk_size, jacobian=False)[0]
+
+    def jacob0(self, q, chunk_size=CHUNK_SIZE):
+        """
+        Returns the geometric Jacobians [v; w] wrt the robot base frame as a (6,n) or (N,6,n) ndarray
+        """
+        return self._batch(q, chunk_size, jacobian=True)[1]
+
+    def _batch(self, q, chunk_size, jacobian):
+        q = np.asarray(q, dtype=float)
+        if q.ndim == 1:
+            pose, jac = self._evaluate(q[None], jacobian)
+            return pose[0], (jac[0] if jacobian else None)
+        n_poses = len(q)
+        chunk_size = chunk_size or max(1, n_poses)
+        if n_poses <= chunk_size:
+            return self._evaluate(q, jacobian)
+        poses = np.empty((n_poses, 4, 4))
+        jacs = np.empty((n_poses, 6, self.n)) if jacobian else None
+        for start in range(0, n_poses, chunk_size):
+            chunk = slice(start, start + chunk_size)
+            pose, jac = self._evaluate(q[chunk], jacobian)
+            poses[chunk] = pose
+            if jacobian:
+                jacs[chunk] = jac
+        return poses, jacs
+
+@functools.lru_cache(maxsize=None)
+def default_kinematics():
+    """
+    Returns the batched kinematics of the teleop_utils.get_robot() model, compiled once per process
+    """
+    import teleop_utils
+    return ETSKinematics(teleop_utils.get_robot())
+
+def parity_check(robot, n_samples=200, seed=0):
+    """
+    Returns the max abs FK and Jacobian differences to the rtb model over random configurations
+    """
+    kinematics = ETSKinematics(robot)
+    rng = np.random.default_rng(seed)
+    q_samples = rng.uniform(-np.pi, np.pi, size=(n_samples, robot.n))
+    poses, jacs = kinematics.fkine_jacob0(q_samples, chunk_size=64)
+    fk_err = max(np.abs(robot.fkine(q).A - pose).max() for q, pose in zip(q_samples, poses))
+    jac_err = max(np.abs(robot.jacob0(q) - jac).max() for q, jac in zip(q_samples, jacs))
+    return fk_err, jac_err
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import roboticstoolbox as rtb
+    import teleop_utils
+
+    robot = getattr(rtb.models, sys.argv[1])() if len(sys.argv) > 1 else teleop_utils.get_robot()
+    fk_err, jac_err = parity_check(robot)
+    print(f'{robot.name}: max FK error: {fk_err:.3e}, max Jacobian error: {jac_err:.3e}')
+
+    q_traj = np.random.default_rng(1).uniform(-np.pi, np.pi, size=(10000, robot.n))
+    kinematics = ETSKinematics(robot)
+    start = time.perf_counter()
+    kinematics.fkine_jacob0(q_traj)
+    batched = time.perf_counter() - start
+    start = time.perf_counter()
+    for q in q_traj[:1000]:
+        robot.fkine(q), robot.jacob0(q)
+    per_pose = 10 * (time.perf_counter() - start)
+    print(f'{len(q_traj)} configurations: batched {batched:.3f} s, per pose (rtb) {per_pose:.3f} s')
+    assert fk_err < 1e-9 and jac_err < 1e-9, f'Batched kinematics do not match the rtb model {robot.name}'
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""
+Headless batch driver for the teleop pipeline
+
+Runs extract -> relative pose -> sim -> metrics -> accuracy for many configs in a worker
+pool, without any plot window or input() prompt:
+
+    python batch_runner.py 'config/*.cfg' [traj_xy] [--workers 4] [--stages rel_pose,sim,metrics]
+
+Each config writes its usual outputs under data_saved, the metrics (mu, inv_cond_num, ...)
+go to its artifact store, and the stage printouts to <cfg>_batch.log. A summary table of the stage timings and
+failures is printed and saved as data_saved/batch_summary.csv
+"""
+
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')    # no display needed, set before matplotlib is imported
+
+import argparse
+import contextlib
+import csv
+import glob
+import importlib
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+STAGES = ['extract', 'rel_pose', 'sim', 'metrics', 'accuracy']
+
+def run_stage(stage, config):
+    """
+    Runs a single pipeline stage on the loaded config
+    """
+    if stage == 'extract':
+        importlib.import_module('3ds_rosbag_extract').extract(config, chunk_size=config['extract_chunk_size'])
+    elif stage == 'rel_pose':
+        importlib.import_module('rel_pose_computation').compute_command_traj(config)
+    elif stage == 'sim':
+        importlib.import_module('pose_traj_sim').simulate(config)
+    elif stage == 'metrics':
+        importlib.import_module('performance_metrics').evaluate(config)
+    elif stage == 'accuracy':
+        importlib.import_module('accuracy_report').accuracy_report(config)
+    else:
+        raise ValueError(f'Unknown stage {stage}')
+
+def run_config(config_path, stages=STAGES, force=False, trace=False):
+    """
+    Runs the pipeline stages for one config file (in a worker process)
+    A failed stage stops the config, the following stages are reported as skipped
+    force = True recomputes the stages instead of using the stage cache
+    trace = True records the instrumentation trace of the stages (see instrumentation.py)
+
+    Returns one summary row per stage
+    """
+    import teleop_utils as utils
+
+    name = os.path.splitext(os.path.basename(config_path))[0]
+    rows = []
+    failed = False
+    os.makedirs('data_saved', exist_ok=True)
+    with open(os.path.join('data_saved', name + '_batch.log'), 'w') as log, \
+            contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            config = utils.load_config(name, config_dir=os.path.dirname(config_path) or '.')
+            config['cache_force'] = config['cache_force'] or force
+            config['trace_enabled'] = config['trace_enabled'] or trace
+        except Exception:
+            traceback.print_exc()
+            return [{'config': name, 'stage': 'load_config', 'status': 'failed',
+                     'wall_s': 0.0, 'cpu_s': 0.0, 'error': traceback.format_exc(limit=1).strip().splitlines()[-1]}]
+
+        for stage in stages:
+            row = {'config': name, 'stage': stage, 'status': 'skipped', 'wall_s': 0.0, 'cpu_s': 0.0, 'error': ''}
+            if not failed:
+                wall, cpu = time.perf_counter(), time.process_time()
+                try:
+                    run_stage(stage, config)
+                    row['status'] = 'ok'
+                except Exception as err:
+                    traceback.print_exc()
+                    row['status'] = 'failed'
+                    row['error'] = f'{type(err).__name__}: {err}'
+                    failed = True
+                row['wall_s'] = time.perf_counter() - wall
+                row['cpu_s'] = time.process_time() - cpu
+            rows.append(row)
+    return rows
+
+def config_paths(patterns):
+    """
+    Returns the sorted config files matching the globs/names, e.g. 'config/*.cfg' or 'traj1'
+    """
+    paths = set()
+    for pattern in patterns:
+        if not pattern.endswith('.cfg') and not glob.has_magic(pattern) and not os.path.exists(pattern):
+            pattern = os.path.join('config', pattern + '.cfg')
+        paths.update(glob.glob(pattern))
+    return sorted(paths)
+
+def run_batch(paths, stages=STAGES, max_workers=None, force=False, trace=False):
+    """
+    Returns the summary rows of all configs, run in a process pool
+    """
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for config_rows in pool.map(run_config, paths, [stages] * len(paths), [force] * len(paths), [trace] * len(paths)):
+            rows.extend(config_rows)
+    return rows
+
+def write_summary(rows, file_path):
+    with open(file_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=['config', 'stage', 'status', 'wall_s', 'cpu_s', 'error'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+def print_summary(rows, stages):
+    """
+    Prints one line per config with the wall time of each stage, or its failure status
+    """
+    configs = list(dict.fromkeys(row['config'] for row in rows))
+    print(f"{'config':<24}" + ''.join(f'{stage:>12}' for stage in stages) + f"{'total [s]':>12}")
+    for name in configs:
+        by_stage = {row['stage']: row for row in rows if row['config'] == name}
+        cells = []
+        for stage in stages:
+            row = by_stage.get(stage)
+            if row is None:
+                cells.append('-')
+            elif row['status'] == 'ok':
+                cells.append(f"{row['wall_s']:.2f}")
+            else:
+                cells.append(row['status'])
+        total = sum(row['wall_s'] for row in by_stage.values())
+        print(f'{name:<24}' + ''.join(f'{cell:>12}' for cell in cells) + f'{total:>12.2f}')
+    for row in rows:
+        if row['status'] == 'failed':
+            print(f"[{row['config']}] {row['stage']} failed: {row['error']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the teleop pipeline headless for many configs')
+    parser.add_argument('configs', nargs='+', help="config files, globs or names, e.g. 'config/*.cfg'")
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated subset of ' + ','.join(STAGES))
+    parser.add_argument('--summary', default=os.path.join('data_saved', 'batch_summary.csv'))
+    parser.add_argument('--force', action='store_true', help='recompute every stage instead of using the stage cache')
+    parser.add_argument('--trace', action='store_true', help='record the instrumentation trace (data_saved/<cfg>_trace.jsonl)')
+    args = parser.parse_args()
+
+    stages = [stage for stage in args.stages.split(',') if stage]
+    paths = config_paths(args.configs)
+    if not paths:
+        parser.error(f'No config file matches {args.configs}')
+
+    rows = run_batch(paths, stages=stages, max_workers=args.workers, force=args.force, trace=args.trace)
+    os.makedirs(os.path.dirname(args.summary) or '.', exist_ok=True)
+    write_summary(rows, args.summary)
+    print_summary(rows, stages)
+    print("Summary Saved As: ", args.summary)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+"""
+Benchmark suite of the teleop pipeline stages
+
+Generates a synthetic 3D Touch-style session (pose messages and enable-button
+stream of configurable length, rate and time stamp jitter), writes it to a
+synthetic rosbag with rosbags, and times extract, rel_pose_traj,
+get_desired_poses and resolved_rate_joint_traj on it. Each stage records its
+wall and CPU time (best of --repeat runs), its throughput (poses/s or IK steps/s)
+and its peak memory (tracemalloc, in a separate run so the timings are not skewed).
+The startup time of the CLI modules (a fresh interpreter importing each of them)
+is recorded as the startup:<module> stages.
+
+    python benchmark.py [--config traj1] [--duration 20] [--rate 1000] [--jitter 0.0002]
+    python benchmark.py --save-baseline          # store the results as the baseline
+    python benchmark.py --threshold 0.2          # fail if a stage is 20% slower than the baseline
+
+The results are compared against the baseline JSON (data_saved/benchmark_baseline.json),
+the script exits with status 1 when a stage regresses past the threshold.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import platform
+import resource
+import subprocess
+import tempfile
+import tracemalloc
+import numpy as np
+from pathlib import Path
+
+BASELINE = os.path.join('data_saved', 'benchmark_baseline.json')
+STARTUP_MODULES = ['3ds_rosbag_extract', 'rel_pose_computation', 'pose_traj_sim', 'performance_metrics',
+                   'multi_segment', 'streaming_teleop', 'batch_runner']
+
+def synthetic_session(duration=20.0, rate=1000.0, jitter=0.0, n_segments=3, seed=0, start_time=100.0):
+    """
+    Returns a synthetic haptic session with the layout of the extracted data
+    (button1, button2, pose_msg, user_input_traj)
+
+    The stylus tip follows smooth Lissajous-like motions of a few cm with small sensor noise,
+    and its orientation slowly sways around the holding pose. The enable button (button2) is
+    pressed n_segments times, each press covering most of its share of the session
+
+    duration = length of the session [s]
+    rate = pose message rate [Hz]
+    jitter = standard deviation of the pose time stamps around the nominal period [s]
+    """
+    rng = np.random.default_rng(seed)
+    n_poses = max(2, int(duration * rate))
+    period = np.full(n_poses, 1.0 / rate)
+    if jitter > 0:
+        period = np.clip(period + jitter * rng.standard_normal(n_poses), 0.1 / rate, None)
+    t = np.cumsum(period) - period[0]
+
+    position = np.stack([0.04 * np.sin(2 * np.pi * 0.25 * t),
+                         0.03 * np.sin(2 * np.pi * 0.15 * t + 0.5),
+                         0.02 * np.sin(2 * np.pi * 0.1 * t)], axis=1)
+    position += 1e-5 * rng.standard_normal(position.shape)
+    rotvec = np.stack([0.2 * np.sin(2 * np.pi * 0.1 * t),
+                       0.15 * np.sin(2 * np.pi * 0.07 * t),
+                       0.1 * np.sin(2 * np.pi * 0.05 * t)], axis=1)
+    from scipy.spatial.transform import Rotation as R
+    quat = R.from_rotvec(rotvec).as_quat()
+    pose_msg = np.column_stack([t + start_time, position, quat])
+
+    # press/release windows, separated by short clutching gaps
+    bounds = np.linspace(0, t[-1], n_segments + 1)
+    press = bounds[:-1] + 0.05 * (bounds[1] - bounds[0])
+    release = bounds[1:] - 0.05 * (bounds[1] - bounds[0])
+    button2 = np.column_stack([np.ravel(np.column_stack([press, release])) + start_time,
+                               np.tile([1.0, 0.0], n_segments)])
+    button1 = np.array([[start_time, 0.0]])
+
+    se3_batch = importlib.import_module('se3_batch')
+    return {
+        'button1': button1,
+        'button2': button2,
+        'pose_msg': pose_msg,
+        'user_input_traj': se3_batch.pose_msg_to_traj(pose_msg),
+    }
+
+def write_bag(bag_path, session):
+    """
+    Writes the session as a ROS1 bag with the topics read by 3ds_rosbag_extract.py
+    """
+    from rosbags.rosbag1 import Writer
+    from rosbags.typesys import Stores, get_typestore
+
+    extract = importlib.import_module('3ds_rosbag_extract')
+    typestore = get_typestore(Stores.ROS1_NOETIC)
+    PoseStamped = typestore.types['geometry_msgs/msg/PoseStamped']
+    Joy = typestore.types['sensor_msgs/msg/Joy']
+    Header = typestore.types['std_msgs/msg/Header']
+    Time = typestore.types['builtin_interfaces/msg/Time']
+    Pose = typestore.types['geometry_msgs/msg/Pose']
+    Point = typestore.types['geometry_msgs/msg/Point']
+    Quaternion = typestore.types['geometry_msgs/msg/Quaternion']
+
+    def header(seq, stamp):
+        sec = int(stamp)
+        return Header(seq=seq, stamp=Time(sec=sec, nanosec=int(round((stamp - sec) * 1e9))), frame_id='')
+
+    # merge the pose and button messages chronologically
+    topics = {name: topic for topic, name in extract.BUTTON_TOPICS.items()}
+    events = [(stamp, 1, extract.POSE_TOPIC, i) for i, stamp in enumerate(session['pose_msg'][:,0])]
+    for name, topic in topics.items():
+        events += [(stamp, 0, topic, i) for i, stamp in enumerate(session[name][:,0])]
+    events.sort()
+
+    Path(bag_path).unlink(missing_ok=True)
+    with Writer(Path(bag_path)) as writer:
+        connections = {extract.POSE_TOPIC: writer.add_connection(extract.POSE_TOPIC, PoseStamped.__msgtype__, typestore=typestore)}
+        for topic in topics.values():
+            connections[topic] = writer.add_connection(topic, Joy.__msgtype__, typestore=typestore)
+        for stamp, _, topic, i in events:
+            if topic == extract.POSE_TOPIC:
+                row = session['pose_msg'][i]
+                msg = PoseStamped(header=header(i, stamp),
+                                  pose=Pose(position=Point(x=row[1], y=row[2], z=row[3]),
+                                            orientation=Quaternion(x=row[4], y=row[5], z=row[6], w=row[7])))
+                data = typestore.serialize_ros1(msg, PoseStamped.__msgtype__)
+            else:
+                value = int(session[extract.BUTTON_TOPICS[topic]][i,1])
+                msg = Joy(header=header(i, stamp), axes=np.array([], dtype=np.float32),
+                          buttons=np.array([value], dtype=np.int32))
+                data = typestore.serialize_ros1(msg, Joy.__msgtype__)
+            writer.write(connections[topic], int(stamp * 1e9), data)
+
+def measure(func, repeat=3):
+    """
+    Returns the result of func() and its best wall time, CPU time [s] and peak memory [MB]
+    The peak memory is measured in an extra tracemalloc run
+    """
+    wall, cpu = np.inf, np.inf
+    for _ in range(repeat):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = func()
+        wall = min(wall, time.perf_counter() - wall_start)
+        cpu = min(cpu, time.process_time() - cpu_start)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, wall, cpu, peak / 1024**2
+
+def measure_startup(module, repeat=3):
+    """
+    Returns the best wall and CPU time [s] of a fresh interpreter importing module (the startup of its CLI)
+    """
+    command = [sys.executable, '-c', f'import importlib; importlib.import_module({module!r})']
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    wall, cpu = np.inf, np.inf
+    for _ in range(repeat):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, check=True)
+        wall = min(wall, time.perf_counter() - start)
+        child = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = min(cpu, child.ru_utime + child.ru_stime - usage.ru_utime - usage.ru_stime)
+    return wall, cpu
+
+def run_startup_benchmarks(modules=STARTUP_MODULES, repeat=3):
+    """
+    Returns the startup results of the CLI modules, in the layout of run_benchmarks
+    (the memory of the child interpreters is not measured)
+    """
+    results = {}
+    for module in modules:
+        wall, cpu = measure_startup(module, repeat)
+        results['startup:' + module] = {'wall_s': wall, 'cpu_s': cpu, 'peak_mb': 0.0, 'items': 1,
+                                        'throughput': 1 / wall, 'unit': 'imports/s'}
+    return results
+
+def run_benchmarks(config, session, ik_waypoints=200, repeat=3, chunk_size=None):
+    """
+    Returns the benchmark results of every stage on the synthetic session:
+    {stage: {wall_s, cpu_s, peak_mb, items, throughput, unit}}
+    """
+    extract = importlib.import_module('3ds_rosbag_extract')
+    rpc = importlib.import_module('rel_pose_computation')
+    sim = importlib.import_module('pose_traj_sim')
+    results = {}
+
+    def record(stage, func, items, unit):
+        result, wall, cpu, peak = measure(func, repeat)
+        n_items = items(result) if callable(items) else items
+        results[stage] = {'wall_s': wall, 'cpu_s': cpu, 'peak_mb': peak, 'items': int(n_items),
+                          'throughput': n_items / wall if wall > 0 else np.inf, 'unit': unit}
+        return result
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bag_path = os.path.join(tmp_dir, 'synthetic.bag')
+        write_bag(bag_path, session)
+
+        def read():
+            with tempfile.TemporaryDirectory(dir=tmp_dir) as spill_dir:
+                data = extract.read_bag(bag_path, spill_dir, chunk_size=chunk_size)
+                return len(data['pose_msg'])
+        record('extract', read, len(session['pose_msg']), 'poses/s')
+
+    # first enable-button segment of the session
+    anchors = rpc.anchor_events(session['button2'])
+    index = rpc.time_windows(session['pose_msg'][:,0], anchors)[0]
+    (abs_traj, _) = rpc.filter_poses_by_time(session['pose_msg'][:,0], anchors[0], session['user_input_traj'], window=index)
+    frame = config['command_reference_frame']
+    rel_traj = record('rel_pose_traj', lambda: rpc.rel_pose_traj(abs_traj, command_reference_frame=frame),
+                      len(abs_traj), 'poses/s')
+
+    q_home = config['follower_robot_home']
+    fkine, _ = sim.ur5_kinematics.kinematics_backend(config['kinematics_backend'])
+    home_pose = fkine(q_home)
+    robot_traj = record('get_desired_poses',
+                        lambda: sim.se3_batch.desired_poses(rel_traj, home_pose, abs_traj, config['scaling_factor'],
+                                                            config['haptic_R_viewer'], config['viewer_R_robotbase'],
+                                                            command_reference_frame=frame),
+                        len(rel_traj), 'poses/s')
+
+    def solve():
+        report = {}
+        sim.resolved_rate_joint_traj(robot_traj[:ik_waypoints], q_home,
+                                     kinematics=config['kinematics_backend'], report=report)
+        return report['waypoint_iters'].sum()
+    record('resolved_rate_joint_traj', solve, lambda steps: steps, 'IK steps/s')
+    return results
+
+def compare(results, baseline, threshold=0.2, memory_threshold=0.5):
+    """
+    Returns the regressions of the results against the baseline, as messages:
+    a stage regresses when its wall time grows by more than threshold (fraction)
+    or its peak memory by more than memory_threshold
+    """
+    regressions = []
+    for stage, result in results.items():
+        base = baseline.get('stages', {}).get(stage)
+        if base is None:
+            continue
+        if result['wall_s'] > base['wall_s'] * (1 + threshold):
+            regressions.append(f"{stage}: wall time {result['wall_s']:.4f} s vs baseline {base['wall_s']:.4f} s "
+                               f"({100 * (result['wall_s'] / base['wall_s'] - 1):+.0f}%)")
+        if result['peak_mb'] > base['peak_mb'] * (1 + memory_threshold):
+            regressions.append(f"{stage}: peak memory {result['peak_mb']:.1f} MB vs baseline {base['peak_mb']:.1f} MB")
+    return regressions
+
+def print_results(results, baseline=None):
+    print(f"{'stage':<32}{'wall [s]':>10}{'cpu [s]':>10}{'peak [MB]':>11}{'throughput':>16}  {'vs baseline':>12}")
+    for stage, result in results.items():
+        base = (baseline or {}).get('stages', {}).get(stage)
+        change = f"{100 * (result['wall_s'] / base['wall_s'] - 1):+.0f}%" if base else '-'
+        print(f"{stage:<32}{result['wall_s']:>10.4f}{result['cpu_s']:>10.4f}{result['peak_mb']:>11.1f}"
+              f"{result['throughput']:>16.1f}  {change:>12}  {result['unit']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the teleop pipeline stages on a synthetic session')
+    parser.add_argument('--config', default='traj1', help='config providing the frames, robot home and kinematics backend')
+    parser.add_argument('--duration', type=float, default=20.0, help='length of the synthetic session [s]')
+    parser.add_argument('--rate', type=float, default=1000.0, help='pose message rate [Hz]')
+    parser.add_argument('--jitter', type=float, default=0.0002, help='std of the pose time stamps [s]')
+    parser.add_argument('--ik-waypoints', type=int, default=200, help='waypoints solved by resolved_rate_joint_traj')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-startup', action='store_true', help='skip the startup time of the CLI modules')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline JSON file')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed wall time regression (fraction)')
+    parser.add_argument('--memory-threshold', type=float, default=0.5, help='allowed peak memory regression (fraction)')
+    args = parser.parse_args()
+
+    utils = importlib.import_module('teleop_utils')
+    config = utils.load_config(args.config)
+    params = {key: getattr(args, key) for key in ('duration', 'rate', 'jitter', 'ik_waypoints', 'seed')}
+    params['kinematics_backend'] = config['kinematics_backend']
+    session = synthetic_session(args.duration, args.rate, args.jitter, seed=args.seed)
+    results = run_benchmarks(config, session, ik_waypoints=args.ik_waypoints, repeat=args.repeat)
+    if not args.no_startup:
+        results.update(run_startup_benchmarks(repeat=args.repeat))
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print(f"Baseline {args.baseline} was run with {baseline.get('params')}, not compared")
+            baseline = None
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'params': params, 'machine': platform.node(), 'python': platform.python_version(),
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': results}, f, indent=1)
+        print("File Saved As: ", args.baseline)
+    elif baseline is not None:
+        regressions = compare(results, baseline, args.threshold, args.memory_threshold)
+        for message in regressions:
+            print('REGRESSION ' + message)
+        if regressions:
+            sys.exit(1)
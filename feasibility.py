@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""
+Feasibility check of a joint trajectory before it is handed to the UR5
+
+The exported joint trajectory (N,n) and its time stamps (N,) are checked as whole
+arrays, without a loop over the samples:
+
+* position: joint positions within the joint limits of the rtb model (robot.qlim)
+* velocity: finite-difference joint velocities of the segments within the UR5 limits
+* acceleration: finite-difference joint accelerations within the acceleration limits
+* workspace: end effector within the reach of the robot and above the floor
+* singularity: inverse condition number of the Jacobian above a threshold
+
+Every check reports the offending samples as ranges of indices [first, last].
+A repeated time stamp with a joint motion is an infinite velocity.
+Check the joint trajectory saved in the artifact store with:
+    python feasibility.py traj1
+"""
+
+import numpy as np
+import ur5_kinematics
+
+# UR5 joint velocity limits [rad/s] (180 deg/s on every joint)
+QD_MAX = np.radians([180, 180, 180, 180, 180, 180])
+# joint acceleration limits [rad/s^2], not in the rtb model
+QDD_MAX = np.radians([800, 800, 800, 800, 800, 800])
+# min inverse condition number of the Jacobian, reach [m] of the UR5 from the base origin
+INV_COND_MIN, REACH = 0.01, 0.85
+CHECKS = ['position', 'velocity', 'acceleration', 'workspace', 'singularity']
+# Joint configurations per batched Jacobian, bounds the memory of long trajectories
+CHUNK_SIZE = 16384
+
+def joint_limits():
+    """
+    Returns the (2,n) lower and upper joint position limits [rad] of the rtb model
+    """
+    import teleop_utils
+    return np.asarray(teleop_utils.get_robot().qlim, dtype=float)
+
+def finite_differences(joint_traj, time_stamps):
+    """
+    Returns the joint velocities (N-1,n) of the segments between the samples and the
+    joint accelerations (N-2,n) at the inner samples, by finite differences in time
+    """
+    joint_traj = np.asarray(joint_traj, dtype=float)
+    dt = np.diff(np.asarray(time_stamps, dtype=float))[:,None]
+    dq = np.diff(joint_traj, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # a motion without a time increment is an infinite velocity, no motion is a zero velocity
+        qd = np.where(dt > 0, dq / dt, np.where(dq == 0, 0.0, np.inf * np.sign(dq)))
+        dt_mid = (dt[1:] + dt[:-1]) / 2
+        qdd = np.where(dt_mid > 0, np.diff(qd, axis=0) / dt_mid, np.where(np.diff(qd, axis=0) == 0, 0.0, np.inf))
+    return qd, np.nan_to_num(qdd, nan=np.inf, posinf=np.inf, neginf=-np.inf)
+
+def index_ranges(mask):
+    """
+    Returns the (M,2) first and last indices of the runs of True in the boolean mask (N,)
+    """
+    edges = np.diff(np.r_[0, np.asarray(mask, dtype=np.int8), 0])
+    return np.column_stack([np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1])
+
+def positive_definite(G, shift):
+    """
+    Returns the (N,) mask of the symmetric matrices G - shift I that are positive definite,
+    G = (m,m,N) batch of symmetric matrices with the batch on the last axis and shift = (N,)
+    The Cholesky factorization runs over the m(m+1)/2 entries, each one an (N,) vector operation
+    """
+    m = len(G)
+    L = np.empty_like(G)
+    ok = np.ones(G.shape[-1], dtype=bool)
+    for j in range(m):
+        d = G[j, j] - shift - (L[j, :j] ** 2).sum(axis=0)
+        ok &= d > 0
+        L[j, j] = np.sqrt(np.where(ok, d, 1.0))
+        for i in range(j + 1, m):
+            L[i, j] = (G[i, j] - (L[i, :j] * L[j, :j]).sum(axis=0)) / L[j, j]
+    return ok
+
+def singular_samples(J, inv_cond_min, power_iters=3):
+    """
+    Returns the mask (N,) of the Jacobians (N,6,n) with an inverse condition number below
+    inv_cond_min, and the inverse condition numbers of the samples that are not certified above it
+    (NaN for the certified ones)
+
+    The test sigma_min / sigma_max < c is lambda_min(G) < c^2 lambda_max(G) for the Gram matrix G.
+    With bounds lo <= lambda_max(G) <= hi (Rayleigh quotient after a few power iterations,
+    trace and max row sum), G - c^2 hi I positive definite certifies the sample and
+    G - c^2 lo I not positive definite flags it. Only the samples in between go to the eigensolver
+    """
+    # batch on the last axis, every entry of the small matrices is a contiguous (N,) vector
+    J = np.ascontiguousarray(np.moveaxis(J, 0, -1))
+    if J.shape[1] > J.shape[0]:
+        J = np.swapaxes(J, 0, 1)
+    m = J.shape[1]
+    G = np.empty((m, m, J.shape[-1]))
+    for i in range(m):
+        for j in range(i, m):
+            G[i, j] = G[j, i] = (J[:, i] * J[:, j]).sum(axis=0)
+    hi = np.minimum(sum(G[i, i] for i in range(m)), np.abs(G).sum(axis=1).max(axis=0))
+    v = G[:, 0].copy()
+    for _ in range(power_iters):
+        v = (G * v[None]).sum(axis=1)
+        v /= np.sqrt((v ** 2).sum(axis=0)) + 1e-300
+    lo = (v * (G * v[None]).sum(axis=1)).sum(axis=0)
+    threshold = inv_cond_min ** 2
+    certified = positive_definite(G, threshold * hi)
+    flagged = ~positive_definite(G, threshold * lo)
+    inv_cond = np.full(G.shape[-1], np.nan)
+    exact = np.flatnonzero(~certified)
+    if len(exact):
+        eig = np.clip(np.linalg.eigvalsh(np.moveaxis(G[..., exact], -1, 0)), 0.0, None)
+        inv_cond[exact] = np.sqrt(eig[:, 0] / eig[:, -1])
+        flagged[exact] = inv_cond[exact] < inv_cond_min
+    return flagged, inv_cond
+
+def check_joint_traj(joint_traj, time_stamps, kinematics='rtb', qlim=None, qd_max=QD_MAX, qdd_max=QDD_MAX,
+                     inv_cond_min=INV_COND_MIN, reach=REACH, z_min=None):
+    """
+    Returns the feasibility report of the joint trajectory (N,n) with time stamps (N,) as a dict:
+
+    feasible = True if no sample violates any check
+    <check>_mask = (N,) samples violating the check, a velocity is flagged at the sample ending
+                   its segment and an acceleration at its inner sample
+    <check>_ranges = (M,2) first and last indices of the runs of offending samples
+    <check>_worst = max excess [rad] over the joint limits (position), worst ratio of the value
+                    to its limit (velocity, acceleration), max distance [m] from the base origin
+                    (workspace) or min inverse condition number of the samples not certified
+                    above the threshold (singularity, None if all are)
+
+    qlim = (2,n) joint position limits [rad], the limits of the rtb model by default
+    z_min = lowest height [m] of the end effector in the robot base frame, None for no floor
+    """
+    joint_traj = np.asarray(joint_traj, dtype=float).reshape(len(joint_traj), -1)
+    n_points = len(joint_traj)
+    qlim = joint_limits() if qlim is None else np.asarray(qlim, dtype=float)
+    fkine, jacob0 = ur5_kinematics.kinematics_backend('ets' if kinematics == 'rtb' else kinematics)
+    masks = {check: np.zeros(n_points, dtype=bool) for check in CHECKS}
+    report = {}
+
+    masks['position'] = ((joint_traj < qlim[0]) | (joint_traj > qlim[1])).any(axis=1)
+    outside = np.maximum(qlim[0] - joint_traj, joint_traj - qlim[1]).max(axis=1) if n_points else np.zeros(0)
+    report['position_worst'] = float(outside.max(initial=0.0))
+
+    qd, qdd = finite_differences(joint_traj, time_stamps)
+    qd_ratio = (np.abs(qd) / qd_max).max(axis=1, initial=0.0)
+    qdd_ratio = (np.abs(qdd) / qdd_max).max(axis=1, initial=0.0)
+    masks['velocity'][1:] = qd_ratio > 1
+    masks['acceleration'][1:-1] = qdd_ratio > 1
+    report['velocity_worst'] = float(qd_ratio.max(initial=0.0))
+    report['acceleration_worst'] = float(qdd_ratio.max(initial=0.0))
+
+    if n_points:
+        position = fkine(joint_traj)[:, :3, 3]
+        distance = np.linalg.norm(position, axis=1)
+        masks['workspace'] = distance > reach
+        if z_min is not None:
+            masks['workspace'] |= position[:, 2] < z_min
+        inv_cond = np.full(n_points, np.nan)
+        for start in range(0, n_points, CHUNK_SIZE):
+            chunk = slice(start, start + CHUNK_SIZE)
+            masks['singularity'][chunk], inv_cond[chunk] = singular_samples(jacob0(joint_traj[chunk]), inv_cond_min)
+        report['workspace_worst'] = float(distance.max())
+        report['singularity_worst'] = None if np.isnan(inv_cond).all() else float(np.nanmin(inv_cond))
+    else:
+        report['workspace_worst'] = report['singularity_worst'] = None
+
+    for check in CHECKS:
+        report[check + '_mask'] = masks[check]
+        report[check + '_ranges'] = index_ranges(masks[check])
+    report['feasible'] = not any(mask.any() for mask in masks.values())
+    return report
+
+def check_config(config, joint_traj, time_stamps):
+    """
+    Returns the feasibility report of the joint trajectory with the limits of the [Feasibility] section of the cfg
+    """
+    return check_joint_traj(joint_traj, time_stamps, kinematics=config['kinematics_backend'],
+                            qd_max=config['feasibility_qd_max'], qdd_max=config['feasibility_qdd_max'],
+                            inv_cond_min=config['feasibility_inv_cond_min'], reach=config['feasibility_reach'],
+                            z_min=config['feasibility_z_min'])
+
+def summary(report, max_ranges=5):
+    """
+    Returns the feasibility report as printable lines, with the first max_ranges offending ranges of each check
+    """
+    if report['feasible']:
+        return ['Feasibility: OK (' + ', '.join(CHECKS) + ')']
+    lines = ['Feasibility: FAILED']
+    worst = {'position': 'max excess {:.4f} rad', 'velocity': 'max {:.3g} x limit',
+             'acceleration': 'max {:.3g} x limit', 'workspace': 'max reach {:.3f} m',
+             'singularity': 'min inv cond {:.4f}'}
+    for check in CHECKS:
+        ranges = report[check + '_ranges']
+        if len(ranges):
+            shown = ', '.join(f'{first}-{last}' if last > first else f'{first}' for first, last in ranges[:max_ranges])
+            more = f' (+{len(ranges) - max_ranges} more)' if len(ranges) > max_ranges else ''
+            lines.append(f"  {check}: {np.count_nonzero(report[check + '_mask'])} samples, "
+                         f"{worst[check].format(report[check + '_worst'])}, at samples {shown}{more}")
+    return lines
+
+def require_feasible(report, file_name):
+    """
+    Raises a ValueError if the feasibility report has a violation, so that file_name is not exported
+    """
+    if not report['feasible']:
+        raise ValueError(f'Joint trajectory not exported to {file_name}: ' + '; '.join(
+            line.strip() for line in summary(report)[1:]))
+
+
+if __name__ == '__main__':
+    import time
+    import teleop_utils as utils
+    from artifact_store import open_store
+
+    config = utils.load_config()
+    data = open_store(config)
+    if 'robot_control_joint_traj' in data:
+        joint_traj, time_stamps = data['robot_control_joint_traj'], data['robot_control_time']
+    else:
+        import pose_traj_sim as sim
+        joint_traj = data['robot_joint_traj']
+        time_stamps = sim.joint_traj_time(config['solver_mode'], len(joint_traj), data['robot_pose_time'])
+    start = time.perf_counter()
+    report = check_config(config, joint_traj, time_stamps)
+    elapsed = time.perf_counter() - start
+    print('\n'.join(summary(report)))
+    print(f'{len(joint_traj)} samples checked in {1e3 * elapsed:.1f} ms')
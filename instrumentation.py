@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+"""
+Opt-in instrumentation of the teleop pipeline
+
+Enabled with [Trace] enabled = True in the cfg (or --trace in batch_runner.py).
+While a trace is active:
+
+* every pipeline function decorated with @traced records its wall and CPU time
+* the resolved rate solvers record, per waypoint, the inner iterations, the final
+  position/orientation errors, the Jacobian condition number and the wall time
+* the kinematics calls (fkine, jacob0, robust_inv, Rotation.from_matrix) are timed
+
+The records are appended as JSON lines to data_saved/<cfg>_trace.jsonl and a short
+summary is printed when the trace stops. Print the summary of a trace file again with:
+    python instrumentation.py data_saved/traj1_trace.jsonl
+"""
+
+import sys
+import json
+import time
+import functools
+import contextlib
+import numpy as np
+
+# the active trace, None when the instrumentation is off
+TRACE = None
+HOT_SPOTS = 5
+
+class Trace:
+    """
+    Collects the records of a run and appends them to a JSON lines file
+    """
+    def __init__(self, file_path, label=''):
+        self.file_path = file_path
+        self.label = label
+        self.records = []
+        self.timers = {}
+        self.start = time.perf_counter()
+
+    def record(self, kind, **fields):
+        fields = {key: (value.item() if isinstance(value, np.generic) else value) for key, value in fields.items()}
+        self.records.append({'type': kind, **fields})
+
+    def add_time(self, name, seconds):
+        calls, total = self.timers.get(name, (0, 0.0))
+        self.timers[name] = (calls + 1, total + seconds)
+
+    def write(self):
+        with open(self.file_path, 'a') as f:
+            f.write(json.dumps({'type': 'run', 'label': self.label, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                'wall_s': time.perf_counter() - self.start}) + '\n')
+            for record in self.records:
+                f.write(json.dumps(record) + '\n')
+            for name, (calls, total) in self.timers.items():
+                f.write(json.dumps({'type': 'timer', 'name': name, 'calls': calls, 'total_s': total}) + '\n')
+
+def start(file_path, label=''):
+    """
+    Starts a trace appended to file_path
+    """
+    global TRACE
+    TRACE = Trace(file_path, label)
+    return TRACE
+
+def stop():
+    """
+    Writes the active trace, prints its summary and turns the instrumentation off
+    """
+    global TRACE
+    trace, TRACE = TRACE, None
+    if trace is None:
+        return
+    trace.write()
+    print_summary(trace.records, trace.timers)
+    print("Trace Saved As: ", trace.file_path)
+
+def active():
+    return TRACE is not None
+
+def traced(func):
+    """
+    Decorator recording the wall and CPU time of a pipeline function while a trace is active
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if TRACE is None:
+            return func(*args, **kwargs)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if TRACE is not None:
+                TRACE.record('stage', name=func.__qualname__, module=func.__module__,
+                             wall_s=time.perf_counter() - wall, cpu_s=time.process_time() - cpu)
+    return wrapper
+
+def traced_stage(func):
+    """
+    Decorator of the pipeline entry points taking the config as first argument:
+    starts the trace of the config when [Trace] is enabled, then as @traced
+    """
+    timed_func = traced(func)
+
+    @functools.wraps(func)
+    def wrapper(config, *args, **kwargs):
+        if TRACE is not None or not config.get('trace_enabled'):
+            return timed_func(config, *args, **kwargs)
+        start(config['trace_file'], label=f"{config['name']}:{func.__qualname__}")
+        try:
+            return timed_func(config, *args, **kwargs)
+        finally:
+            stop()
+    return wrapper
+
+def timed(name, func):
+    """
+    Returns func wrapped to accumulate its time under name while a trace is active,
+    or func itself when the instrumentation is off (no overhead in the solver loops)
+    """
+    if TRACE is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if TRACE is not None:
+                TRACE.add_time(name, time.perf_counter() - start_time)
+    return wrapper
+
+@contextlib.contextmanager
+def _timer(name):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if TRACE is not None:
+            TRACE.add_time(name, time.perf_counter() - start_time)
+
+_NO_TIMER = contextlib.nullcontext()
+
+def timer(name):
+    """
+    Returns a context manager accumulating the time of its block under name while a trace is active
+    """
+    return _NO_TIMER if TRACE is None else _timer(name)
+
+def record(kind, **fields):
+    """
+    Adds a record to the active trace, if any
+    """
+    if TRACE is not None:
+        TRACE.record(kind, **fields)
+
+def read_trace(file_path):
+    """
+    Returns the records and the summed timers of a trace file
+    """
+    records, timers = [], {}
+    with open(file_path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['type'] == 'timer':
+                calls, total = timers.get(entry['name'], (0, 0.0))
+                timers[entry['name']] = (calls + entry['calls'], total + entry['total_s'])
+            else:
+                records.append(entry)
+    return records, timers
+
+def print_summary(records, timers):
+    """
+    Prints the stage times, the kinematics call times and the solver hot spots of a trace
+    """
+    stages = [r for r in records if r['type'] == 'stage']
+    if stages:
+        print(f"{'stage':<40}{'wall [s]':>10}{'cpu [s]':>10}")
+        for r in stages:
+            print(f"{r['module'] + '.' + r['name']:<40}{r['wall_s']:>10.3f}{r['cpu_s']:>10.3f}")
+    if timers:
+        print(f"{'call':<40}{'calls':>10}{'total [s]':>10}{'mean [us]':>11}")
+        for name, (calls, total) in sorted(timers.items(), key=lambda item: -item[1][1]):
+            print(f"{name:<40}{calls:>10}{total:>10.3f}{1e6 * total / max(calls, 1):>11.1f}")
+    waypoints = [r for r in records if r['type'] == 'waypoint']
+    if waypoints:
+        iters = np.array([r['iters'] for r in waypoints])
+        cond = np.array([r['cond'] for r in waypoints])
+        converged = np.array([r['converged'] for r in waypoints])
+        print(f"Waypoints: {len(waypoints)}, iterations mean {iters.mean():.1f} / max {iters.max()}, "
+              f"{np.count_nonzero(~converged)} not converged, Jacobian condition number "
+              f"median {np.median(cond):.1f} / max {cond.max():.1f}")
+        print(f'Hot spots (slowest {HOT_SPOTS} waypoints):')
+        for r in sorted(waypoints, key=lambda r: -r['wall_s'])[:HOT_SPOTS]:
+            print(f"  [{r['solver']}] waypoint {r['index']}: {r['iters']} iterations, {1e3 * r['wall_s']:.1f} ms, "
+                  f"delta_p {r['delta_p']:.2e} m, angle {r['angle']:.2e} rad, cond {r['cond']:.1f}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: python instrumentation.py <trace.jsonl>')
+    print_summary(*read_trace(sys.argv[1]))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import teleop_utils as utils
+import se3_batch
+import ur5_kinematics
+import rel_pose_computation as rpc
+import pose_traj_sim as sim
+from artifact_store import open_store
+import instrumentation
+import pose_filter
+
+@instrumentation.traced
+def segment_tasks(config, data):
+    """
+    Returns one task per enable-button anchor (press/release window) of the session
+
+    Each task holds the filtered absolute poses, the relative time and the relative
+    and desired robot poses of the segment, so the workers only run the IK.
+    A window with fewer than 2 pose samples (e.g. a bounce of the button) is skipped,
+    its segment_id is left out of the tasks
+    """
+    pose_msg = data['pose_msg']
+    user_input_traj = data['user_input_traj']
+    haptic_R_viewer = se3_batch.as_matrix(config['haptic_R_viewer'])
+    viewer_R_robotbase = se3_batch.as_matrix(config['viewer_R_robotbase'])
+    q_home = config['follower_robot_home']
+    home_pose = ur5_kinematics.kinematics_backend(config['kinematics_backend'])[0](q_home)
+
+    (anchors, index) = rpc.segment_index(config, data)
+    tasks = []
+    for segment_id, (time_range, window) in enumerate(zip(anchors, index)):
+        if window[1] - window[0] < 2:
+            print(f"Segment {segment_id} skipped: {window[1] - window[0]} pose samples in "
+                  f"t = [{time_range[0]:.3f}, {time_range[1]:.3f}]")
+            continue
+        (abs_traj, rel_time) = rpc.filter_poses_by_time(
+            time_stamps=pose_msg[:,0], time_range=time_range, user_input_traj=user_input_traj, window=window)
+        abs_traj = pose_filter.smooth_config(config, abs_traj, rel_time)
+        rel_traj = rpc.rel_pose_traj(abs_traj, command_reference_frame=config['command_reference_frame'])
+        start_pose = home_pose
+        if config['segment_start'] == 'chained' and tasks:
+            # clutching: the desired poses continue from the last desired pose of the previous
+            # segment (not the pose the follower reached), so the segments are solved independently
+            start_pose = tasks[-1]['robot_pose_traj'][-1]
+        robot_traj = se3_batch.desired_poses(rel_traj, start_pose, abs_traj,
+                                             config['scaling_factor'], haptic_R_viewer, viewer_R_robotbase,
+                                             command_reference_frame=config['command_reference_frame'])
+        tasks.append({
+            'segment_id': segment_id,
+            'time_range': np.array(time_range),
+            'command_abs_traj': abs_traj,
+            'command_rel_traj': rel_traj,
+            'command_time': rel_time,
+            'robot_pose_traj': robot_traj,
+            'start_pose': start_pose,
+        })
+    return tasks
+
+def solve_segment(task, q_home, solver_mode='fixed_dt', kinematics='rtb', waypoint_tolerance=None, max_iters=None):
+    """
+    Returns the joint trajectory results of one segment task (runs in a worker process)
+    """
+    robot_traj = task['robot_pose_traj']
+    if waypoint_tolerance is None:
+        robot_pose_index = np.arange(len(robot_traj))
+    else:
+        robot_pose_index = sim.decimate_waypoints(robot_traj, *waypoint_tolerance, time_stamps=task['command_time'])
+    solver_kwargs = {} if max_iters is None else {'max_iters': max_iters}
+
+    # a chained segment does not start at home, reach its start pose first
+    # (a timed solver has no time to follow there, the adaptive one converges instead)
+    q_start = q_home
+    if not np.allclose(task['start_pose'], ur5_kinematics.kinematics_backend(kinematics)[0](q_home)):
+        reach_mode = 'adaptive_dls' if sim.SOLVER_ATTRIBUTES[solver_mode]['follows_time'] else solver_mode
+        # the converged joint state, fixed_dt only logs every LOG_STEPS integration steps
+        reach_report = {}
+        sim.SOLVERS[reach_mode](task['start_pose'], q_home, kinematics=kinematics, report=reach_report, **solver_kwargs)
+        q_start = reach_report['waypoint_joint_traj'][-1]
+
+    if sim.SOLVER_ATTRIBUTES[solver_mode]['time_stamps']:
+        solver_kwargs['time_stamps'] = task['command_time'][robot_pose_index]
+    solver_report = {}
+    joint_traj, twist_traj = sim.SOLVERS[solver_mode](robot_traj[robot_pose_index], q_start,
+                                                      kinematics=kinematics, report=solver_report, **solver_kwargs)
+    return {
+        'segment_id': task['segment_id'],
+        'robot_pose_index': robot_pose_index,
+        'robot_joint_traj': joint_traj,
+        'robot_twist_traj': twist_traj,
+        'solver_waypoint_iters': solver_report['waypoint_iters'],
+        'solver_waypoint_converged': solver_report['waypoint_converged'],
+    }
+
+@instrumentation.traced_stage
+def process_all_segments(config, data, max_workers=None):
+    """
+    Returns the per-segment tasks and solver results for every anchor of the session
+    The segments are solved in a process pool, longest first so the pool drains evenly
+    """
+    tasks = segment_tasks(config, data)
+    order = sorted(range(len(tasks)), key=lambda k: -len(tasks[k]['robot_pose_traj']))
+    results = [None] * len(tasks)
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        futures = {k: pool.submit(solve_segment, tasks[k], config['follower_robot_home'],
+                                  solver_mode=config['solver_mode'],
+                                  kinematics=config['kinematics_backend'],
+                                  waypoint_tolerance=config['waypoint_tolerance'],
+                                  max_iters=config['solver_max_iters'])
+                   for k in order}
+        for k, future in futures.items():
+            results[k] = future.result()
+    return tasks, results
+
+@instrumentation.traced
+def save_segments(file_path, tasks, results):
+    """
+    Saves the per-segment store as a single .npz file
+
+    segment_id, segment_time_range (K,2) and segment_n_poses (K,) index the store,
+    the arrays of segment k are saved under 'seg<k>_<name>'
+    """
+    store = {
+        'segment_id': np.array([task['segment_id'] for task in tasks], dtype=int),
+        'segment_time_range': np.array([task['time_range'] for task in tasks]).reshape(-1, 2),
+        'segment_n_poses': np.array([len(task['command_time']) for task in tasks], dtype=int),
+    }
+    for task, result in zip(tasks, results):
+        prefix = f"seg{task['segment_id']}_"
+        for key in ('command_abs_traj', 'command_rel_traj', 'command_time', 'robot_pose_traj'):
+            store[prefix + key] = task[key]
+        for key, value in result.items():
+            if key != 'segment_id':
+                store[prefix + key] = value
+    np.savez(file_path, **store)
+
+
+if __name__ == '__main__':
+    config = utils.load_config()
+    data = open_store(config)
+
+    tasks, results = process_all_segments(config, data)
+    save_segments(config['segment_data'], tasks, results)
+
+    for task, result in zip(tasks, results):
+        print(f"Segment {task['segment_id']}: t = [{task['time_range'][0]:.3f}, {task['time_range'][1]:.3f}], "
+              f"{len(task['command_time'])} poses, {result['solver_waypoint_iters'].sum()} solver iterations, "
+              f"{np.count_nonzero(~result['solver_waypoint_converged'])} waypoints not converged")
+    print("File Saved As: ", config['segment_data'])
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""
+Parameter sweep of the operator mapping
+
+Evaluates a grid of mapping parameters on one recorded session without rerunning
+extraction and relative pose computation:
+
+    scaling_factor x haptic_R_viewer x viewer_R_robotbase x command_reference_frame x joint_states_home
+
+The values tried are listed in the optional [Sweep] section of the cfg (the cfg value
+alone by default). The session (command_abs_traj) is loaded once from the artifact
+store and the relative trajectory is computed once per command_reference_frame. Every
+grid point then gets its desired poses in one batch, its IK (the [Solver] of the cfg,
+with MAX_ITERS iterations per waypoint unless max_iters is set) and its metrics in a
+worker process:
+
+* reachability = share of the desired positions within reach of the robot
+* convergence = share of the waypoints reached by the solver within E_P, E_O
+* max tracking error, min inverse condition number and min manipulability of the joint trajectory
+
+The grid points are ranked by convergence, reachability and min inverse condition number:
+    python parameter_sweep.py traj1 [--workers 4] [--top 10]
+
+The ranked table is printed and saved as data_saved/<cfg>_sweep.csv
+"""
+
+import os
+import csv
+import time
+import itertools
+import numpy as np
+import teleop_utils as utils
+import se3_batch
+import ur5_kinematics
+import pose_traj_sim as sim
+import performance_metrics
+import instrumentation
+from artifact_store import open_store
+from concurrent.futures import ProcessPoolExecutor
+
+# random configurations sampled to estimate the reach of the robot
+REACH_SAMPLES = 20000
+PARAMETERS = ['scaling_factor', 'haptic_R_viewer', 'viewer_R_robotbase', 'command_reference_frame', 'follower_robot_home']
+COLUMNS = ['rank', 'point', 'scaling_factor', 'haptic_R_viewer', 'viewer_R_robotbase', 'command_reference_frame',
+           'joint_states_home', 'reachability', 'convergence', 'max_delta_p', 'max_angle', 'min_inv_cond_num',
+           'min_mu', 'iterations', 'wall_s']
+
+# the session shared by the tasks of a worker process, set once by _init_worker
+_SESSION = None
+
+def reach_radius(fkine, n_joints, n_samples=REACH_SAMPLES, seed=0):
+    """
+    Returns the max distance [m] of the end effector from the robot base origin
+    over random joint configurations, with the forward kinematics evaluated in one batch
+    """
+    q_samples = np.random.default_rng(seed).uniform(-np.pi, np.pi, size=(n_samples, n_joints))
+    return float(np.linalg.norm(fkine(q_samples)[:, :3, 3], axis=1).max())
+
+def sweep_points(grid):
+    """
+    Returns the list of grid points, one dict of mapping parameters per combination of the values
+    """
+    return [dict(zip(PARAMETERS, values)) for values in itertools.product(*(grid[key] for key in PARAMETERS))]
+
+def _init_worker(session):
+    global _SESSION
+    _SESSION = session
+
+def evaluate_point(point):
+    """
+    Returns the metrics of one grid point (runs in a worker process):
+    desired poses, waypoint decimation, IK and Jacobian metrics
+    """
+    session = _SESSION
+    start = time.perf_counter()
+    kinematics = session['kinematics_backend']
+    fkine, _ = ur5_kinematics.kinematics_backend('ets' if kinematics == 'rtb' else kinematics)
+    q_home = point['follower_robot_home']
+    robot_traj = se3_batch.desired_poses(session['command_rel_traj'][point['command_reference_frame']],
+                                         fkine(q_home), session['command_abs_traj'], point['scaling_factor'],
+                                         point['haptic_R_viewer'], point['viewer_R_robotbase'],
+                                         command_reference_frame=point['command_reference_frame'])
+    reachable = np.linalg.norm(robot_traj[:, :3, 3], axis=1) <= session['reach']
+
+    if session['waypoint_tolerance'] is None:
+        robot_pose_index = np.arange(len(robot_traj))
+    else:
+        robot_pose_index = sim.decimate_waypoints(robot_traj, *session['waypoint_tolerance'],
+                                                  time_stamps=session['command_time'])
+    # a grid point may ask for unreachable poses, so the solver always gets an iteration budget
+    solver_kwargs = {'max_iters': session['solver_max_iters'] or sim.MAX_ITERS}
+    if sim.SOLVER_ATTRIBUTES[session['solver_mode']]['time_stamps']:
+        solver_kwargs['time_stamps'] = session['command_time'][robot_pose_index]
+    report = {}
+    joint_traj, _ = sim.SOLVERS[session['solver_mode']](robot_traj[robot_pose_index], q_home,
+                                                        kinematics=kinematics, report=report, **solver_kwargs)
+    delta_p, angle = sim.tracking_errors(robot_traj[robot_pose_index], report['waypoint_joint_traj'], kinematics)
+    metrics = performance_metrics.batch_metrics(joint_traj, kinematics=kinematics)
+    return {
+        'reachability': float(np.mean(reachable)),
+        'convergence': float(np.mean(report['waypoint_converged'])),
+        'max_delta_p': float(delta_p.max()),
+        'max_angle': float(angle.max()),
+        'min_inv_cond_num': float(metrics['inv_cond_num'].min()),
+        'min_mu': float(metrics['mu'].min()),
+        'iterations': int(report['waypoint_iters'].sum()),
+        'wall_s': time.perf_counter() - start,
+    }
+
+def _label(value, values):
+    # index of a rotation among the values tried, e.g. R1
+    return 'R' + str(next(k for k, other in enumerate(values) if np.array_equal(other, value)))
+
+def rank(points, results, grid):
+    """
+    Returns the table rows of the grid points, best first: highest convergence,
+    then reachability, then min inverse condition number
+    """
+    rows = []
+    for k, (point, result) in enumerate(zip(points, results)):
+        rows.append({
+            'point': k,
+            'scaling_factor': point['scaling_factor'],
+            'haptic_R_viewer': _label(point['haptic_R_viewer'], grid['haptic_R_viewer']),
+            'viewer_R_robotbase': _label(point['viewer_R_robotbase'], grid['viewer_R_robotbase']),
+            'command_reference_frame': point['command_reference_frame'],
+            'joint_states_home': str(np.round(np.degrees(point['follower_robot_home']), 1).tolist()),
+            **result,
+        })
+    rows.sort(key=lambda row: (-row['convergence'], -row['reachability'], -row['min_inv_cond_num']))
+    for k, row in enumerate(rows):
+        row['rank'] = k + 1
+    return rows
+
+@instrumentation.traced_stage
+def run_sweep(config, max_workers=None):
+    """
+    Returns the ranked table rows of the [Sweep] grid evaluated on the session of the config
+    """
+    data = open_store(config)
+    grid = config['sweep_grid']
+    abs_traj = np.array(data['command_abs_traj'])
+    kinematics = config['kinematics_backend']
+    fkine, _ = ur5_kinematics.kinematics_backend('ets' if kinematics == 'rtb' else kinematics)
+    session = {
+        'command_abs_traj': abs_traj,
+        'command_time': np.array(data['command_time']),
+        # the relative trajectory only depends on the reference frame
+        'command_rel_traj': {frame: se3_batch.rel_pose_traj(abs_traj, command_reference_frame=frame)
+                             for frame in grid['command_reference_frame']},
+        'reach': reach_radius(fkine, len(config['follower_robot_home'])),
+        'kinematics_backend': kinematics,
+        'solver_mode': config['solver_mode'],
+        'solver_max_iters': config['solver_max_iters'],
+        'waypoint_tolerance': config['waypoint_tolerance'],
+    }
+    points = sweep_points(grid)
+    print(f"Sweeping {len(points)} mapping parameter sets on {len(abs_traj)} poses, solver [{config['solver_mode']}]")
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(session,)) as pool:
+        results = list(pool.map(evaluate_point, points))
+    return rank(points, results, grid)
+
+def write_table(rows, file_path):
+    with open(file_path, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def print_table(rows, grid, top=None):
+    """
+    Prints the ranked grid points and the rotations behind the R<k> labels
+    """
+    print(f"{'rank':>4}{'sf':>7}{'hRv':>5}{'vRb':>5}  {'reference frame':<21}{'home [deg]':<42}"
+          f"{'reach':>7}{'conv':>7}{'dp [mm]':>9}{'min kappa':>11}{'min mu':>9}{'iters':>8}")
+    for row in rows[:top]:
+        print(f"{row['rank']:>4}{row['scaling_factor']:>7.3g}{row['haptic_R_viewer']:>5}{row['viewer_R_robotbase']:>5}  "
+              f"{row['command_reference_frame']:<21}{row['joint_states_home']:<42}"
+              f"{row['reachability']:>7.1%}{row['convergence']:>7.1%}{1e3 * row['max_delta_p']:>9.3f}"
+              f"{row['min_inv_cond_num']:>11.4f}{row['min_mu']:>9.4f}{row['iterations']:>8}")
+    for key in ('haptic_R_viewer', 'viewer_R_robotbase'):
+        for k, rotation in enumerate(grid[key]):
+            print(f'{key} R{k} = {rotation[:3,:3].round(3).tolist()}')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Rank a grid of operator mapping parameters on a recorded session')
+    parser.add_argument('config', help='config name, e.g. traj1')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per core)')
+    parser.add_argument('--top', type=int, default=None, help='print only the best grid points')
+    args = parser.parse_args()
+
+    config = utils.load_config(args.config)
+    rows = run_sweep(config, max_workers=args.workers)
+    file_path = os.path.join('data_saved', config['name'] + '_sweep.csv')
+    write_table(rows, file_path)
+    print_table(rows, config['sweep_grid'], top=args.top)
+    print("File Saved As: ", file_path)
@@ -2,41 +2,89 @@
 
 import numpy as np
 import teleop_utils as utils
-import roboticstoolbox as rtb
-import matplotlib.pyplot as plt
-import ipdb
+import ur5_kinematics
+from artifact_store import open_store
+import stage_cache
+import instrumentation
 
-# LOAD THE ROBOT MODEL
-ROBOT = rtb.models.UR5()
+# Joint configurations per batched SVD, bounds the memory of long trajectories
+CHUNK_SIZE = 4096
 
-def get_metrics(joint_poses):
+def jacobians(joint_poses, kinematics='rtb'):
     """
-    Returns the manipulability measure
+    Returns the geometric Jacobians wrt the robot base frame of the joint poses as an (N,6,6) ndarray
+    kinematics = 'rtb' or 'ets' for the roboticstoolbox model, evaluated in batches from its ETS
+                 (see batch_kinematics.py), or 'ur5' for the closed-form kernel
     """
-    mu = []
-    inv_cond_num = []
-
-    for pose in joint_poses:
-        # Do SVD
-        _, S, _ = np.linalg.svd(ROBOT.jacob0(pose), True)
-        
-        # Get Manipulability Measure
-        mu.append(np.prod(S))
-
-        # Get Inverse Condition Number
-        inv_cond_num.append(np.min(S)/np.max(S))
-
-    return mu, inv_cond_num
+    joint_poses = np.asarray(joint_poses, dtype=float).reshape(-1, 6)
+    if kinematics == 'rtb':
+        kinematics = 'ets'
+    _, jacob0 = ur5_kinematics.kinematics_backend(kinematics)
+    return jacob0(joint_poses)
+
+def _singular_value_metrics(S):
+    # Yoshikawa manipulability and inverse condition number, S sorted in descending order
+    return np.prod(S, axis=-1), S[..., -1] / S[..., 0]
+
+@instrumentation.traced
+def batch_metrics(joint_poses, robot_twist=None, kinematics='rtb', chunk_size=CHUNK_SIZE):
+    """
+    Returns the Jacobian-based performance metrics along a joint trajectory as a dict of arrays,
+    computed with one batched SVD per chunk of chunk_size poses
+
+    mu, inv_cond_num = manipulability measure and inverse condition number of the Jacobian
+    mu_v, inv_cond_num_v = same for the translational block J[:3,:]
+    mu_w, inv_cond_num_w = same for the rotational block J[3:,:]
+    singular_values = (N,6) singular values of the Jacobian, in descending order
+
+    With robot_twist (N,6), the twists are also projected on the principal axes of the
+    manipulability ellipsoid (see manip_ell):
+    twist_tilda = (N,6) U^T twist
+    twist_effort = norm of the joint velocity needed for the twist, |S^-1 U^T twist|
+    """
+    joint_poses = np.asarray(joint_poses, dtype=float).reshape(-1, 6)
+    n_poses = len(joint_poses)
+    names = ['mu', 'inv_cond_num', 'mu_v', 'inv_cond_num_v', 'mu_w', 'inv_cond_num_w']
+    metrics = {name: np.empty(n_poses) for name in names}
+    metrics['singular_values'] = np.empty((n_poses, 6))
+    if robot_twist is not None:
+        robot_twist = np.asarray(robot_twist, dtype=float).reshape(-1, 6)
+        metrics['twist_tilda'] = np.empty((n_poses, 6))
+        metrics['twist_effort'] = np.empty(n_poses)
+
+    for start in range(0, n_poses, chunk_size or max(1, n_poses)):
+        chunk = slice(start, start + (chunk_size or n_poses))
+        J = jacobians(joint_poses[chunk], kinematics=kinematics)
+        if robot_twist is None:
+            S = np.linalg.svd(J, compute_uv=False)
+        else:
+            U, S, _ = np.linalg.svd(J)
+            twist_tilda = np.einsum('nji,nj->ni', U, robot_twist[chunk])
+            metrics['twist_tilda'][chunk] = twist_tilda
+            metrics['twist_effort'][chunk] = np.linalg.norm(twist_tilda / S, axis=1)
+        metrics['singular_values'][chunk] = S
+        metrics['mu'][chunk], metrics['inv_cond_num'][chunk] = _singular_value_metrics(S)
+        metrics['mu_v'][chunk], metrics['inv_cond_num_v'][chunk] = _singular_value_metrics(
+            np.linalg.svd(J[:, :3, :], compute_uv=False))
+        metrics['mu_w'][chunk], metrics['inv_cond_num_w'][chunk] = _singular_value_metrics(
+            np.linalg.svd(J[:, 3:, :], compute_uv=False))
+    return metrics
+
+def get_metrics(joint_poses, kinematics='rtb'):
+    """
+    Returns the manipulability measure and the inverse condition number (see batch_metrics)
+    kinematics = 'rtb', 'ets' or 'ur5' (see jacobians)
+    """
+    metrics = batch_metrics(joint_poses, kinematics=kinematics)
+    return metrics['mu'], metrics['inv_cond_num']
 
-def manip_ell(joint_poses, robot_twist):
+def manip_ell(joint_poses, robot_twist, kinematics='rtb'):
     """
     WORK IN PROGRESS
     This function aims to plot the manipulability ellipsoids of the robot end effector
     """
-    for pose, twist in zip(joint_poses, robot_twist):
-        # Do SVD
-        U, S, Vh = np.linalg.svd(ROBOT.jacob0(pose), True)
-        twist_tilda = U.T @ twist
+    import matplotlib.pyplot as plt
+    twist_tilda = batch_metrics(joint_poses, robot_twist=robot_twist, kinematics=kinematics)['twist_tilda']
 
     # Define ellipsoid parameters for multiple ellipsoids
     centers = np.array([[1, 2, 3], [-2, 0, 1], [0, -2, 2]])  # Center coordinates for each ellipsoid
@@ -72,14 +120,33 @@ def manip_ell(joint_poses, robot_twist):
     # Show the plot
     plt.show()
 
+@instrumentation.traced_stage
+def evaluate(config):
+    """
+    Returns the performance metrics (see batch_metrics) along the joint and twist
+    trajectories saved in the artifact store, and saves them to the store
+    The result is cached on the kinematics backend and the trajectories (see stage_cache.py)
+    """
+    data = open_store(config)
+    robot_joint_traj = data['robot_joint_traj']
+    robot_twist_traj = data['robot_twist_traj']
 
-if __name__ == '__main__':
-    config = utils.load_config()
-    data = np.load(config['user_input_data'])
+    metrics = stage_cache.from_config(config).run('get_metrics',
+        fields={'kinematics_backend': config['kinematics_backend']},
+        inputs={'robot_joint_traj': robot_joint_traj, 'robot_twist_traj': robot_twist_traj},
+        compute=lambda: batch_metrics(robot_joint_traj, robot_twist=robot_twist_traj,
+                                      kinematics=config['kinematics_backend']))
+    data.save('metrics', **metrics)
+    print("Artifacts Saved In: ", data.path)
+    return metrics
 
-    robot_joint_traj, robot_twist_traj = data['robot_joint_traj'], data['robot_twist_traj']
 
-    mu, inv_cond_num = get_metrics(robot_joint_traj)
+if __name__ == '__main__':
+    import traj_plot
+
+    config = utils.load_config()
+    metrics = evaluate(config)
 
-    # utils.parametrized_plot(mu, "$\mu$", "Manipulability Measure $\mu$")
-    utils.parametrized_plot(inv_cond_num, "$\kappa$", "Inverse Condition Number $\kappa$")
+    # utils.parametrized_plot(metrics['mu'], "$\mu$", "Manipulability Measure $\mu$", traj_plot.plot_file_path(config, 'mu'))
+    utils.parametrized_plot(metrics['inv_cond_num'], "$\kappa$", "Inverse Condition Number $\kappa$",
+                            traj_plot.plot_file_path(config, 'inv_cond_num'))
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+"""
+Low-pass smoothing of the haptic input poses
+
+The raw /arm/measured_cp samples of the 3D Touch carry a high frequency jitter that
+the resolved rate solvers pay for with extra iterations and that the follower
+reproduces. The poses of a segment are filtered as one (N,7) signal array:
+
+* positions x, y, z
+* unit quaternions [x, y, z, w] made continuous (no sign flip between samples),
+  renormalized after filtering, a first-order approximation of the geodesic
+  filter that holds for the small rotations between samples
+
+Offline (between filter_poses_by_time and rel_pose_traj), the filter is zero-phase:
+a Butterworth low-pass run forward and backward (filtfilt), or a Savitzky-Golay
+filter with the window matching the cutoff. CausalPoseFilter runs the forward
+Butterworth filter one sample at a time for streaming_teleop.py, with the same
+output as smooth_pose_traj(causal=True) on the whole segment.
+
+The filter is set by the optional [Filter] section of the cfg. Compare the solver
+iterations on the raw and filtered commands with:
+    python pose_filter.py traj1
+"""
+
+import numpy as np
+import se3_batch
+
+METHODS = ['butter', 'savgol']
+
+def sample_rate(time_stamps):
+    """
+    Returns the sample rate [Hz] of the time stamps, from their median time increment
+    """
+    dt = np.diff(np.asarray(time_stamps, dtype=float))
+    dt = dt[dt > 0]
+    return 1.0 / np.median(dt) if len(dt) else None
+
+def pose_signals(pose_traj):
+    """
+    Returns the (N,7) [x, y, z, qx, qy, qz, qw] signals of the poses (N,4,4), the sign
+    of every quaternion chosen to be continuous with the previous one
+    """
+    pose_traj = se3_batch.as_traj(pose_traj)
+    quat = se3_batch.rotm_to_quat(pose_traj[:,:3,:3])
+    # q and -q are the same rotation: flip the samples on the far side of their predecessor
+    flips = np.cumprod(np.r_[1.0, np.where(np.einsum('ij,ij->i', quat[1:], quat[:-1]) < 0, -1.0, 1.0)])
+    return np.column_stack([pose_traj[:,:3,3], flips[:,None] * quat])
+
+def signals_to_poses(signals):
+    """
+    Returns the poses (N,4,4) of (N,7) [x, y, z, qx, qy, qz, qw] signals, the quaternions normalized
+    """
+    pose = se3_batch.from_rotation(se3_batch.quat_to_rotm(signals[:,3:]))
+    pose[:,:3,3] = signals[:,:3]
+    return pose
+
+def savgol_window(rate, cutoff, polyorder):
+    """
+    Returns the odd Savitzky-Golay window length [samples] with a -3 dB cutoff near cutoff [Hz]:
+    f_c / f_nyquist ~ (N + 1) / (3.2 M - 4.6) for a window 2M + 1 and an even polynomial order N
+    (Schafer, What is a Savitzky-Golay filter?, 2011)
+    """
+    n_even = polyorder // 2 * 2
+    half = int(np.ceil(((n_even + 1) / (cutoff / (rate / 2)) + 4.6) / 3.2))
+    return 2 * half + 1
+
+def lowpass(signals, rate, cutoff, method='butter', order=2, causal=False):
+    """
+    Returns the low-pass filtered signals (N,k) sampled at rate [Hz], unchanged if the cutoff [Hz]
+    is at or above the Nyquist frequency or the segment is too short for the filter
+
+    method = 'butter' (Butterworth of the given order) or 'savgol' (polynomial order)
+    causal = True for the forward Butterworth filter only, started at rest on the first sample
+             (the online variant), False for the zero-phase filter
+    """
+    from scipy.signal import butter, filtfilt, lfilter, lfilter_zi, savgol_filter
+
+    signals = np.asarray(signals, dtype=float)
+    n_samples = len(signals)
+    if cutoff is None or rate is None or cutoff >= rate / 2 or n_samples < 2:
+        return signals
+    if method == 'butter':
+        b, a = butter(order, cutoff / (rate / 2))
+        if causal:
+            return lfilter(b, a, signals, axis=0, zi=lfilter_zi(b, a)[:,None] * signals[0])[0]
+        # odd extension over 3 periods of the cutoff, so the start-up transients settle before the segment
+        return filtfilt(b, a, signals, axis=0, padlen=min(int(3 * rate / cutoff), n_samples - 1))
+    if method == 'savgol':
+        if causal:
+            raise ValueError('The savgol filter has no causal variant, use butter')
+        window = min(savgol_window(rate, cutoff, order), n_samples - (1 - n_samples % 2))
+        if window <= order:
+            return signals
+        return savgol_filter(signals, window, order, axis=0)
+    raise ValueError(f'Unknown filter method {method}')
+
+def smooth_pose_traj(pose_traj, time_stamps, cutoff, method='butter', order=2, causal=False, rate=None):
+    """
+    Returns the poses (N,4,4) low-pass filtered at the cutoff [Hz], positions and quaternions
+    filtered together in one vectorized pass over the segment (see lowpass)
+
+    rate = sample rate [Hz], estimated from the time stamps (N,) by default
+    """
+    rate = sample_rate(time_stamps) if rate is None else rate
+    return signals_to_poses(lowpass(pose_signals(pose_traj), rate, cutoff, method=method, order=order, causal=causal))
+
+def smooth_config(config, pose_traj, time_stamps):
+    """
+    Returns the poses filtered as set by the [Filter] section of the cfg, unchanged without a cutoff
+    """
+    if config['filter_cutoff'] is None:
+        return pose_traj
+    return smooth_pose_traj(pose_traj, time_stamps, config['filter_cutoff'], method=config['filter_method'],
+                            order=config['filter_order'], rate=config['filter_rate'])
+
+def jitter(pose_traj):
+    """
+    Returns the RMS of the second differences of the positions [m] and of the rotation
+    vectors [rad] between consecutive poses, a measure of the sample to sample jitter
+    """
+    pose_traj = se3_batch.as_traj(pose_traj)
+    if len(pose_traj) < 3:
+        return 0.0, 0.0
+    rotvec = se3_batch.so3_log(np.swapaxes(pose_traj[:-1,:3,:3], -1, -2) @ pose_traj[1:,:3,:3])
+    return (float(np.sqrt(np.mean(np.sum(np.diff(pose_traj[:,:3,3], n=2, axis=0) ** 2, axis=1)))),
+            float(np.sqrt(np.mean(np.sum(np.diff(rotvec, axis=0) ** 2, axis=1)))))
+
+class CausalPoseFilter:
+    """
+    Online Butterworth low-pass of a pose stream, one (4,4) sample at a time, with the output of
+    smooth_pose_traj(method='butter', causal=True) on the whole stream
+
+    cutoff = cutoff frequency [Hz], rate = sample rate [Hz] of the stream, order = Butterworth order
+    """
+    def __init__(self, cutoff, rate, order=2):
+        self.enabled = cutoff is not None and rate is not None and cutoff < rate / 2
+        if self.enabled:
+            from scipy.signal import butter, lfilter_zi
+            self.b, self.a = butter(order, cutoff / (rate / 2))
+            self.zi_unit = lfilter_zi(self.b, self.a)[:,None]
+        self.reset()
+
+    def reset(self):
+        """
+        Restarts the filter, the next sample is taken as the state at rest (e.g. on a new anchor)
+        """
+        self.zi = None
+        self.quat = None
+
+    def update(self, pose):
+        """
+        Returns the filtered (4,4) pose after the new (4,4) pose sample
+        """
+        if not self.enabled:
+            return np.asarray(pose, dtype=float)
+        signal = pose_signals(pose)[0]
+        if self.quat is not None and np.dot(signal[3:], self.quat) < 0:
+            signal[3:] = -signal[3:]
+        self.quat = signal[3:]
+        if self.zi is None:
+            self.zi = self.zi_unit * signal
+        # one step of the transposed direct form II, as scipy.signal.lfilter (a[0] = 1)
+        filtered = self.b[0] * signal + self.zi[0]
+        for i in range(len(self.zi) - 1):
+            self.zi[i] = self.b[i + 1] * signal - self.a[i + 1] * filtered + self.zi[i + 1]
+        self.zi[-1] = self.b[-1] * signal - self.a[-1] * filtered
+        return signals_to_poses(filtered[None])[0]
+
+def compare_iterations(config, cutoffs):
+    """
+    Returns one row per cutoff [Hz] (None for the raw commands) of the desired pose jitter and
+    the solver iterations of the [Solver] mode on the first segment of the session, with the
+    waypoint decimation of the cfg
+    """
+    import ur5_kinematics
+    import pose_traj_sim as sim
+    import rel_pose_computation as rpc
+    from artifact_store import open_store
+
+    # the raw poses of the first anchor, as compute_command_traj cuts them before the filter
+    data = open_store(config)
+    anchors, index = rpc.segment_index(config, data)
+    abs_traj, time_stamps = rpc.filter_poses_by_time(time_stamps=data['pose_msg'][:,0], time_range=anchors[0],
+                                                     user_input_traj=data['user_input_traj'], window=index[0])
+    abs_traj = np.array(abs_traj)
+    q_home = config['follower_robot_home']
+    home_pose = ur5_kinematics.kinematics_backend(config['kinematics_backend'])[0](q_home)
+    rows = []
+    for cutoff in cutoffs:
+        smoothed = abs_traj if cutoff is None else smooth_pose_traj(abs_traj, time_stamps, cutoff,
+                                                                    method=config['filter_method'],
+                                                                    order=config['filter_order'], rate=config['filter_rate'])
+        rel_traj = se3_batch.rel_pose_traj(smoothed, command_reference_frame=config['command_reference_frame'])
+        robot_traj = se3_batch.desired_poses(rel_traj, home_pose, smoothed, config['scaling_factor'],
+                                             config['haptic_R_viewer'], config['viewer_R_robotbase'],
+                                             command_reference_frame=config['command_reference_frame'])
+        jitter_p, jitter_o = jitter(robot_traj)
+        # the waypoints kept by simulate
+        robot_pose_index = np.arange(len(robot_traj))
+        if config['waypoint_tolerance'] is not None:
+            robot_pose_index = sim.decimate_waypoints(robot_traj, *config['waypoint_tolerance'], time_stamps=time_stamps)
+        robot_traj = robot_traj[robot_pose_index]
+        solver_kwargs = {} if config['solver_max_iters'] is None else {'max_iters': config['solver_max_iters']}
+        if sim.SOLVER_ATTRIBUTES[config['solver_mode']]['time_stamps']:
+            solver_kwargs['time_stamps'] = time_stamps[robot_pose_index]
+        report = {}
+        sim.SOLVERS[config['solver_mode']](robot_traj, q_home, kinematics=config['kinematics_backend'],
+                                           report=report, **solver_kwargs)
+        rows.append({'cutoff': cutoff, 'jitter_p': jitter_p, 'jitter_o': jitter_o,
+                     'iterations': int(report['waypoint_iters'].sum()),
+                     'not_converged': int(np.count_nonzero(~report['waypoint_converged']))})
+    return rows
+
+
+if __name__ == '__main__':
+    import argparse
+    import teleop_utils as utils
+
+    parser = argparse.ArgumentParser(description='Solver iterations on the raw and low-pass filtered commands')
+    parser.add_argument('config', help='config name, e.g. traj1')
+    parser.add_argument('--cutoffs', type=float, nargs='+', default=None,
+                        help='cutoff frequencies [Hz] to compare (default: the [Filter] cutoff of the cfg)')
+    args = parser.parse_args()
+
+    config = utils.load_config(args.config)
+    cutoffs = args.cutoffs or ([config['filter_cutoff']] if config['filter_cutoff'] is not None else [10.0])
+    rows = compare_iterations(config, [None] + cutoffs)
+    raw = rows[0]['iterations']
+    print(f"Solver [{config['solver_mode']}], filter [{config['filter_method']}]")
+    print(f"{'cutoff [Hz]':>12}{'jitter [um]':>13}{'jitter [mrad]':>15}{'iterations':>12}{'reduction':>11}{'not conv.':>11}")
+    for row in rows:
+        cutoff = 'raw' if row['cutoff'] is None else f"{row['cutoff']:g}"
+        reduction = 1 - row['iterations'] / raw if raw else 0.0
+        print(f"{cutoff:>12}{1e6 * row['jitter_p']:>13.3f}{1e3 * row['jitter_o']:>15.4f}"
+              f"{row['iterations']:>12}{reduction:>11.1%}{row['not_converged']:>11}")
@@ -1,21 +1,36 @@
 #!/usr/bin/env python
 
+import time
 import numpy as np
 import teleop_utils as utils
-import roboticstoolbox as rtb
-import ipdb
-from spatialmath import SE3, SO3
-from scipy.spatial.transform import Rotation as R
-import yaml
-
-# LOAD THE ROBOT MODEL
-ROBOT = rtb.models.UR5()
+import se3_batch
+import ur5_kinematics
+from artifact_store import open_store
+import stage_cache
+import instrumentation
+import trajectory_export
+import resample
+import animation_render
+import traj_plot
+import feasibility
 
 # RESOLVED RATE PARAMETERS
 V_MIN, V_MAX, W_MIN, W_MAX, LMDA, DT = 0.1, 1, 15, 100, 5, 0.001
 # ERROR CONVERGENCE PARAMETERS
 E_P, E_O = 0.001, 0.0524
+# fixed_dt logs one joint state every LOG_STEPS time steps
+LOG_STEPS = 25
+# ADAPTIVE DAMPED-LEAST-SQUARES PARAMETERS
+# step gain bounds and adaptation factors, max joint step [rad], per-waypoint iteration budget
+ALPHA_MIN, ALPHA_MAX, ALPHA_GROW, ALPHA_SHRINK, DQ_MAX, MAX_ITERS = 0.05, 1.0, 1.5, 0.5, 0.2, 200
+# damping: LMDA_MIN^2 away from singularities, up to LMDA_MAX^2 when manipulability < W_SING
+LMDA_MIN, LMDA_MAX, W_SING = 0.00316, 0.05, 0.01
+# VELOCITY FEED-FORWARD TRACKING PARAMETERS
+# feedback gain [1/s] on the pose error, bounds of the feedback twist [m/s, rad/s],
+# control period of the waypoints without time stamps [s]
+FF_GAIN, FF_V_MAX, FF_W_MAX, FF_DT = 50.0, 0.25, 1.0, 0.001
 
+@instrumentation.traced
 def get_desired_poses(cmd_traj, home_pose, cmd, sf, haptic_R_viewer, viewer_R_robotbase, command_reference_frame='fixed_robot_base'):
     """
     Returns the desired robot poses from the commanded trajectory as an ndarray
@@ -28,34 +43,55 @@ def get_desired_poses(cmd_traj, home_pose, cmd, sf, haptic_R_viewer, viewer_R_ro
     viewer_R_robotbase = the rotation matrix that rewrites a vector written in the robot base frame to one written in the viewer frame
     """
     
-    # scaling applied to cartesian positions
-    cmd_traj[:,0:3,3] *= sf
     print("Working in " + command_reference_frame + " convention")
-    
-    haptic_R_robotbase = haptic_R_viewer * viewer_R_robotbase
-    robotbase_R_haptic = haptic_R_robotbase.inv()
-    
-    if command_reference_frame=='fixed_robot_base': 
-        # ----STILL UNDER DEVELOPMENT---- #
+    # batched (N,4,4) frame changes, equivalent to the per-pose SE3 products:
+    # fixed_robot_base:    (robotbase_R_haptic * rel_pose * haptic_R_robotbase) * home_pose
+    # moving_end_effector: home_pose * (tcp_R_anch * rel_pose * tcp_R_anch.inv())
+    return se3_batch.desired_poses(cmd_traj, home_pose, cmd, sf, haptic_R_viewer, viewer_R_robotbase,
+                                   command_reference_frame=command_reference_frame)
 
-        des_poses = [((robotbase_R_haptic * rel_pose * haptic_R_robotbase) * home_pose) for rel_pose in utils.ndarray_to_se3(cmd_traj)]
-    
-    elif command_reference_frame=='moving_end_effector':
-
-        # ---- This works --------# 
-
-        anch = utils.ndarray_to_se3(cmd)[0]
-        haptic_R_anch = SE3(SO3(anch.R))
-        anch_R_haptic = haptic_R_anch.inv()
-        robotbase_R_tcp = SE3(SO3(home_pose.R))
-        # For the moving reference frame, we need the end effector reference frames as well
-        anch_R_tcp = anch_R_haptic * haptic_R_robotbase * robotbase_R_tcp
-        tcp_R_anch = anch_R_tcp.inv()
-        des_poses = [(home_pose * (tcp_R_anch * rel_pose * tcp_R_anch.inv())) for rel_pose in utils.ndarray_to_se3(cmd_traj)]
-    else:
-        print(f'Wrong Input for command_reference_frame as {command_reference_frame}')
-        return None
-    return utils.se3_to_ndarray(SE3(des_poses))
+@instrumentation.traced
+def decimate_waypoints(poses, pos_tol, ang_tol, time_stamps=None):
+    """
+    Returns the sorted indices of the waypoints kept by a Douglas-Peucker decimation on SE(3)
+
+    A run of waypoints is replaced by its two end poses as long as every dropped pose stays
+    within pos_tol [m] and ang_tol [rad] of the pose interpolated between the ends
+    (linear position, SLERP rotation, parametrized by time_stamps or by index)
+
+    poses = (N,4,4) desired poses
+    time_stamps = optional (N,) timestamps, e.g. command_time
+    """
+    poses = se3_batch.as_traj(poses)
+    n = len(poses)
+    if n <= 2:
+        return np.arange(n)
+    if time_stamps is None:
+        time_stamps = np.arange(n, dtype=float)
+    time_stamps = np.asarray(time_stamps, dtype=float)
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, n - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        span = time_stamps[last] - time_stamps[first]
+        if span > 0:
+            s = (time_stamps[first+1:last] - time_stamps[first]) / span
+        else:
+            s = np.linspace(0, 1, last - first + 1)[1:-1]
+        interp = se3_batch.interpolate(poses[first], poses[last], s)
+        pos_dev, ang_dev = se3_batch.pose_distance(interp, poses[first+1:last])
+        deviation = np.maximum(pos_dev / pos_tol, ang_dev / ang_tol)
+        worst = np.argmax(deviation)
+        if deviation[worst] > 1:
+            split = first + 1 + worst
+            keep[split] = True
+            segments.append((first, split))
+            segments.append((split, last))
+    return np.flatnonzero(keep)
 
 def get_velocity(position_error, position_error_norm, orientation_axis, orientation_error):
     """
@@ -80,75 +116,324 @@ def get_velocity(position_error, position_error_norm, orientation_axis, orientat
 
     return np.concatenate((p_dot, o_dot), axis=0)
 
-def robust_inv(joint_state):
+def pose_error(des_pose, cur_pose):
+    """
+    Returns the position error, its norm, the rotation error axis and angle
+    between the desired and current (4,4) poses, all wrt the robot base frame
+    """
+    # Position error
+    pos_err = des_pose[:3,3] - cur_pose[:3,3]
+    delta_p = np.linalg.norm(pos_err)
+    # Rotation error as matrix
+    rot_mat = des_pose[:3,:3] @ cur_pose[:3,:3].T
+    from scipy.spatial.transform import Rotation as R
+    with instrumentation.timer('Rotation.from_matrix'):
+        rot_vec = (R.from_matrix(rot_mat)).as_rotvec()
+    # Get the axis-angle of rotation error
+    angle = np.linalg.norm(rot_vec)
+    if angle == 0:
+        axis = np.array([0,0,1])
+    else:
+        axis = rot_vec / angle
+    return pos_err, delta_p, axis, angle
+
+def robust_inv(joint_state, jacob0=None):
     """
     Returns the singularity robust inverse jacobian of the robot
     {With respect to robot base frame}
+    jacob0 = Jacobian function of the kinematics backend, defaults to the rtb model
     """
-    jacobian = ROBOT.jacob0(joint_state) # Jacobian wrt robot base frame
+    if jacob0 is None:
+        jacob0 = utils.get_robot().jacob0
+    jacobian = jacob0(joint_state) # Jacobian wrt robot base frame
     return jacobian.T @ np.linalg.inv((jacobian @ jacobian.T) + (0.00001 * np.identity(6)))
 
-def resolved_rate_joint_traj(traj, q_start):
+@instrumentation.traced
+def resolved_rate_joint_traj(traj, q_start, kinematics='rtb', max_iters=None, report=None):
     """
     Returns a trajectory of joint_state positions
+    Fixed time step (DT) resolved rate with the speed law of get_velocity()
+
+    traj = (N,4,4) desired poses wrt the robot base frame
+    kinematics = 'rtb' for the roboticstoolbox model or 'ur5' for the closed-form kernel
+    max_iters = optional per-waypoint iteration budget, None runs until convergence
+    report = optional dict, filled with the per-waypoint 'waypoint_iters', 'waypoint_converged'
+             and 'waypoint_joint_traj' (the joint state reached at each waypoint)
+
+    While a trace is active (see instrumentation.py), the kinematics calls are timed and every
+    waypoint is recorded with its iterations, final errors and Jacobian condition number
     """
+    fkine, jacob0 = ur5_kinematics.kinematics_backend(kinematics)
+    tracing = instrumentation.active()
+    raw_jacob0 = jacob0
+    fkine, jacob0 = instrumentation.timed('fkine', fkine), instrumentation.timed('jacob0', jacob0)
+    inv_jacobian = instrumentation.timed('robust_inv (incl. jacob0)', robust_inv)
     i = 0
     step = 0
-    traj = utils.ndarray_to_se3(traj)
+    traj = se3_batch.as_traj(traj)
     q_curr = q_start
     joint_state_traj = []
     joint_state_traj.append(q_curr)
     robot_twist = []
+    waypoint_iters = np.zeros(len(traj), dtype=int)
+    waypoint_converged = np.zeros(len(traj), dtype=bool)
+    waypoint_joint_traj = np.zeros((len(traj), len(q_start)))
 
     while i < len(traj):
-        cur_pose = ROBOT.fkine(q_curr)
-        # Position error
-        pos_err = traj[i].t - cur_pose.t
-        delta_p = np.linalg.norm(pos_err)
-        # Rotation error as matrix
-        rot_mat = traj[i].R @ cur_pose.R.T
-        rot_vec = (R.from_matrix(rot_mat)).as_rotvec()
-        # Get the axis-angle of rotation error
-        angle = np.linalg.norm(rot_vec)
-        if angle == 0:
-            axis = np.array([0,0,1])
-        else:
-            axis = rot_vec / angle
+        waypoint_start = time.perf_counter()
+        pos_err, delta_p, axis, angle = pose_error(traj[i], fkine(q_curr))
+        step_start = step
 
-        while (delta_p > E_P) or (angle > E_O):
+        while ((delta_p > E_P) or (angle > E_O)) and (max_iters is None or step - step_start < max_iters):
             vel = get_velocity(pos_err, delta_p, axis, angle)
             
             # Multiply with jacobian inverse for joint speeds
-            q_dot = robust_inv(q_curr) @ vel
+            q_dot = inv_jacobian(q_curr, jacob0) @ vel
 
             # Get next joint states using time step
             q_curr = q_curr + (q_dot * DT)
 
             # Taking every 0.025 seconds of joint_state information for plotting later
-            if step % 25 == 0:
+            if step % LOG_STEPS == 0:
                 joint_state_traj.append(q_curr)
                 robot_twist.append(vel)
             
             step += 1
 
-            cur_pose = ROBOT.fkine(q_curr)
-            # Position error
-            pos_err = traj[i].t - cur_pose.t
-            delta_p = np.linalg.norm(pos_err)
-            # Rotation error as matrix
-            rot_mat = traj[i].R @ cur_pose.R.T
-            rot_vec = (R.from_matrix(rot_mat)).as_rotvec()
-            # Get the axis-angle of rotation error
-            angle = np.linalg.norm(rot_vec)
-            if angle == 0:
-                axis = np.array([0,0,1])
-            else:
-                axis = rot_vec / angle
+            pos_err, delta_p, axis, angle = pose_error(traj[i], fkine(q_curr))
+        waypoint_iters[i] = step - step_start
+        waypoint_converged[i] = (delta_p <= E_P) and (angle <= E_O)
+        waypoint_joint_traj[i] = q_curr
+        if tracing:
+            instrumentation.record('waypoint', solver='fixed_dt', index=i, iters=int(waypoint_iters[i]),
+                                   delta_p=float(delta_p), angle=float(angle), converged=bool(waypoint_converged[i]),
+                                   cond=float(np.linalg.cond(raw_jacob0(q_curr))),
+                                   wall_s=time.perf_counter() - waypoint_start)
         i += 1
     robot_twist.append(np.array([0, 0, 0, 0, 0, 0]))
+    if report is not None:
+        report['waypoint_iters'] = waypoint_iters
+        report['waypoint_converged'] = waypoint_converged
+        report['waypoint_joint_traj'] = waypoint_joint_traj
     return np.array(joint_state_traj), np.array(robot_twist)
 
-def create_yaml(data_to_convert, file_name):
+def damped_step(jacobian, task_step):
+    """
+    Returns the damped least squares joint step J^T (J J^T + lambda^2 I)^-1 task_step
+    The damping grows as the manipulability sqrt(det(J J^T)) drops below W_SING,
+    and the system is solved with a Cholesky factorization instead of an explicit inverse
+    """
+    from scipy.linalg import cho_factor, cho_solve
+    jjt = jacobian @ jacobian.T
+    w = np.sqrt(max(np.linalg.det(jjt), 0.0))
+    if w < W_SING:
+        lmda_sq = LMDA_MIN**2 + (LMDA_MAX**2) * (1 - w / W_SING)**2
+    else:
+        lmda_sq = LMDA_MIN**2
+    return jacobian.T @ cho_solve(cho_factor(jjt + lmda_sq * np.identity(6)), task_step)
+
+def dls_track(target, q_start, fkine, jacob0, alpha=ALPHA_MAX, max_iters=MAX_ITERS):
+    """
+    Returns the joint state after at most max_iters adaptive damped least squares
+    iterations towards the target (4,4) pose, the step size alpha to continue with,
+    the number of iterations, whether the target is reached and the accumulated task step
+
+    Each iteration takes a fraction alpha of the full damped Gauss-Newton step towards the
+    target. alpha grows after a step that reduces the (E_P, E_O normalized) error and the
+    step is rejected and alpha shrunk otherwise, so the best joint state is kept
+    """
+    q_curr = np.array(q_start, dtype=float)
+    pos_err, delta_p, axis, angle = pose_error(target, fkine(q_curr))
+    cost = delta_p / E_P + angle / E_O
+    task_total = np.zeros(6)
+    iters = 0
+    while ((delta_p > E_P) or (angle > E_O)) and iters < max_iters:
+        iters += 1
+        task_step = np.concatenate((pos_err, axis * angle), axis=0)
+        q_step = damped_step(jacob0(q_curr), task_step)
+        # keep the step inside the region where the linearization holds
+        q_step_max = np.max(np.abs(q_step))
+        if q_step_max > DQ_MAX:
+            q_step = q_step * (DQ_MAX / q_step_max)
+
+        q_next = q_curr + alpha * q_step
+        pos_err_next, delta_p_next, axis_next, angle_next = pose_error(target, fkine(q_next))
+        cost_next = delta_p_next / E_P + angle_next / E_O
+        if cost_next < cost:
+            # accept the step and get more aggressive
+            task_total += alpha * task_step
+            q_curr, cost = q_next, cost_next
+            pos_err, delta_p, axis, angle = pos_err_next, delta_p_next, axis_next, angle_next
+            alpha = min(alpha * ALPHA_GROW, ALPHA_MAX)
+        else:
+            # reject the step and be more careful
+            alpha = max(alpha * ALPHA_SHRINK, ALPHA_MIN)
+    converged = (delta_p <= E_P) and (angle <= E_O)
+    return q_curr, alpha, iters, converged, task_total
+
+@instrumentation.traced
+def adaptive_dls_joint_traj(traj, q_start, kinematics='rtb', max_iters=MAX_ITERS, report=None, *, time_stamps=None):
+    """
+    Returns a trajectory of joint_state positions, one per waypoint, and the twists [v; w]
+    (task displacement toward each waypoint over its time increment)
+    Adaptive step damped least squares (see dls_track), a waypoint is given up
+    after max_iters iterations, keeping its best joint state.
+
+    traj = (N,4,4) desired poses wrt the robot base frame
+    time_stamps = (N,) times of the waypoints, e.g. robot_pose_time, FF_DT apart by default.
+                  The first waypoint, and a waypoint without a time increment, get a zero twist
+    kinematics = 'rtb' for the roboticstoolbox model or 'ur5' for the closed-form kernel
+    report = optional dict, filled with the per-waypoint 'waypoint_iters', 'waypoint_converged'
+             and 'waypoint_joint_traj' (the joint state reached at each waypoint)
+    """
+    fkine, jacob0 = ur5_kinematics.kinematics_backend(kinematics)
+    tracing = instrumentation.active()
+    raw_fkine, raw_jacob0 = fkine, jacob0
+    fkine, jacob0 = instrumentation.timed('fkine', fkine), instrumentation.timed('jacob0', jacob0)
+    traj = se3_batch.as_traj(traj)
+    q_curr = np.array(q_start, dtype=float)
+    joint_state_traj = [q_curr]
+    robot_twist = []
+    waypoint_iters = np.zeros(len(traj), dtype=int)
+    waypoint_converged = np.zeros(len(traj), dtype=bool)
+    alpha = ALPHA_MAX
+
+    for i in range(len(traj)):
+        waypoint_start = time.perf_counter()
+        q_curr, alpha, waypoint_iters[i], waypoint_converged[i], task_total = dls_track(
+            traj[i], q_curr, fkine, jacob0, alpha=alpha, max_iters=max_iters)
+        if tracing:
+            _, delta_p, _, angle = pose_error(traj[i], raw_fkine(q_curr))
+            instrumentation.record('waypoint', solver='adaptive_dls', index=i, iters=int(waypoint_iters[i]),
+                                   delta_p=float(delta_p), angle=float(angle), converged=bool(waypoint_converged[i]),
+                                   cond=float(np.linalg.cond(raw_jacob0(q_curr))),
+                                   wall_s=time.perf_counter() - waypoint_start)
+        joint_state_traj.append(q_curr)
+        robot_twist.append(task_total)
+
+    # displacements (m, rad) to twists (m/s, rad/s), as the other solvers
+    if time_stamps is None:
+        time_stamps = np.arange(len(traj)) * FF_DT
+    periods = np.diff(np.asarray(time_stamps, dtype=float), prepend=time_stamps[0])[:,None] if len(traj) else np.zeros((0, 1))
+    robot_twist = np.where(periods > 0, np.reshape(robot_twist, (-1, 6)) / np.where(periods > 0, periods, 1.0), 0.0)
+    robot_twist = np.vstack([robot_twist, np.zeros(6)])
+    if report is not None:
+        report['waypoint_iters'] = waypoint_iters
+        report['waypoint_converged'] = waypoint_converged
+        report['waypoint_joint_traj'] = np.array(joint_state_traj[1:])
+    return np.array(joint_state_traj), np.array(robot_twist)
+
+def feedforward_twists(traj, time_stamps):
+    """
+    Returns the control periods (N,) and the feed-forward twists (N,6) [v; w] wrt the robot base
+    frame that move the desired pose from each waypoint to the next within its period
+    The first waypoint, and a waypoint without a time increment (period FF_DT), get a zero twist
+    """
+    traj = se3_batch.as_traj(traj)
+    periods = np.diff(np.asarray(time_stamps, dtype=float), prepend=time_stamps[0])
+    moving = periods > 0
+    periods = np.where(moving, periods, FF_DT)
+    twists = np.zeros((len(traj), 6))
+    twists[1:,:3] = traj[1:,:3,3] - traj[:-1,:3,3]
+    twists[1:,3:] = se3_batch.so3_log(traj[1:,:3,:3] @ np.swapaxes(traj[:-1,:3,:3], -1, -2))
+    twists = np.where(moving[:,None], twists / periods[:,None], 0.0)
+    return periods, twists
+
+def _bounded(vec, bound):
+    norm = np.linalg.norm(vec)
+    return vec * (bound / norm) if norm > bound else vec
+
+@instrumentation.traced
+def feedforward_joint_traj(traj, q_start, time_stamps=None, kinematics='rtb', max_iters=None, report=None):
+    """
+    Returns a trajectory of joint_state positions, one per waypoint
+    Velocity feed-forward tracking: the solver advances exactly one control period per waypoint
+    (a single damped least squares step), commanding the twist between consecutive desired poses
+    plus a bounded proportional feedback on the remaining pose error. The cost is fixed, O(N),
+    and the timing of the commands is kept, a waypoint may be reached with a residual error
+
+    traj = (N,4,4) desired poses wrt the robot base frame
+    time_stamps = (N,) times of the waypoints, e.g. robot_pose_time, FF_DT apart by default
+    kinematics = 'rtb' for the roboticstoolbox model or 'ur5' for the closed-form kernel
+    max_iters = unused, every waypoint takes one step
+    report = optional dict, filled with the per-waypoint 'waypoint_iters' (all 1), 'waypoint_converged'
+             (within E_P, E_O after the step) and 'waypoint_joint_traj'
+    """
+    fkine, jacob0 = ur5_kinematics.kinematics_backend(kinematics)
+    tracing = instrumentation.active()
+    raw_jacob0 = jacob0
+    fkine, jacob0 = instrumentation.timed('fkine', fkine), instrumentation.timed('jacob0', jacob0)
+    traj = se3_batch.as_traj(traj)
+    if time_stamps is None:
+        time_stamps = np.arange(len(traj)) * FF_DT
+    periods, ff_twists = feedforward_twists(traj, time_stamps)
+    q_curr = np.array(q_start, dtype=float)
+    joint_state_traj = [q_curr]
+    robot_twist = []
+    waypoint_converged = np.zeros(len(traj), dtype=bool)
+
+    # the feedback of a step acts on the error to the previous waypoint (the first one at the start)
+    if len(traj):
+        pos_err, _, axis, angle = pose_error(traj[0], fkine(q_curr))
+    for i in range(len(traj)):
+        waypoint_start = time.perf_counter()
+        gain = min(FF_GAIN * periods[i], 1.0) / periods[i]
+        twist = ff_twists[i] + np.concatenate((_bounded(gain * pos_err, FF_V_MAX),
+                                               _bounded(gain * angle * axis, FF_W_MAX)), axis=0)
+        q_step = damped_step(jacob0(q_curr), twist * periods[i])
+        q_step_max = np.max(np.abs(q_step))
+        if q_step_max > DQ_MAX:
+            q_step = q_step * (DQ_MAX / q_step_max)
+        q_curr = q_curr + q_step
+
+        pos_err, delta_p, axis, angle = pose_error(traj[i], fkine(q_curr))
+        waypoint_converged[i] = (delta_p <= E_P) and (angle <= E_O)
+        if tracing:
+            instrumentation.record('waypoint', solver='feedforward', index=i, iters=1,
+                                   delta_p=float(delta_p), angle=float(angle), converged=bool(waypoint_converged[i]),
+                                   cond=float(np.linalg.cond(raw_jacob0(q_curr))),
+                                   wall_s=time.perf_counter() - waypoint_start)
+        joint_state_traj.append(q_curr)
+        robot_twist.append(twist)
+
+    robot_twist.append(np.array([0, 0, 0, 0, 0, 0]))
+    if report is not None:
+        report['waypoint_iters'] = np.ones(len(traj), dtype=int)
+        report['waypoint_converged'] = waypoint_converged
+        report['waypoint_joint_traj'] = np.array(joint_state_traj[1:]).reshape(len(traj), len(q_start))
+    return np.array(joint_state_traj), np.array(robot_twist)
+
+def tracking_errors(traj, joint_traj, kinematics='rtb'):
+    """
+    Returns the position [m] and rotation angle [rad] errors (N,) of the joint states (N,n)
+    to the desired poses (N,4,4), with the forward kinematics evaluated in one batch
+    """
+    fkine, _ = ur5_kinematics.kinematics_backend('ets' if kinematics == 'rtb' else kinematics)
+    joint_traj = np.asarray(joint_traj, dtype=float)
+    if len(joint_traj) == 0:
+        return np.zeros(0), np.zeros(0)
+    return se3_batch.pose_distance(se3_batch.as_traj(traj), fkine(joint_traj.reshape(len(joint_traj), -1)))
+
+# solver modes selectable with [Solver] solver_mode in the cfg
+SOLVERS = {
+    'fixed_dt': resolved_rate_joint_traj,
+    'adaptive_dls': adaptive_dls_joint_traj,
+    'feedforward': feedforward_joint_traj,
+}
+# attributes of the solver modes:
+# follows_time = the joint trajectory follows the time stamps of the waypoints
+# time_stamps = the solver takes the time stamps of the waypoints (adaptive_dls only for its twists)
+SOLVER_ATTRIBUTES = {
+    'fixed_dt': {'follows_time': False, 'time_stamps': False},
+    'adaptive_dls': {'follows_time': False, 'time_stamps': True},
+    'feedforward': {'follows_time': True, 'time_stamps': True},
+}
+
+@instrumentation.traced
+def create_yaml(data_to_convert, file_name, feasibility_report=None):
+    # Refuse to export a trajectory that failed the feasibility check (see feasibility.py)
+    if feasibility_report is not None:
+        feasibility.require_feasible(feasibility_report, file_name)
     # Convert the parent ndarray and nested ndarrays to the desired format for YAML
     yaml_data = []
     for idx, sublist in enumerate(data_to_convert):
@@ -158,68 +443,183 @@ def create_yaml(data_to_convert, file_name):
         })
 
     # Write the data to the YAML file
+    import yaml
     with open(file_name, 'w') as yaml_file:
         yaml.dump(yaml_data, yaml_file, default_flow_style=False)
     print('joint state trajectory saved as: ', file_name)
 
-if __name__ == '__main__':
-    # Load the command data { waypoints, timestamps }
-    config = utils.load_config()
-    haptic_R_viewer = SE3(config['haptic_R_viewer'])
-    viewer_R_robotbase = SE3(config['viewer_R_robotbase'])
+def joint_traj_time(solver_mode, n_points, robot_pose_time):
+    """
+    Returns the time stamps of the joint trajectory points logged by the solver:
+    every LOG_STEPS * DT for fixed_dt, the start then the waypoint times for adaptive_dls and feedforward
+    """
+    if solver_mode in ('adaptive_dls', 'feedforward'):
+        return np.r_[0.0, robot_pose_time][:n_points]
+    return np.arange(n_points) * LOG_STEPS * DT
+
+@instrumentation.traced
+def export_joint_traj(config, joint_pose_traj, time_stamps):
+    """
+    Checks the feasibility of the joint trajectory (see feasibility.py), then writes it for the
+    ROS node in the format of the [Export] section: the yaml schema of create_yaml by default,
+    or a streaming format of trajectory_export.py
+    With [Feasibility] refuse_export, a trajectory that fails the check raises a ValueError and is not written
+
+    Returns the feasibility report
+    """
+    report = feasibility.check_config(config, joint_pose_traj, time_stamps)
+    print('\n'.join(feasibility.summary(report)))
+    strict_report = report if config['feasibility_strict'] else None
+    if config['export_format'] == 'yaml':
+        create_yaml(joint_pose_traj, config['yaml_file_path'], feasibility_report=strict_report)
+    else:
+        if strict_report is not None:
+            feasibility.require_feasible(strict_report, config['export_file_path'])
+        trajectory_export.export_trajectory(config['export_file_path'], joint_pose_traj, time_stamps,
+                                            file_format=config['export_format'], compress=config['export_compress'])
+    return report
+
+@instrumentation.traced_stage
+def simulate(config):
+    """
+    Computes the desired robot poses and the joint trajectory from the commanded
+    trajectory, saves them to the artifact store and to the joint trajectory file ([Export])
+    Both results are cached on the cfg fields and inputs they depend on (see stage_cache.py)
 
-    data = np.load(config['user_input_data'])
+    Returns the desired poses, the joint and twist trajectories and the solver report
+    With a [Resample] control_rate, the joint trajectory at the control rate is exported
+    and added to the report as 'control_time' and 'control_joint_traj'
+    The feasibility report of the exported joint trajectory is added as 'feasibility'
+    """
+    # Load the command data { waypoints, timestamps }
+    data = open_store(config)
     # Relative pen poses wrt the Haptic Device base frame
     cmd_traj = data['command_rel_traj']
     cmd_time = data['command_time'] # {timestamps}
 
     q_home = config['follower_robot_home']
-    T_home = ROBOT.fkine(q_home)
-
-    robot_traj = get_desired_poses( 
-                                    cmd_traj=cmd_traj, 
-                                    home_pose=T_home,
-                                    cmd=data['command_abs_traj'],
-                                    sf=config['scaling_factor'], 
-                                    haptic_R_viewer=config['haptic_R_viewer'], 
-                                    viewer_R_robotbase=config['viewer_R_robotbase'],
-                                    command_reference_frame=config['command_reference_frame']
-                                    )
-    
-    joint_pose_traj, robot_twist_traj = resolved_rate_joint_traj(robot_traj, q_home)
-    gif_path = 'data_saved/follower_robot_' + config['name'] + '.gif'
-    
-    # save everything
-    np.savez(config['user_input_data'],
-            # original data already loaded 
-            button1=data['button1'],
-            button2=data['button2'],
-            pose_msg=data['pose_msg'],
-            user_input_traj=data['user_input_traj'],
-            command_abs_traj=data['command_abs_traj'],
-            command_rel_traj=data['command_rel_traj'],
-            command_time=data['command_time'],
-            # teleop_traj_config data
-            haptic_R_viewer=config['haptic_R_viewer'],
-            viewer_R_robotbase=config['viewer_R_robotbase'],
-            scaling_factor=config['scaling_factor'],
-            command_reference_frame=config['command_reference_frame'],
+    T_home = ur5_kinematics.kinematics_backend(config['kinematics_backend'])[0](q_home)
+
+    cache = stage_cache.from_config(config)
+
+    def compute_desired_poses():
+        robot_traj = get_desired_poses( 
+                                        cmd_traj=cmd_traj, 
+                                        home_pose=T_home,
+                                        cmd=data['command_abs_traj'],
+                                        sf=config['scaling_factor'], 
+                                        haptic_R_viewer=config['haptic_R_viewer'], 
+                                        viewer_R_robotbase=config['viewer_R_robotbase'],
+                                        command_reference_frame=config['command_reference_frame']
+                                        )
+        
+        # Drop waypoints that the path does not need within the tolerance, keep the map to command_time
+        if config['waypoint_tolerance'] is None:
+            robot_pose_index = np.arange(len(robot_traj))
+        else:
+            pos_tol, ang_tol = config['waypoint_tolerance']
+            robot_pose_index = decimate_waypoints(robot_traj, pos_tol, ang_tol, time_stamps=cmd_time)
+            print(f'Waypoint decimation kept {len(robot_pose_index)}/{len(robot_traj)} waypoints')
+        return {'robot_pose_traj': robot_traj[robot_pose_index], 'robot_pose_index': robot_pose_index}
+
+    outputs = cache.run('get_desired_poses',
+        fields={key: config[key] for key in ('scaling_factor', 'haptic_R_viewer', 'viewer_R_robotbase',
+                                             'command_reference_frame', 'follower_robot_home', 'waypoint_tolerance')},
+        inputs={'command_rel_traj': cmd_traj, 'command_abs_traj': data['command_abs_traj'], 'command_time': cmd_time},
+        compute=compute_desired_poses)
+    robot_traj, robot_pose_index = outputs['robot_pose_traj'], outputs['robot_pose_index']
+    robot_pose_time = cmd_time[robot_pose_index]
+
+    def compute_joint_traj():
+        solver_report = {}
+        solver_kwargs = {} if config['solver_max_iters'] is None else {'max_iters': config['solver_max_iters']}
+        if SOLVER_ATTRIBUTES[config['solver_mode']]['time_stamps']:
+            solver_kwargs['time_stamps'] = robot_pose_time
+        joint_pose_traj, robot_twist_traj = SOLVERS[config['solver_mode']](
+                                        robot_traj, q_home,
+                                        kinematics=config['kinematics_backend'],
+                                        report=solver_report,
+                                        **solver_kwargs
+                                        )
+        return {'robot_joint_traj': joint_pose_traj, 'robot_twist_traj': robot_twist_traj,
+                'waypoint_iters': solver_report['waypoint_iters'], 'waypoint_converged': solver_report['waypoint_converged'],
+                'waypoint_joint_traj': solver_report['waypoint_joint_traj']}
+
+    # the solver constants are part of the key, so editing them invalidates the cached results
+    outputs = cache.run('resolved_rate_joint_traj',
+        fields={'solver_mode': config['solver_mode'], 'solver_max_iters': config['solver_max_iters'],
+                'kinematics_backend': config['kinematics_backend'], 'follower_robot_home': q_home,
+                'constants': [V_MIN, V_MAX, W_MIN, W_MAX, LMDA, DT, E_P, E_O,
+                              ALPHA_MIN, ALPHA_MAX, ALPHA_GROW, ALPHA_SHRINK, DQ_MAX, MAX_ITERS,
+                              LMDA_MIN, LMDA_MAX, W_SING, FF_GAIN, FF_V_MAX, FF_W_MAX, FF_DT]},
+        inputs={'robot_pose_traj': robot_traj, 'robot_pose_time': robot_pose_time},
+        compute=compute_joint_traj)
+    joint_pose_traj, robot_twist_traj = outputs['robot_joint_traj'], outputs['robot_twist_traj']
+    solver_report = {key: outputs[key] for key in ('waypoint_iters', 'waypoint_converged', 'waypoint_joint_traj')}
+    print(f"Solver [{config['solver_mode']}]: {solver_report['waypoint_iters'].sum()} iterations, "
+          f"{np.count_nonzero(~solver_report['waypoint_converged'])}/{len(robot_traj)} waypoints not converged")
+    # achieved tracking error at every waypoint, to compare the solver modes
+    solver_report['tracking_delta_p'], solver_report['tracking_angle'] = tracking_errors(
+                                        robot_traj, solver_report['waypoint_joint_traj'], config['kinematics_backend'])
+    if len(robot_traj):
+        print(f"Tracking error: position mean {1e3 * solver_report['tracking_delta_p'].mean():.3f} / "
+              f"max {1e3 * solver_report['tracking_delta_p'].max():.3f} mm, "
+              f"angle max {np.degrees(solver_report['tracking_angle'].max()):.3f} deg")
+    # joint trajectory at the control rate, aligned with the operator's timing (command_time)
+    resampled = {}
+    if config['control_rate'] is not None:
+        control_time, control_joint_traj = resample.control_joint_traj(
+                                        robot_pose_time, solver_report['waypoint_joint_traj'],
+                                        config['control_rate'], method=config['resample_method'],
+                                        tolerance=config['resample_tolerance'])
+        solver_report['control_time'], solver_report['control_joint_traj'] = control_time, control_joint_traj
+        resampled = {'robot_control_time': control_time, 'robot_control_joint_traj': control_joint_traj}
+        print(f"Resampled to {config['control_rate']} Hz ({config['resample_method']}): {len(control_time)} points")
+    # save the outputs of this stage
+    data.save('sim',
             # robot trajectory processed
             robot_pose_traj=robot_traj,
+            robot_pose_index=robot_pose_index,
+            robot_pose_time=robot_pose_time,
             robot_joint_traj=joint_pose_traj,
             robot_twist_traj=robot_twist_traj,
+            solver_mode=config['solver_mode'],
+            solver_waypoint_iters=solver_report['waypoint_iters'],
+            solver_waypoint_converged=solver_report['waypoint_converged'],
+            solver_waypoint_joint_traj=solver_report['waypoint_joint_traj'],
+            solver_tracking_delta_p=solver_report['tracking_delta_p'],
+            solver_tracking_angle=solver_report['tracking_angle'],
+            **resampled,
             )
-    print("File Saved As: ", config['user_input_data'])
-    # Creates yaml configuration file to use with ROS node
-    create_yaml(joint_pose_traj, config['yaml_file_path'])
+    print("Artifacts Saved In: ", data.path)
+    # Creates the joint trajectory file to use with ROS node
+    if resampled:
+        solver_report['feasibility'] = export_joint_traj(config, control_joint_traj, control_time)
+    else:
+        solver_report['feasibility'] = export_joint_traj(config, joint_pose_traj,
+                                        joint_traj_time(config['solver_mode'], len(joint_pose_traj), robot_pose_time))
+    return robot_traj, joint_pose_traj, robot_twist_traj, solver_report
+
+
+if __name__ == '__main__':
+    config = utils.load_config()
+    haptic_R_viewer = config['haptic_R_viewer']
+    viewer_R_robotbase = config['viewer_R_robotbase']
+    gif_path = 'data_saved/follower_robot_' + config['name'] + '.gif'
+
+    robot_traj, joint_pose_traj, robot_twist_traj, solver_report = simulate(config)
+    data = open_store(config)
 
-    input("Display the input vs robot trajectory comparison: press [Enter]")
     # Map both the input and robot trajectory to the viewer frame
-    hap_traj = haptic_R_viewer.inv() * utils.ndarray_to_se3(data['command_abs_traj'])
-    rob_traj = viewer_R_robotbase * utils.ndarray_to_se3(robot_traj)
+    hap_traj = se3_batch.compose(se3_batch.inv(se3_batch.as_matrix(haptic_R_viewer)), data['command_abs_traj'])
+    rob_traj = se3_batch.compose(se3_batch.as_matrix(viewer_R_robotbase), robot_traj)
     # plot the comparison of both
-    utils.plot_haptic_robot_traj(hap_traj=hap_traj,rob_traj=rob_traj)
-    
+    utils.plot_haptic_robot_traj(hap_traj=hap_traj, rob_traj=rob_traj,
+                                 file_path=traj_plot.plot_file_path(config, 'haptic_robot_traj'), n_frames=config['plot_frames'])
+
     # The below method generates an animation
-    input("Press [enter] to display animated trajectory")
-    ROBOT.plot(joint_pose_traj, dt=0.025, block=False, backend='pyplot', movie=gif_path)      # by default, dt=0.05
\ No newline at end of file
+    if 'control_joint_traj' in solver_report:
+        animation_render.render_animation(solver_report['control_joint_traj'], gif_path,
+                                          time_stamps=solver_report['control_time'], title=config['name'])
+    else:
+        animation_render.render_animation(joint_pose_traj, gif_path, title=config['name'])
@@ -2,8 +2,11 @@
 
 import numpy as np
 import teleop_utils as utils
-from spatialmath import *
-import ipdb
+import se3_batch
+from artifact_store import open_store
+import stage_cache
+import instrumentation
+import pose_filter
 
 def total_time(pose_array):
     """
@@ -13,41 +16,144 @@ def total_time(pose_array):
     """
     return pose_array[len(pose_array)-1][0] - pose_array[0][0]
 
-def anchor_events(button):
+@instrumentation.traced
+def anchor_events(button, end_time=None):
     """
-    Returns each anchor event as an array where 
-    each element of array is [time_press, time_release]
+    Returns each anchor event as a (K,2) array where 
+    each row is [time_press, time_release]
+
+    Repeated events (a press after a press, a release after a release) are ignored, so
+    every anchor runs from a button press to the following release. A trailing press
+    without a release is closed at end_time, or dropped if end_time is None
+    """
+    button = np.asarray(button)
+    if len(button) == 0:
+        return np.empty((0, 2))
+    pressed = button[:,1] == 1
+    # keep the state changes only
+    changes = np.flatnonzero(np.r_[True, pressed[1:] != pressed[:-1]])
+    event_time, event_pressed = button[changes,0], pressed[changes]
+    press = np.flatnonzero(event_pressed)
+    release_time = np.append(event_time, np.nan if end_time is None else end_time)[press + 1]
+    anchors = np.column_stack([event_time[press], release_time])
+    return anchors[~np.isnan(anchors[:,1])]
+
+@instrumentation.traced
+def time_windows(time_stamps, anchors):
+    """
+    Returns the [start, stop) indices of the samples within each anchor time range as a (K,2) int array
+    Preconditions: time_stamps is sorted chronologically
+    """
+    anchors = np.asarray(anchors, dtype=float).reshape(-1, 2)
+    start = np.searchsorted(time_stamps, anchors[:,0], side='left')
+    stop = np.searchsorted(time_stamps, anchors[:,1], side='right')
+    return np.column_stack([start, np.maximum(start, stop)]).astype(np.int64)
+
+@instrumentation.traced
+def filter_poses_by_time(time_stamps, time_range, user_input_traj, window=None):
+    """
+    Returns the poses within the time range (a view of user_input_traj, not a copy)
+    and their time stamps relative to the first one
+    Preconditions: time_stamps is sorted chronologically
+
+    window = optional precomputed [start, stop) indices of the range (see time_windows)
+    """
+    if window is None:
+        window = time_windows(time_stamps, time_range)[0]
+    (start, stop) = window
+    relative_time = time_stamps[start:stop] - time_stamps[start]
+    return (user_input_traj[start:stop], relative_time)
+
+@instrumentation.traced
+def segment_index(config, data, recompute=False):
+    """
+    Returns the anchors (K,2) of the enable button and their [start, stop) pose indices (K,2)
+
+    The index is saved in the artifact store ('segments' stage) alongside the extracted
+    data and reused until it is recomputed or the enable button of the config changes.
+    A press still held at the end of the bag is closed at the last pose message
     """
-    anchors = []
-    for i in range(len(button) - 1):
-        if (button[i,1] == 1):
-            anchors.append([button[i,0], button[i+1,0]])
-    return anchors
-
-def filter_poses_by_time(time_stamps, time_range, user_input_traj):
-    # Find the indices where the time values in the poses array fall within the given range
-    index_within_range = np.where(
-        (time_stamps >= time_range[0]) & (time_stamps <= time_range[1]))
-    relative_time = time_stamps[index_within_range[0]] - time_stamps[index_within_range[0][0]]
-    return (user_input_traj[index_within_range[0],:,:],relative_time)
+    if (not recompute and 'segment_index' in data
+            and str(data['segment_button']) == config['enable_button']):
+        return data['segment_anchors'], data['segment_index']
+    time_stamps = data['pose_msg'][:,0]
+    anchors = anchor_events(data[config['enable_button']], end_time=time_stamps[-1])
+    index = time_windows(time_stamps, anchors)
+    data.save('segments', segment_button=np.array(config['enable_button']),
+              segment_anchors=anchors, segment_index=index)
+    return anchors, index
    
+@instrumentation.traced
 def rel_pose_traj(user_input_traj,command_reference_frame='moving_end_effector'):
     """
     Returns the change in the pen's pose wrt the Haptic Device base frame
+    as an (N,4,4) ndarray, computed in batch (see se3_batch.rel_pose_traj)
+    """
+    return se3_batch.rel_pose_traj(user_input_traj, command_reference_frame)
+
+
+@instrumentation.traced_stage
+def compute_command_traj(config):
+    """
+    Computes the commanded trajectories of the first enable-button anchor
+    and saves them to the artifact store
+    With a [Filter] cutoff, the poses of the anchor are low-pass filtered (see pose_filter.py)
+    The result is cached on the command_reference_frame, the filter and the extracted data (see stage_cache.py)
+
+    Returns the filtered absolute trajectory, the relative trajectory (both (N,4,4)),
+    the relative time stamps and the total time of the anchor
     """
-    start_pose = user_input_traj[0]     # Anchor pose in the haptic device base frame
-    if command_reference_frame=='fixed_robot_base':
-        return SE3([pose * start_pose.inv() for pose in user_input_traj])
-    elif command_reference_frame=='moving_end_effector':
-        return SE3([start_pose.inv()*pose for pose in user_input_traj])
-    else:
-        print(f'Wrong Input for command_reference_frame as {command_reference_frame}')
-        return None
+    data = open_store(config)
+    pose_msg = data['pose_msg']
+    user_input_traj = data['user_input_traj']
+
+    (anchors, index) = segment_index(config, data)
+    selected_anchor_range = anchors[0]
+    total_time = selected_anchor_range[1] - selected_anchor_range[0]
+
+    def compute():
+        (user_input_traj_fltr, rel_time) = filter_poses_by_time(
+            time_stamps = pose_msg[:,0], time_range = selected_anchor_range, user_input_traj = user_input_traj,
+            window = index[0])
+        if config['filter_cutoff'] is not None:
+            raw_jitter = pose_filter.jitter(user_input_traj_fltr)
+            user_input_traj_fltr = pose_filter.smooth_config(config, user_input_traj_fltr, rel_time)
+            smoothed_jitter = pose_filter.jitter(user_input_traj_fltr)
+            print(f"Filter [{config['filter_method']}] at {config['filter_cutoff']} Hz: position jitter "
+                  f"{1e6 * raw_jitter[0]:.3f} -> {1e6 * smoothed_jitter[0]:.3f} um, rotation jitter "
+                  f"{1e3 * raw_jitter[1]:.4f} -> {1e3 * smoothed_jitter[1]:.4f} mrad")
+
+        rel_traj = rel_pose_traj(user_input_traj=user_input_traj_fltr,
+                                 command_reference_frame=config['command_reference_frame'])
+        return {'command_abs_traj': user_input_traj_fltr, 'command_rel_traj': rel_traj, 'command_time': rel_time}
+
+    outputs = stage_cache.from_config(config).run('rel_pose_traj',
+        fields={'command_reference_frame': config['command_reference_frame'],
+                'filter': [config['filter_cutoff'], config['filter_method'], config['filter_order'], config['filter_rate']]},
+        inputs={'segment_window': index[0], 'pose_msg': pose_msg, 'user_input_traj': user_input_traj},
+        compute=compute)
+    (user_input_traj_fltr, rel_traj, rel_time) = (outputs['command_abs_traj'], outputs['command_rel_traj'], outputs['command_time'])
+
+    # save the outputs of this stage, the extracted data stays untouched
+    data.save('rel_pose',
+            # teleop_traj_config data
+            haptic_R_viewer=se3_batch.as_matrix(config['haptic_R_viewer']),
+            viewer_R_robotbase=se3_batch.as_matrix(config['viewer_R_robotbase']),
+            scaling_factor=config['scaling_factor'],
+            command_reference_frame=config['command_reference_frame'],
+            # commanded trajectories processed,
+            command_abs_traj=user_input_traj_fltr,
+            command_rel_traj=rel_traj,
+            command_time=np.array(rel_time),
+            )
+    
+    print("Artifacts Saved In: ", data.path)
+    return user_input_traj_fltr, rel_traj, rel_time, total_time
 
 
 if __name__ == '__main__':
     """ 
-    Load the data from an npz file where:
+    Load the data from the artifact store where:
     
     button1 and button2:
     [   [time_0 event_0]
@@ -70,62 +176,26 @@ if __name__ == '__main__':
         [SE3() at time_n]
 
     """
-    config = utils.load_config()
-    data = np.load(config['user_input_data'])
-    button_enable = data[config['enable_button']]
-    pose_msg = data['pose_msg']
-    user_input_traj = data['user_input_traj']
-
-    anchors = anchor_events(button_enable)
-    selected_anchor_range = anchors[0]
-    total_time = selected_anchor_range[1] - selected_anchor_range[0]
-
-    (user_input_traj_fltr, rel_time) = filter_poses_by_time(
-        time_stamps = pose_msg[:,0], time_range = selected_anchor_range, user_input_traj = user_input_traj)
-
+    import sys
+    import traj_plot
 
-
-    user_input_traj_fltr = utils.ndarray_to_se3(user_input_traj_fltr) # this forced conversion using SE3(list of SE3 instances) is necessary to enable user_input_traj.plot() 
-
-    rel_traj = rel_pose_traj(user_input_traj=user_input_traj_fltr,
-                             command_reference_frame=config['command_reference_frame'])
-
-    # save everything
-    np.savez(config['user_input_data'],
-            # original data already loaded 
-            button1=data['button1'], 
-            button2=data['button2'], 
-            pose_msg=data['pose_msg'], 
-            user_input_traj=data['user_input_traj'], 
-            # teleop_traj_config data
-            haptic_R_viewer=config['haptic_R_viewer'],
-            viewer_R_robotbase=config['viewer_R_robotbase'],
-            scaling_factor=config['scaling_factor'],
-            command_reference_frame=config['command_reference_frame'],
-            # commanded trajectories processed,
-            command_abs_traj=utils.se3_to_ndarray(user_input_traj_fltr),
-            command_rel_traj=utils.se3_to_ndarray(rel_traj),
-            command_time=np.array(rel_time),
-            )
-    
-    print("File Saved As: ", config['user_input_data'])
+    config = utils.load_config()
+    (user_input_traj_fltr, rel_traj, rel_time, total_time) = compute_command_traj(config)
 
     # Animation 1: User Input
-    utils.animate_user_input(user_input_traj=user_input_traj_fltr, plt_title='User Input Traj')
+    utils.animate_user_input(user_input_traj=user_input_traj_fltr, plt_title='User Input Traj', time_stamps=rel_time,
+                             gif_path='data_saved/user_input_' + config['name'] + '.gif')
 
     # Animation 2: User Input (Relative)
-    utils.animate_user_input(user_input_traj=rel_traj, plt_title='User Input Traj (Relative)')
-
-    # Comparison: User Input vs. Relative
-    time_to_view = 1.0
-    while time_to_view>0:
-        time_to_view = float(input(
-            f'Total time = {total_time}, select a time view (or negative time to quit): '))
-        if time_to_view>=total_time:
-            time_to_view = total_time
-        if time_to_view > 0:
-            index_to_view = int (time_to_view/total_time*len(rel_traj))
-            utils.plot_user_input_pose(index = index_to_view,abs_traj=user_input_traj_fltr,rel_traj=rel_traj)
+    utils.animate_user_input(user_input_traj=rel_traj, plt_title='User Input Traj (Relative)', time_stamps=rel_time,
+                             gif_path='data_saved/user_input_rel_' + config['name'] + '.gif')
+
+    # Comparison: User Input vs. Relative, at the times [s] given after the config name
+    for time_to_view in (float(arg) for arg in sys.argv[2:]):
+        index_to_view = int(min(max(time_to_view, 0.0), total_time) / total_time * (len(rel_traj) - 1))
+        utils.plot_user_input_pose(index=index_to_view, abs_traj=user_input_traj_fltr, rel_traj=rel_traj,
+                                   file_path=traj_plot.plot_file_path(config, f'user_input_pose_{time_to_view:g}s'))
 
     # Comparison: Trajectory vs. Relative
-    utils.plot_user_input_traj(abs_traj=user_input_traj_fltr,rel_traj=rel_traj)
\ No newline at end of file
+    utils.plot_user_input_traj(abs_traj=user_input_traj_fltr, rel_traj=rel_traj,
+                               file_path=traj_plot.plot_file_path(config, 'user_input_traj'), n_frames=config['plot_frames'])
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Time-parameterized resampling of the solver output
+
+The resolved rate solvers log joint states at their own pace (every LOG_STEPS
+integration steps for fixed_dt), unrelated to the operator's timing. Both solvers
+also report the joint state reached at every waypoint, and the waypoints carry the
+time stamps of the commands (command_time). These are resampled here to a fixed
+control rate with vectorized interpolation, so the follower reproduces the
+demonstration speed:
+
+* joint space: cubic spline (zero end velocities), PCHIP (no overshoot) or linear
+* task space: linear position and SLERP rotation (see se3_batch.interpolate)
+
+drop_redundant() then removes the control points that linear interpolation in
+time reproduces within a joint tolerance, for compact time-stamped exports.
+"""
+
+import numpy as np
+import se3_batch
+
+METHODS = ['cubic', 'pchip', 'linear']
+
+def unique_times(time_stamps, values):
+    """
+    Returns the strictly increasing time stamps and their values, keeping the last
+    value of repeated time stamps (e.g. a waypoint reached in zero time)
+    """
+    time_stamps = np.asarray(time_stamps, dtype=float)
+    keep = np.r_[np.diff(time_stamps) > 0, True]
+    return time_stamps[keep], np.asarray(values)[keep]
+
+def control_times(start, end, rate):
+    """
+    Returns the time stamps of a control rate [Hz] from start to end, end included
+    """
+    n_ticks = int(np.floor((end - start) * rate + 1e-9))
+    time_stamps = start + np.arange(n_ticks + 1) / rate
+    if time_stamps[-1] < end - 1e-9:
+        time_stamps = np.r_[time_stamps, end]
+    return time_stamps
+
+def resample_joint_traj(time_stamps, joint_traj, rate, method='cubic'):
+    """
+    Returns the control time stamps and the joint trajectory (M,n) interpolated at the control rate [Hz]
+
+    time_stamps = (N,) times of the joint states, e.g. the waypoint times
+    joint_traj = (N,n) joint states
+    method = 'cubic' (spline with zero end velocities), 'pchip' (no overshoot between points) or 'linear'
+    """
+    time_stamps, joint_traj = unique_times(time_stamps, np.asarray(joint_traj, dtype=float))
+    if len(time_stamps) < 2:
+        return time_stamps, joint_traj
+    query = control_times(time_stamps[0], time_stamps[-1], rate)
+    from scipy.interpolate import CubicSpline, PchipInterpolator
+    if method == 'cubic':
+        resampled = CubicSpline(time_stamps, joint_traj, axis=0, bc_type='clamped')(query)
+    elif method == 'pchip':
+        resampled = PchipInterpolator(time_stamps, joint_traj, axis=0)(query)
+    elif method == 'linear':
+        index = np.clip(np.searchsorted(time_stamps, query, side='right') - 1, 0, len(time_stamps) - 2)
+        s = ((query - time_stamps[index]) / (time_stamps[index + 1] - time_stamps[index]))[:,None]
+        resampled = (1 - s) * joint_traj[index] + s * joint_traj[index + 1]
+    else:
+        raise ValueError(f'Unknown resampling method {method}')
+    return query, resampled
+
+def resample_pose_traj(time_stamps, pose_traj, rate):
+    """
+    Returns the control time stamps and the poses (M,4,4) interpolated at the control rate [Hz],
+    linearly for the positions and by SLERP for the rotations
+    """
+    time_stamps, pose_traj = unique_times(time_stamps, se3_batch.as_traj(pose_traj))
+    if len(time_stamps) < 2:
+        return time_stamps, pose_traj
+    query = control_times(time_stamps[0], time_stamps[-1], rate)
+    return query, interpolate_pose_traj(time_stamps, pose_traj, query)
+
+def interpolate_pose_traj(time_stamps, pose_traj, query):
+    """
+    Returns the poses (M,4,4) at the query times (M,) interpolated between the poses (N,4,4)
+    with strictly increasing time stamps (N,), linearly for the positions and by SLERP for
+    the rotations. The query times are clamped to the time span of the poses
+    """
+    if len(time_stamps) < 2:
+        return np.repeat(se3_batch.as_traj(pose_traj)[:1], len(query), axis=0)
+    query = np.clip(query, time_stamps[0], time_stamps[-1])
+    index = np.clip(np.searchsorted(time_stamps, query, side='right') - 1, 0, len(time_stamps) - 2)
+    s = (query - time_stamps[index]) / (time_stamps[index + 1] - time_stamps[index])
+    rot_a, rot_b = pose_traj[index,:3,:3], pose_traj[index + 1,:3,:3]
+    delta = se3_batch.so3_log(np.swapaxes(rot_a, -1, -2) @ rot_b)
+    poses = np.zeros((len(query), 4, 4))
+    poses[:,:3,:3] = rot_a @ se3_batch.so3_exp(s[:,None] * delta)
+    poses[:,:3,3] = (1 - s)[:,None] * pose_traj[index,:3,3] + s[:,None] * pose_traj[index + 1,:3,3]
+    poses[:,3,3] = 1.0
+    return poses
+
+def drop_redundant(time_stamps, joint_traj, tolerance):
+    """
+    Returns the indices of the points to keep so that linear interpolation in time between
+    the kept points reproduces every dropped point within tolerance [rad] on each joint
+    (Douglas-Peucker in joint space, the first and last points are always kept)
+    """
+    time_stamps = np.asarray(time_stamps, dtype=float)
+    joint_traj = np.asarray(joint_traj, dtype=float)
+    n_points = len(time_stamps)
+    keep = np.zeros(n_points, dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, n_points - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        inner = slice(first + 1, last)
+        span = time_stamps[last] - time_stamps[first]
+        s = (time_stamps[inner] - time_stamps[first]) / span if span > 0 else np.zeros(last - first - 1)
+        chord = (1 - s)[:,None] * joint_traj[first] + s[:,None] * joint_traj[last]
+        error = np.abs(joint_traj[inner] - chord).max(axis=1)
+        worst = np.argmax(error)
+        if error[worst] > tolerance:
+            split = first + 1 + worst
+            keep[split] = True
+            stack += [(first, split), (split, last)]
+    return np.flatnonzero(keep)
+
+def control_joint_traj(time_stamps, joint_traj, rate, method='cubic', tolerance=None):
+    """
+    Returns the time stamps and joint trajectory of the solver output at the control rate,
+    without the redundant points if a joint tolerance [rad] is given
+    """
+    control_time, control_traj = resample_joint_traj(time_stamps, joint_traj, rate, method=method)
+    if tolerance is not None:
+        kept = drop_redundant(control_time, control_traj, tolerance)
+        control_time, control_traj = control_time[kept], control_traj[kept]
+    return control_time, control_traj
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""
+Batched SE(3) operations on contiguous ndarrays
+
+A single pose is a (4,4) homogeneous transform, a trajectory is an (N,4,4) array.
+Every function broadcasts over the leading axis, so a whole trajectory is handled
+in a few array operations instead of a Python list of spatialmath SE3 objects.
+"""
+
+import numpy as np
+
+def as_matrix(pose):
+    """
+    Returns the pose(s) as a float ndarray of shape (4,4) or (N,4,4)
+    Accepts spatialmath SE3/SO3 objects (single or multi-valued) or ndarrays
+    """
+    if hasattr(pose, 'data'):   # spatialmath object
+        data = np.asarray(pose.data, dtype=float)
+        if data.shape[-1] == 3:
+            data = from_rotation(data)
+        return data[0] if len(data) == 1 else data
+    pose = np.asarray(pose, dtype=float)
+    if pose.shape[-2:] == (3, 3):
+        return from_rotation(pose)
+    return pose
+
+def as_traj(poses):
+    """
+    Returns the pose(s) as an (N,4,4) trajectory array, a single pose becomes N=1
+    """
+    return as_matrix(poses).reshape(-1, 4, 4)
+
+def from_rotation(rot):
+    """
+    Returns the pure rotation transform(s) of a (3,3) or (N,3,3) rotation matrix array
+    """
+    rot = np.asarray(rot, dtype=float)
+    pose = np.zeros(rot.shape[:-2] + (4, 4))
+    pose[..., :3, :3] = rot
+    pose[..., 3, 3] = 1.0
+    return pose
+
+def from_translation(trans):
+    """
+    Returns the pure translation transform(s) of a (3,) or (N,3) position array
+    """
+    trans = np.asarray(trans, dtype=float)
+    pose = np.zeros(trans.shape[:-1] + (4, 4))
+    pose[..., :3, :3] = np.eye(3)
+    pose[..., :3, 3] = trans
+    pose[..., 3, 3] = 1.0
+    return pose
+
+def quat_to_rotm(quat):
+    """
+    Returns the rotation matrix array (N,3,3) of the (N,4) quaternions stored as [x, y, z, w]
+    The quaternions are normalized first, as UnitQuaternion does
+    """
+    quat = np.asarray(quat, dtype=float)
+    quat = quat / np.linalg.norm(quat, axis=-1, keepdims=True)
+    x, y, z, w = quat[..., 0], quat[..., 1], quat[..., 2], quat[..., 3]
+    rot = np.empty(quat.shape[:-1] + (3, 3))
+    rot[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    rot[..., 0, 1] = 2 * (x * y - z * w)
+    rot[..., 0, 2] = 2 * (x * z + y * w)
+    rot[..., 1, 0] = 2 * (x * y + z * w)
+    rot[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    rot[..., 1, 2] = 2 * (y * z - x * w)
+    rot[..., 2, 0] = 2 * (x * z - y * w)
+    rot[..., 2, 1] = 2 * (y * z + x * w)
+    rot[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    return rot
+
+def rotm_to_quat(rot):
+    """
+    Returns the (N,4) unit quaternions [x, y, z, w] of the (N,3,3) rotation matrix array,
+    with w >= 0. Each row uses the largest of w, x, y, z as pivot (Shepperd's method)
+    """
+    rot = np.asarray(rot, dtype=float)
+    trace = np.trace(rot, axis1=-2, axis2=-1)
+    diag = np.diagonal(rot, axis1=-2, axis2=-1)
+    # 4 q_k^2 - 1 = [trace, 2 R_xx - trace, 2 R_yy - trace, 2 R_zz - trace] for k = w, x, y, z
+    pivot = np.argmax(np.concatenate([trace[..., None], 2 * diag - trace[..., None]], axis=-1), axis=-1)
+    # antisymmetric and symmetric parts: 4 w [x, y, z] and 4 [xy, xz, yz]
+    anti = np.stack([rot[..., 2, 1] - rot[..., 1, 2], rot[..., 0, 2] - rot[..., 2, 0], rot[..., 1, 0] - rot[..., 0, 1]], axis=-1)
+    sym = np.stack([rot[..., 0, 1] + rot[..., 1, 0], rot[..., 0, 2] + rot[..., 2, 0], rot[..., 1, 2] + rot[..., 2, 1]], axis=-1)
+    quat = np.empty(rot.shape[:-2] + (4,))
+    # pivot w
+    quat[..., :3], quat[..., 3] = anti, 1 + trace
+    for k in range(3):
+        # pivot x, y or z: its own component, the other two from sym (pair k, m at k + m - 1), w from anti
+        rows = pivot == k + 1
+        quat[rows, k] = 1 + 2 * diag[rows, k] - trace[rows]
+        for m in range(3):
+            if m != k:
+                quat[rows, m] = sym[rows, k + m - 1]
+        quat[rows, 3] = anti[rows, k]
+    quat /= np.linalg.norm(quat, axis=-1, keepdims=True)
+    return np.where(quat[..., 3:] < 0, -quat, quat)
+
+def pose_msg_to_traj(pose_msg):
+    """
+    Returns the (N,4,4) poses of the (N,8) [time, x, y, z, qx, qy, qz, qw] pose messages
+    """
+    pose_msg = np.asarray(pose_msg, dtype=float)
+    pose = from_rotation(quat_to_rotm(pose_msg[:, 4:8]))
+    pose[:, :3, 3] = pose_msg[:, 1:4]
+    return pose
+
+def rotation_part(pose):
+    """
+    Returns the pure rotation transform(s) of the pose(s), dropping the translation
+    """
+    return from_rotation(np.asarray(pose)[..., :3, :3])
+
+def compose(*poses):
+    """
+    Returns the product of the poses from left to right, e.g. compose(A, B, C) = A * B * C
+    Each argument may be a single (4,4) pose or an (N,4,4) trajectory
+    """
+    result = poses[0]
+    for pose in poses[1:]:
+        result = np.matmul(result, pose)
+    return result
+
+def inv(pose):
+    """
+    Returns the inverse of the pose(s) using the closed form [R^T, -R^T t]
+    """
+    pose = np.asarray(pose, dtype=float)
+    rot_t = np.swapaxes(pose[..., :3, :3], -1, -2)
+    result = np.zeros_like(pose)
+    result[..., :3, :3] = rot_t
+    result[..., :3, 3] = -np.einsum('...ij,...j->...i', rot_t, pose[..., :3, 3])
+    result[..., 3, 3] = 1.0
+    return result
+
+def conjugate(frame, pose):
+    """
+    Returns frame * pose * frame^-1, i.e. the pose(s) rewritten by the change of frame
+    """
+    return compose(frame, pose, inv(frame))
+
+def scale_translation(pose, sf):
+    """
+    Returns a copy of the pose(s) with the cartesian positions multiplied by the scaling factor
+    """
+    result = np.array(pose, dtype=float)
+    result[..., :3, 3] *= sf
+    return result
+
+def so3_log(rot):
+    """
+    Returns the rotation vector(s) (axis * angle) of a (3,3) or (N,3,3) rotation matrix array
+    Batched SO(3) log map, accurate near 0 and pi
+    """
+    rot = np.asarray(rot, dtype=float)
+    cos_angle = np.clip((np.trace(rot, axis1=-2, axis2=-1) - 1) / 2, -1.0, 1.0)
+    angle = np.arccos(cos_angle)
+    vee = np.stack([rot[..., 2, 1] - rot[..., 1, 2],
+                    rot[..., 0, 2] - rot[..., 2, 0],
+                    rot[..., 1, 0] - rot[..., 0, 1]], axis=-1)
+    sin_angle = np.sin(angle)
+    small = angle < 1e-6
+    scale = np.where(small, 0.5 + angle**2 / 12, angle / (2 * np.where(small, 1.0, sin_angle)))
+    rotvec = scale[..., None] * vee
+
+    # near pi the antisymmetric part vanishes, read the axis from the symmetric part
+    # (R + R^T)/2 = cos(angle) I + (1 - cos(angle)) axis axis^T
+    near_pi = angle > np.pi - 1e-3
+    if np.any(near_pi):
+        cos_pi = cos_angle[near_pi][:, None, None]
+        sym = ((rot[near_pi] + np.swapaxes(rot[near_pi], -1, -2)) / 2 - cos_pi * np.eye(3)) / (1 - cos_pi)
+        diag = np.diagonal(sym, axis1=-2, axis2=-1)
+        k = np.argmax(diag, axis=-1)
+        axis = np.take_along_axis(sym, k[:, None, None], axis=-1)[..., 0]
+        axis = axis / np.sqrt(np.maximum(np.take_along_axis(diag, k[:, None], axis=-1), 1e-12))
+        sign = np.where(np.einsum('...i,...i->...', axis, vee[near_pi]) < 0, -1.0, 1.0)
+        rotvec[near_pi] = (sign * angle[near_pi])[..., None] * axis
+    return rotvec
+
+def so3_exp(rotvec):
+    """
+    Returns the rotation matrix array (3,3) or (N,3,3) of the rotation vector(s)
+    Batched Rodrigues formula
+    """
+    rotvec = np.asarray(rotvec, dtype=float)
+    angle = np.linalg.norm(rotvec, axis=-1)
+    small = angle < 1e-6
+    safe_angle = np.where(small, 1.0, angle)
+    a = np.where(small, 1 - angle**2 / 6, np.sin(angle) / safe_angle)
+    b = np.where(small, 0.5 - angle**2 / 24, (1 - np.cos(angle)) / safe_angle**2)
+    skew = np.zeros(rotvec.shape[:-1] + (3, 3))
+    skew[..., 0, 1], skew[..., 0, 2] = -rotvec[..., 2], rotvec[..., 1]
+    skew[..., 1, 0], skew[..., 1, 2] = rotvec[..., 2], -rotvec[..., 0]
+    skew[..., 2, 0], skew[..., 2, 1] = -rotvec[..., 1], rotvec[..., 0]
+    return np.eye(3) + a[..., None, None] * skew + b[..., None, None] * (skew @ skew)
+
+def interpolate(pose_a, pose_b, s):
+    """
+    Returns the poses (N,4,4) between pose_a (s=0) and pose_b (s=1) at the fractions s (N,)
+    Positions are interpolated linearly and rotations by SLERP (geodesic on SO(3))
+    """
+    s = np.asarray(s, dtype=float)
+    delta = so3_log(pose_a[:3, :3].T @ pose_b[:3, :3])
+    pose = np.zeros(s.shape + (4, 4))
+    pose[..., :3, :3] = pose_a[:3, :3] @ so3_exp(s[..., None] * delta)
+    pose[..., :3, 3] = (1 - s)[..., None] * pose_a[:3, 3] + s[..., None] * pose_b[:3, 3]
+    pose[..., 3, 3] = 1.0
+    return pose
+
+def pose_distance(pose_a, pose_b):
+    """
+    Returns the position distance and the geodesic rotation angle between pose(s) a and b
+    """
+    pos_dist = np.linalg.norm(pose_a[..., :3, 3] - pose_b[..., :3, 3], axis=-1)
+    rel_rot = np.swapaxes(pose_a[..., :3, :3], -1, -2) @ pose_b[..., :3, :3]
+    ang_dist = np.linalg.norm(so3_log(rel_rot), axis=-1)
+    return pos_dist, ang_dist
+
+def rel_pose_traj(user_input_traj, command_reference_frame='moving_end_effector'):
+    """
+    Returns the change in the pen's pose wrt its first (anchor) pose as an (N,4,4) array
+
+    fixed_robot_base: pose * anchor^-1
+    moving_end_effector: anchor^-1 * pose
+    """
+    user_input_traj = as_traj(user_input_traj)
+    anchor_inv = inv(user_input_traj[0])
+    if command_reference_frame=='fixed_robot_base':
+        return compose(user_input_traj, anchor_inv)
+    elif command_reference_frame=='moving_end_effector':
+        return compose(anchor_inv, user_input_traj)
+    else:
+        print(f'Wrong Input for command_reference_frame as {command_reference_frame}')
+        return None
+
+def desired_poses(cmd_traj, home_pose, cmd, sf, haptic_R_viewer, viewer_R_robotbase, command_reference_frame='fixed_robot_base'):
+    """
+    Returns the desired robot poses (N,4,4) from the relative commanded trajectory
+
+    Parameters:
+    cmd_traj = (N,4,4) relative trajectory input wrt Haptic Base frame
+    home_pose = starting pose of robot wrt Robot Base frame
+    cmd = (N,4,4) absolute trajectory input, its first pose is the anchor
+    sf = scaling factor for teleoperation
+    haptic_R_viewer = rotation that rewrites a vector in the viewer base frame to the haptic base frame
+    viewer_R_robotbase = rotation that rewrites a vector in the robot base frame to the viewer frame
+    """
+    cmd_traj = scale_translation(as_traj(cmd_traj), sf)
+    home_pose = as_matrix(home_pose)
+    haptic_R_robotbase = compose(as_matrix(haptic_R_viewer), as_matrix(viewer_R_robotbase))
+
+    if command_reference_frame=='fixed_robot_base':
+        return compose(conjugate(inv(haptic_R_robotbase), cmd_traj), home_pose)
+    elif command_reference_frame=='moving_end_effector':
+        # anchor/TCP conjugation: rewrite the relative motion in the robot TCP frame
+        anch_R_haptic = inv(rotation_part(as_traj(cmd)[0]))
+        anch_R_tcp = compose(anch_R_haptic, haptic_R_robotbase, rotation_part(home_pose))
+        return compose(home_pose, conjugate(inv(anch_R_tcp), cmd_traj))
+    else:
+        print(f'Wrong Input for command_reference_frame as {command_reference_frame}')
+        return None
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed cache of pipeline stage results
+
+A stage result is keyed by a hash of the cfg fields the stage depends on and of its
+input arrays (or input files), and saved as .npy files under
+data_saved/.stage_cache/<stage>/<key>/. A rerun with unchanged fields and inputs loads
+the result instead of recomputing it. The least recently used entries are evicted
+when the cache directory grows past its size limit.
+
+Clear the cache (all stages or some):
+    python stage_cache.py clear [stage ...]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+import instrumentation
+
+# bumped when the outputs of a stage change, so older entries are not reused
+CACHE_VERSION = 3
+META = 'meta.json'
+
+def _jsonable(value):
+    if hasattr(value, 'data') and not isinstance(value, np.ndarray):     # spatialmath object
+        value = np.asarray(value.data)
+    if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+        return np.asarray(value).tolist()
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(x) for x in value]
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    return value
+
+def array_digest(array, block_size=1 << 24):
+    """
+    Returns the hex digest of the array dtype, shape and bytes, hashed in blocks
+    so memory-mapped arrays are not loaded at once
+    """
+    array = np.asanyarray(array)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f'{array.dtype.str}{array.shape}'.encode())
+    flat = array.reshape(-1) if array.ndim else array.reshape(1)
+    step = max(1, block_size // max(1, array.itemsize))
+    for start in range(0, len(flat), step):
+        digest.update(np.ascontiguousarray(flat[start:start + step]).tobytes())
+    return digest.hexdigest()
+
+def file_fingerprint(file_path):
+    """
+    Returns a cheap fingerprint of an input file: absolute path, size and mtime
+    """
+    stat = os.stat(file_path)
+    return f'{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+class StageCache:
+    """
+    Cache of stage results
+
+    root = cache directory
+    max_bytes = size limit of the cache directory, None for no limit
+    enabled = False computes every stage and stores nothing
+    force = True recomputes every stage and overwrites its cache entry
+    """
+    def __init__(self, root, max_bytes=None, enabled=True, force=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.force = force
+
+    def key(self, stage, fields, inputs):
+        """
+        Returns the cache key of a stage from its cfg fields (dict) and inputs
+        (dict of arrays, or of strings such as file fingerprints)
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(json.dumps([CACHE_VERSION, stage, _jsonable(fields)], sort_keys=True).encode())
+        for name in sorted(inputs):
+            value = inputs[name]
+            digest.update(name.encode())
+            digest.update((value if isinstance(value, str) else array_digest(np.asanyarray(value))).encode())
+        return digest.hexdigest()
+
+    def _entry(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def get(self, stage, key):
+        """
+        Returns the cached outputs (memory-mapped) or None on a miss
+        """
+        entry = self._entry(stage, key)
+        meta_path = os.path.join(entry, META)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        outputs = {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in meta['outputs']}
+        meta['last_used'] = time.time()
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return outputs
+
+    def put(self, stage, key, outputs):
+        """
+        Saves the outputs (dict of arrays) as the entry of the key, then evicts old entries
+        """
+        entry = self._entry(stage, key)
+        tmp_entry = f'{entry}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        os.makedirs(tmp_entry)
+        size = 0
+        for name, value in outputs.items():
+            file_path = os.path.join(tmp_entry, name + '.npy')
+            np.save(file_path, np.asanyarray(value), allow_pickle=False)
+            size += os.path.getsize(file_path)
+        with open(os.path.join(tmp_entry, META), 'w') as f:
+            json.dump({'stage': stage, 'outputs': list(outputs), 'size': size, 'last_used': time.time()}, f)
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # another process saved the same entry meanwhile
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self.evict()
+
+    def run(self, stage, fields, inputs, compute):
+        """
+        Returns the outputs of compute() (a dict of arrays), loaded from the cache
+        when the stage was already run with the same fields and inputs
+        """
+        if not self.enabled:
+            return compute()
+        key = self.key(stage, fields, inputs)
+        if not self.force:
+            outputs = self.get(stage, key)
+            if outputs is not None:
+                print(f'Cache hit [{stage}]: {key[:12]}')
+                instrumentation.record('cache', stage=stage, key=key, hit=True)
+                return outputs
+        instrumentation.record('cache', stage=stage, key=key, hit=False)
+        outputs = compute()
+        self.put(stage, key, outputs)
+        return outputs
+
+    def entries(self):
+        """
+        Returns (last_used, size, path) of every cache entry
+        """
+        found = []
+        if not os.path.isdir(self.root):
+            return found
+        for stage in os.listdir(self.root):
+            stage_dir = os.path.join(self.root, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for key in os.listdir(stage_dir):
+                meta_path = os.path.join(stage_dir, key, META)
+                if os.path.exists(meta_path):
+                    with open(meta_path) as f:
+                        meta = json.load(f)
+                    found.append((meta['last_used'], meta['size'], os.path.join(stage_dir, key)))
+        return found
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes
+        """
+        if self.max_bytes is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_bytes:
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def clear(self, stages=None):
+        """
+        Removes the entries of the given stages, or the whole cache
+        """
+        if stages is None:
+            shutil.rmtree(self.root, ignore_errors=True)
+        else:
+            for stage in stages:
+                shutil.rmtree(os.path.join(self.root, stage), ignore_errors=True)
+
+def from_config(config):
+    """
+    Returns the stage cache set up by the [Cache] section of the config
+    """
+    return StageCache(config['cache_dir'],
+                      max_bytes=config['cache_max_bytes'],
+                      enabled=config['cache_enabled'],
+                      force=config['cache_force'])
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'clear':
+        sys.exit('usage: python stage_cache.py clear [stage ...]')
+    StageCache(os.path.join('data_saved', '.stage_cache')).clear(sys.argv[2:] or None)
+    print('Stage cache cleared')
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+Real-time streaming teleop
+
+The haptic poses and enable-button events are consumed as they arrive from an
+asyncio queue, and a joint command is emitted at a fixed control rate:
+
+* on a button press the next pose becomes the anchor and the follower continues
+  from its current pose (clutching), on a release the follower holds its pose
+* with a [Filter] cutoff, the pose samples go through a causal low-pass filter
+* every pose sample is mapped to a desired robot pose with the rel_pose_traj and
+  get_desired_poses frame conventions
+* every tick runs at most iters_per_tick adaptive damped least squares iterations
+  (pose_traj_sim.dls_track) towards the latest desired pose
+
+As a stand-in for the device, replay_source plays a recorded session (artifact store
+or <cfg>_user_input_data.npz) at real-time speed:
+    python streaming_teleop.py traj1 [--npz data_saved/traj1_user_input_data.npz] [--duration 10]
+
+The streamed joint commands and the per-tick latencies are saved to the artifact
+store, and the latency percentiles and deadline misses are printed.
+"""
+
+import time
+import asyncio
+import numpy as np
+import teleop_utils as utils
+import se3_batch
+import ur5_kinematics
+import pose_traj_sim as sim
+import pose_filter
+from artifact_store import open_store
+
+LATENCY_PERCENTILES = [50, 90, 99]
+
+class TeleopStream:
+    """
+    Incremental teleop engine: keeps the anchor state and the follower joint state
+
+    config = loaded config, for the frame mapping, the robot home, the kinematics backend and the [Filter]
+    iters_per_tick = solver iteration budget per control tick
+    pose_rate = sample rate [Hz] of the haptic poses for the causal low-pass filter of a [Filter] cutoff
+    """
+    def __init__(self, config, iters_per_tick=10, pose_rate=None):
+        self.config = config
+        self.iters_per_tick = iters_per_tick
+        self.fkine, self.jacob0 = ur5_kinematics.kinematics_backend(config['kinematics_backend'])
+        self.haptic_R_viewer = se3_batch.as_matrix(config['haptic_R_viewer'])
+        self.viewer_R_robotbase = se3_batch.as_matrix(config['viewer_R_robotbase'])
+        self.q = np.array(config['follower_robot_home'], dtype=float)
+        self.alpha = sim.ALPHA_MAX
+        self.engaged = False
+        self.anchor = None
+        self.start_pose = None
+        self.target = None
+        self.converged = True
+        # causal Butterworth filter of the poses, the zero-phase filters need the whole segment
+        self.pose_filter = pose_filter.CausalPoseFilter(config['filter_cutoff'], config['filter_rate'] or pose_rate,
+                                                        order=config['filter_order'])
+
+    def on_button(self, value):
+        """
+        Engages the teleop on a press, the follower holds its pose after a release
+        """
+        if value == 1 and not self.engaged:
+            self.engaged = True
+            self.anchor = None
+            self.start_pose = self.fkine(self.q)
+            self.pose_filter.reset()
+        elif value != 1:
+            self.engaged = False
+
+    def on_pose(self, pose):
+        """
+        Updates the desired robot pose from a (4,4) haptic pose sample
+        """
+        if not self.engaged:
+            return
+        pose = self.pose_filter.update(pose)
+        if self.anchor is None:
+            self.anchor = np.array(pose, dtype=float)
+        rel_pose = se3_batch.rel_pose_traj(np.stack([self.anchor, pose]),
+                                           command_reference_frame=self.config['command_reference_frame'])[1:]
+        self.target = se3_batch.desired_poses(rel_pose, self.start_pose, self.anchor[None],
+                                              self.config['scaling_factor'],
+                                              self.haptic_R_viewer, self.viewer_R_robotbase,
+                                              command_reference_frame=self.config['command_reference_frame'])[0]
+
+    def tick(self):
+        """
+        Returns the joint command of this tick, after at most iters_per_tick solver iterations
+        """
+        if self.target is not None:
+            (self.q, self.alpha, _, self.converged, _) = sim.dls_track(
+                self.target, self.q, self.fkine, self.jacob0, alpha=self.alpha, max_iters=self.iters_per_tick)
+        return self.q
+
+def replay_events(data, enable_button):
+    """
+    Returns the time stamps (N,), kinds (N,) (0 = button, 1 = pose) and row indices (N,)
+    of the recorded button and pose messages in chronological order, a button
+    event is played before a pose message of the same time stamp
+    """
+    button, pose_time = data[enable_button], data['pose_msg'][:,0]
+    stamps = np.concatenate([button[:,0], pose_time])
+    kinds = np.concatenate([np.zeros(len(button), dtype=int), np.ones(len(pose_time), dtype=int)])
+    rows = np.concatenate([np.arange(len(button)), np.arange(len(pose_time))])
+    order = np.lexsort((kinds, stamps))
+    return stamps[order], kinds[order], rows[order]
+
+async def replay_source(data, enable_button, queue, speed=1.0, duration=None):
+    """
+    Plays a recorded session into the queue at real-time speed (times speed), as a
+    stand-in for the haptic device. Puts ('button', value, t_arrival) and
+    ('pose', (4,4) pose, t_arrival) events, then None at the end of the session
+    """
+    stamps, kinds, rows = replay_events(data, enable_button)
+    button, user_input_traj = data[enable_button], data['user_input_traj']
+    start = time.perf_counter()
+    for stamp, kind, row in zip(stamps - stamps[0], kinds, rows):
+        if duration is not None and stamp > duration:
+            break
+        delay = stamp / speed - (time.perf_counter() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if kind == 0:
+            queue.put_nowait(('button', button[row,1], time.perf_counter()))
+        else:
+            queue.put_nowait(('pose', np.array(user_input_traj[row]), time.perf_counter()))
+    queue.put_nowait(None)
+
+async def control_loop(engine, queue, rate, sink=None):
+    """
+    Returns the per-tick log of the control loop: emits one joint command per period
+    of the control rate until the source puts None
+
+    sink = optional callable(t, q), e.g. publishing the joint command to the robot
+    """
+    period = 1.0 / rate
+    log = {'time': [], 'joint': [], 'engaged': [], 'converged': [], 'latency': [], 'command_latency': []}
+    start = time.perf_counter()
+    scheduled = start
+    done = False
+    while not done:
+        tick_start = time.perf_counter()
+        pose_arrival = None
+        while not queue.empty():
+            event = queue.get_nowait()
+            if event is None:
+                done = True
+                break
+            if event[0] == 'button':
+                engine.on_button(event[1])
+            else:
+                engine.on_pose(event[1])
+                pose_arrival = event[2]
+        q = engine.tick()
+        if sink is not None:
+            sink(tick_start - start, q)
+        emitted = time.perf_counter()
+
+        log['time'].append(scheduled - start)
+        log['joint'].append(q.copy())
+        log['engaged'].append(engine.engaged)
+        log['converged'].append(engine.converged)
+        # tick compute time, and age of the newest pose sample when its command is emitted
+        log['latency'].append(emitted - tick_start)
+        log['command_latency'].append(np.nan if pose_arrival is None else emitted - pose_arrival)
+
+        scheduled += period
+        if emitted > scheduled + period:
+            scheduled = emitted     # drop the ticks that can no longer be on time
+        await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+    return log
+
+def stream(config, data, rate=125.0, iters_per_tick=10, speed=1.0, duration=None, sink=None):
+    """
+    Returns the per-tick log of a replayed session streamed through the teleop engine
+    (arrays: time, joint, engaged, converged, latency, command_latency) and its latency summary
+    """
+    engine = TeleopStream(config, iters_per_tick=iters_per_tick,
+                          pose_rate=pose_filter.sample_rate(data['pose_msg'][:,0]))
+
+    async def session():
+        queue = asyncio.Queue()
+        source = asyncio.create_task(replay_source(data, config['enable_button'], queue, speed=speed, duration=duration))
+        log = await control_loop(engine, queue, rate, sink=sink)
+        await source
+        return log
+
+    log = {key: np.array(value) for key, value in asyncio.run(session()).items()}
+    return log, latency_summary(log, rate)
+
+def latency_summary(log, rate):
+    """
+    Returns the latency percentiles [s] of the ticks and of the commands,
+    and the number of ticks that missed their deadline (computed longer than a period)
+    """
+    summary = {'ticks': len(log['latency']), 'deadline_misses': int(np.count_nonzero(log['latency'] > 1.0 / rate))}
+    command_latency = log['command_latency'][~np.isnan(log['command_latency'])]
+    for p in LATENCY_PERCENTILES:
+        summary[f'latency_p{p}'] = float(np.percentile(log['latency'], p)) if len(log['latency']) else np.nan
+        summary[f'command_latency_p{p}'] = float(np.percentile(command_latency, p)) if len(command_latency) else np.nan
+    summary['latency_max'] = float(np.max(log['latency'])) if len(log['latency']) else np.nan
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Stream a recorded session through the teleop engine in real time')
+    parser.add_argument('config', help='config name, e.g. traj1')
+    parser.add_argument('--npz', default=None, help='replay a _user_input_data.npz instead of the artifact store')
+    parser.add_argument('--duration', type=float, default=None, help='replay only the first seconds of the session')
+    args = parser.parse_args()
+
+    config = utils.load_config(args.config)
+    store = open_store(config)
+    data = store if args.npz is None else np.load(args.npz)
+    print(f"Streaming {config['name']} at {config['stream_rate']} Hz, "
+          f"{config['stream_iters_per_tick']} iterations per tick, replay speed x{config['replay_speed']}")
+    log, summary = stream(config, data, rate=config['stream_rate'], iters_per_tick=config['stream_iters_per_tick'],
+                          speed=config['replay_speed'], duration=args.duration)
+
+    store.save('stream',
+               stream_time=log['time'],
+               stream_joint_traj=log['joint'],
+               stream_engaged=log['engaged'],
+               stream_converged=log['converged'],
+               stream_tick_latency=log['latency'],
+               stream_command_latency=log['command_latency'])
+
+    print(f"Ticks: {summary['ticks']}, deadline misses: {summary['deadline_misses']}")
+    print('Tick latency [ms]: ' + ', '.join(f"p{p} {1e3 * summary[f'latency_p{p}']:.3f}" for p in LATENCY_PERCENTILES)
+          + f", max {1e3 * summary['latency_max']:.3f}")
+    print('Command latency [ms]: ' + ', '.join(f"p{p} {1e3 * summary[f'command_latency_p{p}']:.3f}" for p in LATENCY_PERCENTILES))
+    print("Artifacts Saved In: ", store.path)
@@ -2,154 +2,234 @@
 
 import os
 import sys
+import functools
 import configparser
 import numpy as np
-from spatialmath import *
-import matplotlib.pyplot as plt
 import ast
-import ipdb
-
-def load_config():
-    config_file_name = sys.argv[1]
-    config_file_path = os.path.join('config',config_file_name+'.cfg')
+import trajectory_export
+import feasibility
+
+# roboticstoolbox, spatialmath and matplotlib take seconds to import: they are only
+# imported by the functions that need them, so the CLI scripts start fast
+
+@functools.lru_cache(maxsize=None)
+def get_robot():
+    """
+    Returns the roboticstoolbox UR5 model, built once per process
+    """
+    import roboticstoolbox as rtb
+    return rtb.models.UR5()
+
+def rotation_to_se3(rotation):
+    """
+    Returns the (4,4) ndarray of a 3x3 rotation given as nested lists,
+    or the identity if it is not a valid rotation matrix
+    """
+    pose = np.identity(4)
+    try:
+        rot = np.array([np.array(i) for i in rotation], dtype=float)
+        if rot.shape == (3,3) and np.allclose(rot @ rot.T, np.identity(3)) and np.linalg.det(rot) > 0:
+            pose[:3,:3] = rot
+    except (TypeError, ValueError):
+        pass
+    return pose
+
+def load_config(config_file_name=None, config_dir='config'):
+    # the config name is the first command line argument unless given
+    if config_file_name is None:
+        config_file_name = sys.argv[1]
+    config_file_path = os.path.join(config_dir,config_file_name+'.cfg')
     config = configparser.ConfigParser()
     config.read(config_file_path)
     
     # file paths
     rosbag_file_path = os.path.join('data_saved',config['General']['user_input_rosbag']+'.bag')
     user_input_data_path = os.path.join('data_saved',config_file_name+'_user_input_data.npz')
+    artifact_store_path = os.path.join('data_saved',config_file_name+'_artifacts')
     teleop_command_data_path = os.path.join('data_saved',config_file_name+'_teleop_command_data.npz')
     yaml_file_path = os.path.join('data_saved',config_file_name+'.yaml')
+    segment_data_path = os.path.join('data_saved',config_file_name+'_segments.npz')
     
     sf = ast.literal_eval(config['General']['scaling_factor'])
 
     # get the viewer perspective frames 
-    haptic_R_viewer = ast.literal_eval(config['General']['haptic_R_viewer'])
-    try:    # Returns identity SE(3) if the user input rotation is invalid
-        haptic_R_viewer = SE3(SO3(np.array([np.array(i) for i in haptic_R_viewer])))
-    except:
-        haptic_R_viewer = SE3(SO3())
-
-    viewer_R_robotbase = ast.literal_eval(config['General']['viewer_R_robotbase'])
-    try:    # Returns identity SE(3) if the user input rotation is invalid
-        viewer_R_robotbase = SE3(SO3(np.array([np.array(i) for i in viewer_R_robotbase])))
-    except:
-        viewer_R_robotbase = SE3(SO3())
+    # as (4,4) ndarrays, identity SE(3) if the user input rotation is invalid
+    haptic_R_viewer = rotation_to_se3(ast.literal_eval(config['General']['haptic_R_viewer']))
+    viewer_R_robotbase = rotation_to_se3(ast.literal_eval(config['General']['viewer_R_robotbase']))
 
     # Get the robot home joint state
     q_home = np.radians(np.array(ast.literal_eval(config['Robot']['joint_states_home'])))
+    # 'rtb' (roboticstoolbox model), 'ets' (same model, batched in batch_kinematics.py)
+    # or 'ur5' (closed-form kernel in ur5_kinematics.py)
+    kinematics_backend = config['Robot'].get('kinematics_backend', 'rtb')
+
+    # Number of pose messages kept in memory while extracting a rosbag, None keeps the whole bag
+    extract_chunk_size = ast.literal_eval(config['General'].get('extract_chunk_size', 'None'))
+
+    # Resolved rate solver: 'fixed_dt' (default), 'adaptive_dls' or 'feedforward', optional per-waypoint iteration budget
+    solver_mode = config.get('Solver', 'solver_mode', fallback='fixed_dt')
+    solver_max_iters = ast.literal_eval(config.get('Solver', 'max_iters', fallback='None'))
+    # Waypoint decimation tolerance [position (m), orientation (deg)], None keeps every waypoint
+    waypoint_tolerance = ast.literal_eval(config.get('Solver', 'waypoint_tolerance', fallback='None'))
+    if waypoint_tolerance is not None:
+        waypoint_tolerance = (float(waypoint_tolerance[0]), np.radians(float(waypoint_tolerance[1])))
+
+    # Stage cache: on by default, size limit of the cache directory, force recomputing every stage
+    cache_enabled = config.getboolean('Cache', 'enabled', fallback=True)
+    cache_max_bytes = int(config.getfloat('Cache', 'max_size_mb', fallback=2048) * 1024 * 1024)
+    cache_force = config.getboolean('Cache', 'force', fallback=False)
+
+    # Streaming teleop: control rate (Hz), solver iterations per tick, replay speed of the recorded session
+    stream_rate = config.getfloat('Stream', 'control_rate', fallback=125.0)
+    stream_iters_per_tick = config.getint('Stream', 'iters_per_tick', fallback=10)
+    replay_speed = config.getfloat('Stream', 'replay_speed', fallback=1.0)
+
+    # Opt-in instrumentation (see instrumentation.py), traces appended to data_saved/<cfg>_trace.jsonl
+    trace_enabled = config.getboolean('Trace', 'enabled', fallback=False)
+
+    # Joint trajectory export: 'yaml' (default schema), 'yaml_flow', 'csv' or 'bin' (float32, optionally compressed)
+    export_format = config.get('Export', 'format', fallback='yaml')
+    export_compress = config.getboolean('Export', 'compress', fallback=False)
+    export_extension = trajectory_export.EXTENSIONS.get(export_format, '.yaml')
+
+    # Resampling of the solver output to a control rate (Hz), None keeps the solver log
+    control_rate = ast.literal_eval(config.get('Resample', 'control_rate', fallback='None'))
+    resample_method = config.get('Resample', 'method', fallback='cubic')
+    # Joint tolerance (deg) to drop the control points reproduced by linear interpolation, None keeps them all
+    resample_tolerance = ast.literal_eval(config.get('Resample', 'joint_tolerance', fallback='None'))
+    if resample_tolerance is not None:
+        resample_tolerance = np.radians(float(resample_tolerance))
+
+    # Low-pass filter of the haptic input poses (pose_filter.py): cutoff (Hz), None for the raw poses
+    filter_cutoff = ast.literal_eval(config.get('Filter', 'cutoff', fallback='None'))
+    filter_method = config.get('Filter', 'method', fallback='butter')
+    filter_order = config.getint('Filter', 'order', fallback=2)
+    # sample rate (Hz) of the haptic poses, None to estimate it from the time stamps
+    filter_rate = ast.literal_eval(config.get('Filter', 'sample_rate', fallback='None'))
+
+    # Figures saved by the plotting functions (traj_plot.py): file format and frame triads drawn along a trajectory
+    plot_format = config.get('Plot', 'format', fallback='png')
+    plot_frames = config.getint('Plot', 'frames', fallback=20)
+
+    # Feasibility check of the exported joint trajectory (feasibility.py): limits in deg/s, deg/s^2, m
+    feasibility_strict = config.getboolean('Feasibility', 'refuse_export', fallback=False)
+    def feasibility_limit(key, default):
+        return np.radians(np.array(ast.literal_eval(config['Feasibility'][key]), dtype=float)) if config.has_option('Feasibility', key) else default
+    feasibility_qd_max = feasibility_limit('joint_velocity_limit', feasibility.QD_MAX)
+    feasibility_qdd_max = feasibility_limit('joint_acceleration_limit', feasibility.QDD_MAX)
+    feasibility_inv_cond_min = config.getfloat('Feasibility', 'min_inv_cond_num', fallback=feasibility.INV_COND_MIN)
+    feasibility_reach = config.getfloat('Feasibility', 'reach', fallback=feasibility.REACH)
+    feasibility_z_min = ast.literal_eval(config.get('Feasibility', 'z_min', fallback='None'))
+
+    # Parameter sweep (parameter_sweep.py): the values tried for each mapping parameter, the cfg value by default
+    def sweep_values(key, default):
+        return ast.literal_eval(config['Sweep'][key]) if config.has_option('Sweep', key) else [default]
+    sweep_grid = {
+        'scaling_factor': [float(value) for value in sweep_values('scaling_factor', sf)],
+        'haptic_R_viewer': [rotation_to_se3(value) for value in sweep_values('haptic_R_viewer', haptic_R_viewer[:3,:3].tolist())],
+        'viewer_R_robotbase': [rotation_to_se3(value) for value in sweep_values('viewer_R_robotbase', viewer_R_robotbase[:3,:3].tolist())],
+        'command_reference_frame': sweep_values('command_reference_frame', config['General']['command_reference_frame']),
+        'follower_robot_home': [np.radians(np.array(value, dtype=float)) for value in sweep_values('joint_states_home', np.degrees(q_home).tolist())],
+    }
 
     # output
     config_data = {
         'name':config_file_name,
         'user_input_rosbag': rosbag_file_path,
         'user_input_data': user_input_data_path,
+        'artifact_store': artifact_store_path,
         'enable_button' : config['General']['enable_button'],
         'teleop_command_data': teleop_command_data_path,
         'haptic_R_viewer': haptic_R_viewer,
         'viewer_R_robotbase': viewer_R_robotbase,        
         'scaling_factor': sf,
         'follower_robot_home': q_home,
+        'kinematics_backend': kinematics_backend,
+        'solver_mode': solver_mode,
+        'solver_max_iters': solver_max_iters,
+        'waypoint_tolerance': waypoint_tolerance,
         'yaml_file_path': yaml_file_path,
-        'command_reference_frame': config['General']['command_reference_frame']
+        'segment_data': segment_data_path,
+        'extract_chunk_size': extract_chunk_size,
+        # 'independent': every segment starts at home, 'chained': at the last desired pose of the previous segment
+        'segment_start': config['General'].get('segment_start', 'independent'),
+        'command_reference_frame': config['General']['command_reference_frame'],
+        'cache_dir': os.path.join('data_saved','.stage_cache'),
+        'cache_enabled': cache_enabled,
+        'cache_max_bytes': cache_max_bytes,
+        'cache_force': cache_force,
+        'stream_rate': stream_rate,
+        'stream_iters_per_tick': stream_iters_per_tick,
+        'replay_speed': replay_speed,
+        'sweep_grid': sweep_grid,
+        'control_rate': control_rate,
+        'resample_method': resample_method,
+        'resample_tolerance': resample_tolerance,
+        'filter_cutoff': filter_cutoff,
+        'filter_method': filter_method,
+        'filter_order': filter_order,
+        'filter_rate': filter_rate,
+        'plot_format': plot_format,
+        'plot_frames': plot_frames,
+        'feasibility_strict': feasibility_strict,
+        'feasibility_qd_max': feasibility_qd_max,
+        'feasibility_qdd_max': feasibility_qdd_max,
+        'feasibility_inv_cond_min': feasibility_inv_cond_min,
+        'feasibility_reach': feasibility_reach,
+        'feasibility_z_min': feasibility_z_min,
+        'export_format': export_format,
+        'export_compress': export_compress,
+        'export_file_path': os.path.join('data_saved',config_file_name+export_extension),
+        'trace_enabled': trace_enabled,
+        'trace_file': os.path.join('data_saved',config_file_name+'_trace.jsonl'),
     }
     return config_data
 
 def ndarray_to_se3(nd_array: np.ndarray):
-    return SE3([SE3(nd_array[i,:,:]) for i in range(nd_array.shape[0])])
-
-def se3_to_ndarray(se3_array: SE3):
-    return np.array([np.array(x) for x in se3_array])
-
-def animate_user_input(user_input_traj:SE3,plt_title):
-    fig = plt.figure()
-    ax = fig.add_subplot(111, projection='3d')
-    plt.title(plt_title)
-    user_input_traj[0].plot(frame='st', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    user_input_traj.animate(frame='i', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    plt.show(block=False)
-    input(f'Animation [{plt_title}] displayed')
-
-def plot_user_input_pose(index,abs_traj,rel_traj):
-    fig = plt.figure()
-    ax = fig.add_subplot(121, projection='3d')
-    abs_traj[0].plot(frame='st', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    abs_traj[index].plot(frame='i', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    plt.title('User Input Traj')
-    
-    ax = fig.add_subplot(122, projection='3d')
-    rel_traj[0].plot(frame='st', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    rel_traj[index].plot(frame='i', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    plt.title('User Input Traj (Relative)')
-
-    plt.show(block=False)
-    input(f'User Input Pose [{index}] displayed')
-
-def plot_user_input_traj(abs_traj,rel_traj, skip_N=75):
-    fig = plt.figure()
-    ax = fig.add_subplot(121, projection='3d')
-    abs_traj[0].plot(frame='st', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    abs_traj[-1].plot(frame='end', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    plt.title('User Input Traj')
-    abs_traj_nd = se3_to_ndarray(abs_traj)
-    ax.plot(
-        abs_traj_nd[::skip_N,0,3],
-        abs_traj_nd[::skip_N,1,3],
-        abs_traj_nd[::skip_N,2,3],
-        label='trajectory curve'
-        )
-
-    ax = fig.add_subplot(122, projection='3d')
-    rel_traj[0].plot(frame='st', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    rel_traj[-1].plot(frame='end', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    plt.title('User Input Traj (Relative)')
-    rel_traj_nd = se3_to_ndarray(rel_traj)
-    ax.plot(
-        rel_traj_nd[::skip_N,0,3],
-        rel_traj_nd[::skip_N,1,3],
-        rel_traj_nd[::skip_N,2,3],
-        label='trajectory curve'
-        )
-    plt.show(block=False)
-    input(f'User Input Traj displayed')
-
-def plot_haptic_robot_traj(hap_traj,rob_traj, skip_N=75):
-    fig = plt.figure()
-    ax = fig.add_subplot(121, projection='3d')
-    hap_traj[0].plot(frame='st', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    hap_traj[-1].plot(frame='end', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    plt.title('User Input (Haptic) Traj')
-    hap_traj_nd = se3_to_ndarray(hap_traj)
-    ax.plot(
-        hap_traj_nd[::skip_N,0,3],
-        hap_traj_nd[::skip_N,1,3],
-        hap_traj_nd[::skip_N,2,3],
-        label='trajectory curve'
-        )
-
-    ax = fig.add_subplot(122, projection='3d')
-    rob_traj[0].plot(frame='st', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    rob_traj[-1].plot(frame='end', style='rgb', axislabel=False, originsize=50, length=0.1, flo=(-0.01,-0.01,-0.01))
-    plt.title('UR5 TCP Traj')
-    rob_traj_nd = se3_to_ndarray(rob_traj)
-    ax.plot(
-        rob_traj_nd[::skip_N,0,3],
-        rob_traj_nd[::skip_N,1,3],
-        rob_traj_nd[::skip_N,2,3],
-        label='trajectory curve'
-        )
-    plt.show(block=False)
-    input(f'Trajectory Comparison displayed')
-
-def parametrized_plot(y_data, data_title, plt_title):
-    t_data = [i/(len(y_data)-1) for i in range(len(y_data))]
-    plt.plot(t_data, y_data, linestyle='-', color='b', label=data_title)
-
-    plt.xlabel('t')
-    plt.ylabel(data_title)
-    plt.title(plt_title)
-    plt.legend()
-
-    # Display the Plot
-    plt.show(block=False)
-    input(f'Trajectory Comparison displayed')
\ No newline at end of file
+    from spatialmath import SE3
+    # build the multi-valued SE3 in one go, the arrays come from our own (batched) transforms
+    return SE3(list(np.asarray(nd_array, dtype=float).reshape(-1,4,4)), check=False)
+
+def se3_to_ndarray(se3_array):
+    return np.asarray(se3_array.data, dtype=float)
+
+def animate_user_input(user_input_traj, plt_title, time_stamps, gif_path):
+    """
+    Renders the poses (SE3 or (N,4,4) ndarray) with time stamps (N,) to an animated GIF
+    """
+    import traj_plot
+    return traj_plot.animate_pose_traj(user_input_traj, gif_path, time_stamps, title=plt_title)
+
+def plot_user_input_pose(index, abs_traj, rel_traj, file_path):
+    """
+    Saves the figure of the user input pose at index on the absolute and relative trajectories
+    """
+    import traj_plot
+    figure = traj_plot.traj_figure([('User Input Traj', abs_traj), ('User Input Traj (Relative)', rel_traj)], index=index)
+    return traj_plot.save_figure(figure, file_path)
+
+def plot_user_input_traj(abs_traj, rel_traj, file_path, n_frames=20):
+    """
+    Saves the figure of the absolute and relative user input trajectories, decimated by arc length
+    """
+    import traj_plot
+    figure = traj_plot.traj_figure([('User Input Traj', abs_traj), ('User Input Traj (Relative)', rel_traj)],
+                                   n_frames=n_frames)
+    return traj_plot.save_figure(figure, file_path)
+
+def plot_haptic_robot_traj(hap_traj, rob_traj, file_path, n_frames=20):
+    """
+    Saves the figure of the user input (haptic) and UR5 TCP trajectories, decimated by arc length
+    """
+    import traj_plot
+    figure = traj_plot.traj_figure([('User Input (Haptic) Traj', hap_traj), ('UR5 TCP Traj', rob_traj)],
+                                   n_frames=n_frames)
+    return traj_plot.save_figure(figure, file_path)
+
+def parametrized_plot(y_data, data_title, plt_title, file_path):
+    """
+    Saves the figure of the series over the normalized parameter t in [0, 1]
+    """
+    import traj_plot
+    t_data = np.linspace(0.0, 1.0, len(y_data))
+    return traj_plot.save_figure(traj_plot.series_figure(t_data, y_data, data_title, plt_title), file_path)
@@ -0,0 +1,42 @@
+"""
+Parity of the closed-form UR5 kinematics with rtb.models.UR5() over seeded random configurations
+"""
+
+import numpy as np
+import pytest
+import ur5_kinematics
+
+N_SAMPLES = 200
+TOL = 1e-9
+
+@pytest.fixture(scope='module')
+def robot():
+    rtb = pytest.importorskip('roboticstoolbox')
+    try:
+        # the URDF comes from a robot_descriptions download, unavailable offline
+        return rtb.models.UR5()
+    except Exception as error:
+        pytest.skip(f'rtb.models.UR5() could not be loaded: {error}')
+
+@pytest.fixture(scope='module')
+def q_samples():
+    return np.random.default_rng(0).uniform(-np.pi, np.pi, size=(N_SAMPLES, 6))
+
+def test_fkine_batch(robot, q_samples):
+    expected = np.array([robot.fkine(q).A for q in q_samples])
+    np.testing.assert_allclose(ur5_kinematics.fkine(q_samples), expected, rtol=0, atol=TOL)
+
+def test_jacob0_batch(robot, q_samples):
+    expected = np.array([robot.jacob0(q) for q in q_samples])
+    np.testing.assert_allclose(ur5_kinematics.jacob0(q_samples), expected, rtol=0, atol=TOL)
+
+def test_single_configuration(robot, q_samples):
+    # the scalar fast paths of fkine and jacob0
+    for q in q_samples[:20]:
+        np.testing.assert_allclose(ur5_kinematics.fkine(q), robot.fkine(q).A, rtol=0, atol=TOL)
+        np.testing.assert_allclose(ur5_kinematics.jacob0(q), robot.jacob0(q), rtol=0, atol=TOL)
+
+def test_kinematics_backend(q_samples):
+    fkine, jacob0 = ur5_kinematics.kinematics_backend('ur5')
+    np.testing.assert_allclose(fkine(q_samples), ur5_kinematics.fkine(q_samples), rtol=0, atol=0)
+    np.testing.assert_allclose(jacob0(q_samples), ur5_kinematics.jacob0(q_samples), rtol=0, atol=0)
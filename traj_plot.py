@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+Plots of pose trajectories saved to files, without a display or a prompt
+
+Replaces the SE3.plot / SE3.animate calls of teleop_utils on every pose, each one
+followed by an input() prompt. Here:
+
+* the poses are raw (N,4,4) arrays, a spatialmath SE3 is converted once
+* the trajectory is decimated by arc length instead of every skip_N-th pose: the kept
+  poses are evenly spaced along the path, a rotation counting as the motion of the tip
+  of a frame axis, so still segments of a long session collapse to a few poses and
+  fast motions keep their detail
+* the frame triads of all the kept poses are one Line3DCollection (3 segments per pose)
+* the figures are drawn on an Agg canvas (no display needed) and saved as PNG, SVG,
+  PDF or HTML (the SVG inline in a page)
+* the animations are decimated to a frame rate and written to a GIF as in
+  animation_render.py, only the moving frame is redrawn (blitting)
+
+Plot the command trajectory in the artifact store of a cfg with:
+    python traj_plot.py traj1 [--format svg]
+"""
+
+import os
+import io
+import numpy as np
+import se3_batch
+import animation_render
+
+FORMATS = ['png', 'svg', 'pdf', 'html']
+# poses kept for the path line and frame triads drawn along it
+PATH_POINTS = 500
+FRAMES = 20
+# length of the frame axes, as a share of the size of the trajectory
+AXIS_SCALE = 0.08
+FIGSIZE = (12, 6)
+DPI = 100
+AXIS_COLORS = ['tab:red', 'tab:green', 'tab:blue']
+
+def as_pose_array(pose_traj):
+    """
+    Returns the (N,4,4) ndarray of the poses, given as an ndarray or a spatialmath SE3
+    """
+    return se3_batch.as_traj(pose_traj)
+
+def arc_length(pose_traj, rot_length=0.0):
+    """
+    Returns the cumulative arc length (N,) [m] along the poses (N,4,4),
+    a rotation angle counting rot_length [m/rad]
+    """
+    if len(pose_traj) < 2:
+        return np.zeros(len(pose_traj))
+    delta_p, angle = se3_batch.pose_distance(pose_traj[:-1], pose_traj[1:])
+    return np.r_[0.0, np.cumsum(delta_p + rot_length * angle)]
+
+def even_index(s, n_points):
+    """
+    Returns the sorted indices of at most n_points samples evenly spaced along the cumulative
+    length s (N,), the first and last ones included (all the samples if there are no more than n_points)
+    """
+    n_samples = len(s)
+    if n_samples <= n_points:
+        return np.arange(n_samples)
+    index = np.searchsorted(s, np.linspace(0.0, s[-1], max(n_points, 2)))
+    # a curve that does not move is drawn by its end points
+    return np.unique(np.r_[np.minimum(index, n_samples - 1), n_samples - 1])
+
+def arc_length_index(pose_traj, n_points, rot_length=0.0):
+    """
+    Returns the sorted indices of at most n_points poses (N,4,4) evenly spaced along the arc length
+    """
+    if len(pose_traj) <= n_points:
+        return np.arange(len(pose_traj))
+    return even_index(arc_length(pose_traj, rot_length), n_points)
+
+def axis_length(pose_traj):
+    """
+    Returns the length [m] of the frame axes drawn on the trajectory, AXIS_SCALE of its largest extent
+    """
+    extent = np.ptp(pose_traj[:,:3,3], axis=0).max() if len(pose_traj) else 0.0
+    return AXIS_SCALE * extent if extent > 0 else 0.01
+
+def frame_segments(pose_traj, length):
+    """
+    Returns the (3N,2,3) x, y, z axis segments of the frames of the poses (N,4,4) and their (3N,) colors
+    """
+    origin = pose_traj[:,:3,3]
+    # the columns of the rotations are the axes
+    tips = origin[:,None] + length * np.swapaxes(pose_traj[:,:3,:3], 1, 2)
+    segments = np.stack([np.broadcast_to(origin[:,None], tips.shape), tips], axis=2).reshape(-1, 2, 3)
+    return segments, AXIS_COLORS * len(pose_traj)
+
+def _set_equal_limits(ax, points):
+    # equal scale on the 3 axes, centered on the points
+    low, high = points.min(axis=0), points.max(axis=0)
+    center, half = (low + high) / 2, max((high - low).max() / 2, 1e-3)
+    ax.set_xlim(center[0] - half, center[0] + half)
+    ax.set_ylim(center[1] - half, center[1] + half)
+    ax.set_zlim(center[2] - half, center[2] + half)
+    ax.set_box_aspect((1, 1, 1))
+
+def draw_traj(ax, pose_traj, title='', n_frames=FRAMES, n_points=PATH_POINTS, index=None):
+    """
+    Draws the poses (N,4,4) on the 3D axes: the path of the positions, the frames of n_frames
+    poses spread along it and the start and end frames. With an index, only the start frame and
+    the frame of that pose are drawn on the path
+    """
+    from mpl_toolkits.mplot3d.art3d import Line3DCollection
+
+    pose_traj = as_pose_array(pose_traj)
+    length = axis_length(pose_traj)
+    path = pose_traj[arc_length_index(pose_traj, n_points), :3, 3]
+    ax.plot(path[:,0], path[:,1], path[:,2], color='tab:gray', linewidth=1, label='trajectory curve')
+    marked = {'st': 0, 'end': len(pose_traj) - 1} if index is None else {'st': 0, 'i': index}
+    if index is None and n_frames:
+        segments, colors = frame_segments(pose_traj[arc_length_index(pose_traj, n_frames, rot_length=length)], length)
+        ax.add_collection3d(Line3DCollection(segments, colors=colors, linewidths=0.8))
+    segments, colors = frame_segments(pose_traj[list(marked.values())], 1.5 * length)
+    ax.add_collection3d(Line3DCollection(segments, colors=colors, linewidths=2.5))
+    for label, k in marked.items():
+        ax.text(*(pose_traj[k,:3,3] - length / 4), label)
+    _set_equal_limits(ax, np.concatenate([path, segments.reshape(-1, 3)]))
+    ax.set_xlabel('X')
+    ax.set_ylabel('Y')
+    ax.set_zlabel('Z')
+    ax.set_title(title)
+
+def traj_figure(panels, n_frames=FRAMES, n_points=PATH_POINTS, index=None, figsize=FIGSIZE, dpi=DPI):
+    """
+    Returns the Agg figure with one 3D subplot per (title, pose_traj) panel, see draw_traj
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=figsize, dpi=dpi, layout='constrained')
+    FigureCanvasAgg(figure)
+    for k, (title, pose_traj) in enumerate(panels):
+        ax = figure.add_subplot(1, len(panels), k + 1, projection='3d')
+        draw_traj(ax, pose_traj, title, n_frames=n_frames, n_points=n_points, index=index)
+    return figure
+
+def series_figure(t_data, y_data, data_title, plt_title, n_points=2 * PATH_POINTS, figsize=(8, 5), dpi=DPI):
+    """
+    Returns the Agg figure of the series (N,) against t_data (N,), decimated to n_points
+    by arc length along the normalized curve
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    t_data, y_data = np.asarray(t_data, dtype=float), np.asarray(y_data, dtype=float)
+    curve = np.column_stack([t_data, y_data])
+    span = np.ptp(curve, axis=0) if len(curve) else np.ones(2)
+    steps = np.linalg.norm(np.diff(curve, axis=0) / np.where(span > 0, span, 1.0), axis=1)
+    index = even_index(np.r_[0.0, np.cumsum(steps)], n_points)
+    figure = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    ax.plot(t_data[index], y_data[index], linestyle='-', color='b', label=data_title)
+    ax.set_xlabel('t')
+    ax.set_ylabel(data_title)
+    ax.set_title(plt_title)
+    ax.legend()
+    return figure
+
+def save_figure(figure, file_path):
+    """
+    Saves the figure to file_path, the format from its extension (png, svg, pdf or html)
+    """
+    extension = os.path.splitext(file_path)[1][1:].lower()
+    if extension not in FORMATS:
+        raise ValueError(f'Unknown figure format {extension}, use one of {FORMATS}')
+    if extension == 'html':
+        svg = io.StringIO()
+        figure.savefig(svg, format='svg')
+        title = os.path.splitext(os.path.basename(file_path))[0]
+        # the svg element alone, without the XML prolog
+        svg = svg.getvalue()[svg.getvalue().index('<svg'):]
+        with open(file_path, 'w') as f:
+            f.write(f'<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>{title}</title></head>\n'
+                    f'<body>\n{svg}\n</body>\n</html>\n')
+    else:
+        figure.savefig(file_path)
+    print("File Saved As: ", file_path)
+    return file_path
+
+def plot_file_path(config, name):
+    """
+    Returns the path data_saved/<cfg>_<name>.<format> of a figure, in the [Plot] format of the cfg
+    """
+    return os.path.join('data_saved', f"{config['name']}_{name}.{config['plot_format']}")
+
+class PoseRenderer:
+    """
+    Agg canvas of a pose trajectory animation: the path, the start frame and the moving frame,
+    with the background drawn once and only the moving frame redrawn on every frame
+    """
+    def __init__(self, pose_traj, title='', n_points=PATH_POINTS, figsize=(6, 6), dpi=animation_render.DPI):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.title = title
+        self.length = 1.5 * axis_length(pose_traj)
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(projection='3d')
+        draw_traj(self.ax, pose_traj, n_frames=0, n_points=n_points)
+        self.axis_lines = [self.ax.plot([], [], [], color=color, linewidth=2.5, animated=True)[0]
+                           for color in AXIS_COLORS]
+        self.title_text = self.ax.set_title(title, animated=True)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+
+    def render(self, pose, frame_time):
+        """
+        Returns the RGB image (H,W,3) uint8 of the frame showing the (4,4) pose
+        """
+        segments, _ = frame_segments(pose[None], self.length)
+        for line, segment in zip(self.axis_lines, segments):
+            line.set_data_3d(segment[:,0], segment[:,1], segment[:,2])
+        self.title_text.set_text(f'{self.title}  t = {frame_time:.2f} s')
+        self.canvas.restore_region(self.background)
+        for artist in (*self.axis_lines, self.title_text):
+            self.ax.draw_artist(artist)
+        return np.asarray(self.canvas.buffer_rgba())[..., :3].copy()
+
+def animate_pose_traj(pose_traj, gif_path, time_stamps, fps=animation_render.FPS, title=''):
+    """
+    Renders the poses (N,4,4) with time stamps (N,) to an animated GIF at fps, the pose shown
+    in a frame being the latest one at its time. Returns the number of frames
+    """
+    pose_traj = as_pose_array(pose_traj)
+    frame_time, index = animation_render.frame_index(time_stamps, fps)
+    renderer = PoseRenderer(pose_traj, title)
+    frames = (renderer.render(pose_traj[k], t) for k, t in zip(index, frame_time - frame_time[0]))
+    n_frames = animation_render.write_gif(gif_path, frames, fps)
+    print("Animation Saved As: ", gif_path)
+    return n_frames
+
+
+if __name__ == '__main__':
+    import argparse
+    import teleop_utils as utils
+    from artifact_store import open_store
+
+    parser = argparse.ArgumentParser(description='Plot the command trajectory of a cfg to a file')
+    parser.add_argument('config', help='config name, e.g. traj1')
+    parser.add_argument('--format', choices=FORMATS, default=None, help='figure format (default: the [Plot] format of the cfg)')
+    args = parser.parse_args()
+
+    config = utils.load_config(args.config)
+    if args.format is not None:
+        config['plot_format'] = args.format
+    data = open_store(config)
+    figure = traj_figure([('User Input Traj', np.array(data['command_abs_traj'])),
+                          ('User Input Traj (Relative)', np.array(data['command_rel_traj']))],
+                         n_frames=config['plot_frames'])
+    save_figure(figure, plot_file_path(config, 'user_input_traj'))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+Streaming export of joint trajectories for the ROS node
+
+create_yaml() in pose_traj_sim.py (format 'yaml', the default) keeps the original
+schema. The other formats are written incrementally, a chunk of points at a time,
+with the time stamp and the joint velocities of every point:
+
+* yaml_flow: one flow-style line per point, same keys as the yaml schema plus time and
+  Joint_Velocities, e.g. - {Joint_Positions: [...], traj_point: 0, time: 0.0, Joint_Velocities: [...]}
+* csv: traj_point, time, q1..qn, dq1..dqn
+* bin: compact float32 rows [time, q1..qn, dq1..dqn] after a small JSON header,
+  optionally zlib-compressed
+
+The format is selected by the [Export] section of the cfg. Print a summary of an
+exported file (any format) with:
+    python trajectory_export.py data_saved/traj1.traj
+"""
+
+import os
+import sys
+import json
+import zlib
+import struct
+import numpy as np
+
+FORMATS = ['yaml', 'yaml_flow', 'csv', 'bin']
+EXTENSIONS = {'yaml': '.yaml', 'yaml_flow': '.yaml', 'csv': '.csv', 'bin': '.traj'}
+MAGIC = b'TELEOPTRAJ1\n'
+CHUNK_SIZE = 4096
+
+def joint_velocities(joint_traj, time_stamps):
+    """
+    Returns the joint velocities (N,n) of the joint trajectory by finite differences in time,
+    the mean of the velocities of the segments before and after each point
+    Segments without a time increment (repeated time stamps) have zero velocity
+    """
+    joint_traj = np.asarray(joint_traj, dtype=float)
+    if len(joint_traj) < 2:
+        return np.zeros_like(joint_traj)
+    dt = np.diff(np.asarray(time_stamps, dtype=float))[:,None]
+    segment = np.divide(np.diff(joint_traj, axis=0), dt, out=np.zeros((len(dt), joint_traj.shape[1])), where=dt > 0)
+    return np.vstack([segment[:1], (segment[:-1] + segment[1:]) / 2, segment[-1:]])
+
+def _format_row(values):
+    return ', '.join(repr(float(x)) for x in values)
+
+class TrajectoryWriter:
+    """
+    Writes joint trajectory points incrementally to a yaml_flow, csv or bin file
+
+    file_path = output file
+    n_joints = number of joints of a point
+    file_format = 'yaml_flow', 'csv' or 'bin'
+    compress = zlib-compress the bin rows
+    """
+    def __init__(self, file_path, n_joints=6, file_format='bin', compress=False):
+        if file_format not in ('yaml_flow', 'csv', 'bin'):
+            raise ValueError(f'Unknown streaming export format {file_format}')
+        self.file_path = file_path
+        self.n_joints = n_joints
+        self.file_format = file_format
+        self.compress = compress and file_format == 'bin'
+        self.n_points = 0
+        self.file = open(file_path, 'wb' if file_format == 'bin' else 'w')
+        self.compressor = zlib.compressobj() if self.compress else None
+        if file_format == 'csv':
+            self.file.write(','.join(['traj_point', 'time'] + [f'q{k + 1}' for k in range(n_joints)]
+                                     + [f'dq{k + 1}' for k in range(n_joints)]) + '\n')
+        elif file_format == 'bin':
+            header = json.dumps({'n_joints': n_joints, 'dtype': '<f4', 'compressed': self.compress,
+                                 'columns': ['time'] + [f'q{k + 1}' for k in range(n_joints)]
+                                            + [f'dq{k + 1}' for k in range(n_joints)]}).encode()
+            self.file.write(MAGIC + struct.pack('<I', len(header)) + header)
+
+    def write(self, time_stamps, joint_positions, joint_velocities):
+        """
+        Appends a chunk of points: time stamps (K,), joint positions and velocities (K,n)
+        """
+        time_stamps = np.asarray(time_stamps, dtype=float).reshape(-1)
+        joint_positions = np.asarray(joint_positions, dtype=float).reshape(-1, self.n_joints)
+        joint_velocities = np.asarray(joint_velocities, dtype=float).reshape(-1, self.n_joints)
+        if self.file_format == 'bin':
+            rows = np.column_stack([time_stamps, joint_positions, joint_velocities]).astype('<f4').tobytes()
+            self.file.write(self.compressor.compress(rows) if self.compress else rows)
+        elif self.file_format == 'csv':
+            self.file.writelines(
+                f'{self.n_points + k},{float(t)!r},' + ','.join(repr(float(x)) for x in np.r_[q, dq]) + '\n'
+                for k, (t, q, dq) in enumerate(zip(time_stamps, joint_positions, joint_velocities)))
+        else:
+            self.file.writelines(
+                f'- {{Joint_Positions: [{_format_row(q)}], traj_point: {self.n_points + k}, '
+                f'time: {float(t)!r}, Joint_Velocities: [{_format_row(dq)}]}}\n'
+                for k, (t, q, dq) in enumerate(zip(time_stamps, joint_positions, joint_velocities)))
+        self.n_points += len(time_stamps)
+
+    def close(self):
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def export_trajectory(file_path, joint_traj, time_stamps, file_format='bin', compress=False, chunk_size=CHUNK_SIZE):
+    """
+    Writes the joint trajectory (N,n) with its time stamps (N,) and joint velocities,
+    chunk_size points at a time
+    """
+    joint_traj = np.asarray(joint_traj)
+    time_stamps = np.asarray(time_stamps, dtype=float)
+    velocities = joint_velocities(joint_traj, time_stamps)
+    with TrajectoryWriter(file_path, joint_traj.shape[1], file_format, compress) as writer:
+        for start in range(0, len(joint_traj), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            writer.write(time_stamps[chunk], joint_traj[chunk], velocities[chunk])
+    print('joint state trajectory saved as: ', file_path)
+
+def load_trajectory(file_path):
+    """
+    Returns the time stamps (N,), joint positions (N,n) and joint velocities (N,n) of an
+    exported trajectory, in any format. The time stamps and velocities of the original
+    yaml schema are None
+    """
+    if file_path.endswith('.csv'):
+        rows = np.loadtxt(file_path, delimiter=',', skiprows=1, ndmin=2)
+        n_joints = (rows.shape[1] - 2) // 2
+        return rows[:,1], rows[:,2:2 + n_joints], rows[:,2 + n_joints:]
+    with open(file_path, 'rb') as f:
+        if f.read(len(MAGIC)) == MAGIC:
+            (header_size,) = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_size))
+            payload = f.read()
+            if header['compressed']:
+                payload = zlib.decompress(payload)
+            rows = np.frombuffer(payload, dtype=header['dtype']).reshape(-1, 1 + 2 * header['n_joints'])
+            n_joints = header['n_joints']
+            return rows[:,0], rows[:,1:1 + n_joints], rows[:,1 + n_joints:]
+    import yaml
+    with open(file_path) as f:
+        points = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    joint_positions = np.array([point['Joint_Positions'] for point in points])
+    if points and 'time' in points[0]:
+        return (np.array([point['time'] for point in points]), joint_positions,
+                np.array([point['Joint_Velocities'] for point in points]))
+    return None, joint_positions, None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('usage: python trajectory_export.py <exported trajectory>')
+    time_stamps, joint_positions, velocities = load_trajectory(sys.argv[1])
+    print(f'{sys.argv[1]}: {len(joint_positions)} points, {joint_positions.shape[1]} joints, '
+          f'{os.path.getsize(sys.argv[1]) / 1024:.1f} kB')
+    if time_stamps is not None:
+        print(f'time = [{time_stamps[0]:.3f}, {time_stamps[-1]:.3f}] s, '
+              f'max joint speed {np.abs(velocities).max():.3f} rad/s')
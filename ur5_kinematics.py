@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+Closed-form UR5 kinematics on plain numpy arrays
+
+Hand-derived forward kinematics and geometric (base frame) Jacobian of the
+rtb.models.UR5() URDF chain, base_link -> ee_link. Joints 2, 3 and 4 share the
+same axis direction, so the arm reduces to a planar chain in the shoulder frame
+F1 = Rz(q1) * Tz(D1) and everything is written in terms of q2+q3 and q2+q3+q4.
+
+fkine/jacob0 accept a single configuration (6,), which takes a scalar
+fast path, or a batch (N,6).
+
+Run this file to check the parity against the roboticstoolbox model:
+    python ur5_kinematics.py
+or the test (skipped when rtb.models.UR5() cannot be loaded):
+    python -m pytest tests
+"""
+
+import math
+import numpy as np
+
+# UR5 URDF link offsets [m]
+D1 = 0.089159               # base -> shoulder_pan (z)
+SHOULDER_OFFSET = 0.13585   # shoulder_pan -> shoulder_lift (y)
+ELBOW_OFFSET = -0.1197      # shoulder_lift -> elbow (y)
+A2 = 0.425                  # upper arm length
+A3 = 0.39225                # forearm length
+D4 = 0.093                  # wrist_1 -> wrist_2 (y)
+D5 = 0.09465                # wrist_2 -> wrist_3 (z)
+D6 = 0.0823                 # wrist_3 -> ee_link (y)
+
+def _joint_terms(q):
+    q = np.asarray(q, dtype=float)
+    q1, q2, q3, q4, q5, q6 = (q[..., i] for i in range(6))
+    q23 = q2 + q3
+    q234 = q23 + q4
+    return {
+        'c1': np.cos(q1), 's1': np.sin(q1),
+        'c2': np.cos(q2), 's2': np.sin(q2),
+        'c23': np.cos(q23), 's23': np.sin(q23),
+        'c234': np.cos(q234), 's234': np.sin(q234),
+        'c5': np.cos(q5), 's5': np.sin(q5),
+        'c6': np.cos(q6), 's6': np.sin(q6),
+    }
+
+def _rotate_z(c1, s1, vec):
+    # Rz(q1) @ vec, vec (...,3)
+    out = np.empty_like(vec)
+    out[..., 0] = c1 * vec[..., 0] - s1 * vec[..., 1]
+    out[..., 1] = s1 * vec[..., 0] + c1 * vec[..., 1]
+    out[..., 2] = vec[..., 2]
+    return out
+
+def _scalar_terms(q):
+    q1, q2, q3, q4, q5, q6 = (float(x) for x in q)
+    q23 = q2 + q3
+    q234 = q23 + q4
+    return (math.cos(q1), math.sin(q1), math.cos(q2), math.sin(q2), math.cos(q23), math.sin(q23),
+            math.cos(q234), math.sin(q234), math.cos(q5), math.sin(q5), math.cos(q6), math.sin(q6))
+
+def fkine_single(q):
+    """
+    Returns the ee_link pose wrt the robot base frame as a (4,4) ndarray
+    Scalar fast path of fkine() for a single (6,) configuration
+    """
+    c1, s1, c2, s2, c23, s23, c234, s234, c5, s5, c6, s6 = _scalar_terms(q)
+    r0 = (s5 * c234, c5 * c6 * c234 - s6 * s234, -c5 * s6 * c234 - c6 * s234)
+    r1 = (c5, -s5 * c6, s5 * s6)
+    x = A2 * c2 + A3 * c23 - D5 * s234 + D6 * s5 * c234
+    y = SHOULDER_OFFSET + ELBOW_OFFSET + D4 + D6 * c5
+    z = -A2 * s2 - A3 * s23 - D5 * c234 - D6 * s5 * s234
+    return np.array([
+        [c1 * r0[0] - s1 * r1[0], c1 * r0[1] - s1 * r1[1], c1 * r0[2] - s1 * r1[2], c1 * x - s1 * y],
+        [s1 * r0[0] + c1 * r1[0], s1 * r0[1] + c1 * r1[1], s1 * r0[2] + c1 * r1[2], s1 * x + c1 * y],
+        [-s5 * s234, -c5 * c6 * s234 - s6 * c234, c5 * s6 * s234 - c6 * c234, z + D1],
+        [0.0, 0.0, 0.0, 1.0]])
+
+def jacob0_single(q):
+    """
+    Returns the geometric Jacobian [v; w] wrt the robot base frame as a (6,6) ndarray
+    Scalar fast path of jacob0() for a single (6,) configuration
+    """
+    c1, s1, c2, s2, c23, s23, c234, s234, c5, s5, c6, s6 = _scalar_terms(q)
+    # ee position relative to each joint, in F1
+    e6 = (D6 * s5 * c234, D6 * c5, -D6 * s5 * s234)
+    e5 = (e6[0] - D5 * s234, e6[1], e6[2] - D5 * c234)
+    e3 = (e5[0] + A3 * c23, e5[1] + D4, e5[2] - A3 * s23)
+    e2 = (e3[0] + A2 * c2, e3[1] + ELBOW_OFFSET, e3[2] - A2 * s2)
+    e1 = (e2[0], e2[1] + SHOULDER_OFFSET, e2[2])
+    w5 = (-s234, 0.0, -c234)
+    w6 = (s5 * c234, c5, -s5 * s234)
+    # axis x (p_ee - p_i) in F1, the y axis is shared by joints 2-4
+    cols = [
+        ((-e1[1], e1[0], 0.0), (0.0, 0.0, 1.0)),
+        ((e2[2], 0.0, -e2[0]), (0.0, 1.0, 0.0)),
+        ((e3[2], 0.0, -e3[0]), (0.0, 1.0, 0.0)),
+        ((e5[2], 0.0, -e5[0]), (0.0, 1.0, 0.0)),
+        ((w5[1] * e5[2] - w5[2] * e5[1], w5[2] * e5[0] - w5[0] * e5[2], w5[0] * e5[1] - w5[1] * e5[0]), w5),
+        ((w6[1] * e6[2] - w6[2] * e6[1], w6[2] * e6[0] - w6[0] * e6[2], w6[0] * e6[1] - w6[1] * e6[0]), w6),
+    ]
+    jac = np.empty((6, 6))
+    for i, (v, w) in enumerate(cols):
+        jac[0, i], jac[1, i], jac[2, i] = c1 * v[0] - s1 * v[1], s1 * v[0] + c1 * v[1], v[2]
+        jac[3, i], jac[4, i], jac[5, i] = c1 * w[0] - s1 * w[1], s1 * w[0] + c1 * w[1], w[2]
+    return jac
+
+def fkine(q):
+    """
+    Returns the ee_link pose(s) wrt the robot base frame as a (4,4) or (N,4,4) ndarray
+    """
+    if np.ndim(q) == 1:
+        return fkine_single(q)
+    t = _joint_terms(q)
+    c1, s1, c234, s234, c5, s5, c6, s6 = (t[k] for k in ('c1', 's1', 'c234', 's234', 'c5', 's5', 'c6', 's6'))
+    shape = np.shape(c1)
+
+    # rotation in the shoulder frame F1: Ry(pi+q234) Rz(q5) Ry(q6) Rz(pi/2)
+    rot = np.empty(shape + (3, 3))
+    rot[..., 0, 0] = s5 * c234
+    rot[..., 0, 1] = c5 * c6 * c234 - s6 * s234
+    rot[..., 0, 2] = -c5 * s6 * c234 - c6 * s234
+    rot[..., 1, 0] = c5
+    rot[..., 1, 1] = -s5 * c6
+    rot[..., 1, 2] = s5 * s6
+    rot[..., 2, 0] = -s5 * s234
+    rot[..., 2, 1] = -c5 * c6 * s234 - s6 * c234
+    rot[..., 2, 2] = c5 * s6 * s234 - c6 * c234
+
+    # position in the shoulder frame F1
+    pos = np.empty(shape + (3,))
+    pos[..., 0] = A2 * t['c2'] + A3 * t['c23'] - D5 * s234 + D6 * s5 * c234
+    pos[..., 1] = SHOULDER_OFFSET + ELBOW_OFFSET + D4 + D6 * c5
+    pos[..., 2] = -A2 * t['s2'] - A3 * t['s23'] - D5 * c234 - D6 * s5 * s234
+
+    pose = np.zeros(shape + (4, 4))
+    pose[..., 0, :3] = c1[..., None] * rot[..., 0, :] - s1[..., None] * rot[..., 1, :]
+    pose[..., 1, :3] = s1[..., None] * rot[..., 0, :] + c1[..., None] * rot[..., 1, :]
+    pose[..., 2, :3] = rot[..., 2, :]
+    pose[..., :3, 3] = _rotate_z(c1, s1, pos)
+    pose[..., 2, 3] += D1
+    pose[..., 3, 3] = 1.0
+    return pose
+
+def jacob0(q):
+    """
+    Returns the geometric Jacobian(s) [v; w] wrt the robot base frame as a (6,6) or (N,6,6) ndarray
+    """
+    if np.ndim(q) == 1:
+        return jacob0_single(q)
+    t = _joint_terms(q)
+    c1, s1, c234, s234, c5, s5 = (t[k] for k in ('c1', 's1', 'c234', 's234', 'c5', 's5'))
+    shape = np.shape(c1)
+    zeros, ones = np.zeros(shape), np.ones(shape)
+
+    # joint axes in the shoulder frame F1
+    y_axis = np.stack([zeros, ones, zeros], axis=-1)
+    axes = np.stack([
+        np.stack([zeros, zeros, ones], axis=-1),
+        y_axis, y_axis, y_axis,
+        np.stack([-s234, zeros, -c234], axis=-1),
+        np.stack([s5 * c234, c5, -s5 * s234], axis=-1),
+    ], axis=-2)
+
+    # points on the joint axes in F1 (F1 origin is on the axis of joint 1)
+    p2 = np.stack([zeros, SHOULDER_OFFSET * ones, zeros], axis=-1)
+    p3 = p2 + np.stack([A2 * t['c2'], ELBOW_OFFSET * ones, -A2 * t['s2']], axis=-1)
+    p4 = p3 + np.stack([A3 * t['c23'], zeros, -A3 * t['s23']], axis=-1)
+    p5 = p4 + np.stack([zeros, D4 * ones, zeros], axis=-1)
+    p6 = p5 + np.stack([-D5 * s234, zeros, -D5 * c234], axis=-1)
+    p_ee = p6 + np.stack([D6 * s5 * c234, D6 * c5 * ones, -D6 * s5 * s234], axis=-1)
+    points = np.stack([np.zeros(shape + (3,)), p2, p3, p4, p5, p6], axis=-2)
+
+    lin = np.cross(axes, p_ee[..., None, :] - points)
+
+    jac = np.empty(shape + (6, 6))
+    jac[..., :3, :] = np.swapaxes(_rotate_z(c1[..., None], s1[..., None], lin), -1, -2)
+    jac[..., 3:, :] = np.swapaxes(_rotate_z(c1[..., None], s1[..., None], axes), -1, -2)
+    return jac
+
+def joint_positions(q):
+    """
+    Returns the positions of the base, the shoulder, the points on the axes of joints 2-6
+    and the ee_link wrt the robot base frame as a (8,3) or (N,8,3) ndarray, e.g. to draw
+    the arm as a polyline
+    """
+    t = _joint_terms(q)
+    c1, s1, c234, s234, c5, s5 = (t[k] for k in ('c1', 's1', 'c234', 's234', 'c5', 's5'))
+    shape = np.shape(c1)
+    zeros, ones = np.zeros(shape), np.ones(shape)
+
+    # same chain as jacob0, in the shoulder frame F1
+    p2 = np.stack([zeros, SHOULDER_OFFSET * ones, zeros], axis=-1)
+    p3 = p2 + np.stack([A2 * t['c2'], ELBOW_OFFSET * ones, -A2 * t['s2']], axis=-1)
+    p4 = p3 + np.stack([A3 * t['c23'], zeros, -A3 * t['s23']], axis=-1)
+    p5 = p4 + np.stack([zeros, D4 * ones, zeros], axis=-1)
+    p6 = p5 + np.stack([-D5 * s234, zeros, -D5 * c234], axis=-1)
+    p_ee = p6 + np.stack([D6 * s5 * c234, D6 * c5 * ones, -D6 * s5 * s234], axis=-1)
+    points = _rotate_z(c1[..., None], s1[..., None], np.stack([np.zeros(shape + (3,)), np.zeros(shape + (3,)), p2, p3, p4, p5, p6, p_ee], axis=-2))
+    points[..., 1:, 2] += D1
+    return points
+
+def kinematics_backend(backend='rtb', robot=None):
+    """
+    Returns the (fkine, jacob0) pair of functions, both returning ndarrays
+
+    backend = 'ur5' for the closed-form kernel in this file,
+              'rtb' for the generic roboticstoolbox model given as robot
+              (the cached teleop_utils.get_robot() model by default),
+              'ets' for the same model evaluated in batches (see batch_kinematics.py)
+    """
+    if backend == 'ur5':
+        return fkine, jacob0
+    elif backend == 'ets':
+        import batch_kinematics
+        kinematics = batch_kinematics.default_kinematics() if robot is None else batch_kinematics.ETSKinematics(robot)
+        return kinematics.fkine, kinematics.jacob0
+    elif backend == 'rtb':
+        if robot is None:
+            import teleop_utils
+            robot = teleop_utils.get_robot()
+        return (lambda q: robot.fkine(q).A), robot.jacob0
+    else:
+        raise ValueError(f'Unknown kinematics backend {backend}')
+
+def parity_check(robot, n_samples=1000, seed=0):
+    """
+    Returns the max abs FK and Jacobian differences to the rtb model over random configurations
+    """
+    rng = np.random.default_rng(seed)
+    q_samples = rng.uniform(-np.pi, np.pi, size=(n_samples, 6))
+    fk_batch, jac_batch = fkine(q_samples), jacob0(q_samples)
+    fk_err, jac_err = 0.0, 0.0
+    for q, fk, jac in zip(q_samples, fk_batch, jac_batch):
+        # batched path and scalar fast path
+        fk_err = max(fk_err, np.abs(robot.fkine(q).A - fk).max(), np.abs(robot.fkine(q).A - fkine_single(q)).max())
+        jac_err = max(jac_err, np.abs(robot.jacob0(q) - jac).max(), np.abs(robot.jacob0(q) - jacob0_single(q)).max())
+    return fk_err, jac_err
+
+
+if __name__ == '__main__':
+    import roboticstoolbox as rtb
+
+    fk_err, jac_err = parity_check(rtb.models.UR5())
+    print(f'Max FK error: {fk_err:.3e}, max Jacobian error: {jac_err:.3e}')
+    assert fk_err < 1e-9 and jac_err < 1e-9, 'Closed-form UR5 kinematics do not match rtb.models.UR5()'